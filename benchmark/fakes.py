@@ -0,0 +1,428 @@
+"""
+Stand-ins for the Chromecast devices and the MQTT broker, everything runs in-process without any network.
+"""
+import heapq
+from collections import namedtuple
+from queue import Queue
+from threading import Thread, Condition, Lock
+from time import time, sleep
+
+from paho.mqtt import client
+from paho.mqtt.client import topic_matches_sub
+from pychromecast.socket_client import CONNECTION_STATUS_CONNECTED, CONNECTION_STATUS_DISCONNECTED
+
+from handler.adapter import ChromecastConnection, ConnectionUnavailableException
+
+FakeCastInfo = namedtuple("FakeCastInfo", ["host", "port", "uuid", "model_name", "friendly_name"])
+FakeCastStatus = namedtuple("FakeCastStatus", ["display_name", "volume_level", "volume_muted", "app_id"])
+FakeConnectionStatus = namedtuple("FakeConnectionStatus", ["status"])
+FakeMediaStatus = namedtuple("FakeMediaStatus", ["media_metadata", "player_state", "current_time", "duration",
+                                                 "playback_rate", "title", "album_name", "artist", "album_artist",
+                                                 "track", "content_type", "content_id"])
+FakeMqttMessage = namedtuple("FakeMqttMessage", ["topic", "payload", "retain", "properties"])
+FakeConnackProperties = namedtuple("FakeConnackProperties", ["TopicAliasMaximum"])
+
+
+class SimulatedNetwork(Thread):
+    """
+    Delivers the callbacks of all simulated devices after a delay, like the socket threads of pychromecast do.
+    """
+
+    def __init__(self):
+        Thread.__init__(self, name="simulated-network")
+        self.daemon = True
+
+        self.condition = Condition()
+        self.schedule = []
+        self.counter = 0
+        self.devices = {}
+
+    def add_device(self, device):
+        self.devices[device.name] = device
+
+    def get_device(self, device_name):
+        device = self.devices.get(device_name)
+        if device is None or not device.is_online:
+            raise ConnectionUnavailableException()
+
+        return device
+
+    def call_later(self, delay, callback, *args):
+        with self.condition:
+            heapq.heappush(self.schedule, (time() + delay, self.counter, callback, args))
+            self.counter += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.schedule) == 0 or self.schedule[0][0] > time():
+                    timeout = self.schedule[0][0] - time() if len(self.schedule) > 0 else None
+                    self.condition.wait(timeout)
+
+                _, _, callback, args = heapq.heappop(self.schedule)
+
+            callback(*args)
+
+
+class FakeMediaController:
+
+    def __init__(self, device):
+        self.device = device
+        self.status = device.media_status
+        self.listeners = []
+
+    def register_status_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _command(self, name, **changes):
+        self.device.execute(name, media_changes=changes)
+
+    def play_media(self, url, content_type, **kwargs):
+        self._command("play_media", player_state="PLAYING", content_id=url, content_type=content_type,
+                      current_time=0)
+
+    def pause(self):
+        self._command("pause", player_state="PAUSED")
+
+    def play(self):
+        self._command("play", player_state="PLAYING")
+
+    def stop(self):
+        self._command("stop", player_state="IDLE")
+
+    def seek(self, position):
+        self._command("seek", current_time=float(position))
+
+    def rewind(self):
+        self._command("rewind", current_time=0.0)
+
+    def queue_prev(self):
+        self._command("queue_prev", current_time=0.0)
+
+    def queue_next(self):
+        self._command("queue_next", current_time=0.0)
+
+
+class FakeChromecast:
+    """
+    Simulated pychromecast device. Every command blocks the caller for response_latency seconds, the resulting
+    status is reported status_delay seconds later. All executed commands are recorded as (name, time).
+    """
+
+    def __init__(self, name, network, response_latency=0.005, status_delay=0.01):
+        self.name = name
+        self.network = network
+        self.response_latency = response_latency
+        self.status_delay = status_delay
+
+        self.cast_type = "audio"
+        self.cast_info = FakeCastInfo("127.0.0.1", 8009, "uuid-%s" % name, "Fake Cast", name)
+        self.status = FakeCastStatus("Default Media Receiver", 0.5, False, "CC1AD845")
+        self.media_status = FakeMediaStatus({}, "PLAYING", 0.0, 300.0, 1, "title", None, None, None, None,
+                                            "audio/mpeg", "http://stream")
+        self.media_controller = FakeMediaController(self)
+
+        self.is_online = True
+        self.lock = Lock()
+        self.status_listeners = []
+        self.connection_listeners = []
+        self.commands = []
+
+        network.add_device(self)
+
+    def register_status_listener(self, listener):
+        self.status_listeners.append(listener)
+
+    def register_connection_listener(self, listener):
+        self.connection_listeners.append(listener)
+        self.network.call_later(0.001, self._emit_connection_status, CONNECTION_STATUS_CONNECTED)
+        self.network.call_later(0.002, self.emit_cast_status)
+
+    def register_launch_error_listener(self, listener):
+        pass
+
+    def disconnect(self):
+        self.status_listeners = []
+        self.connection_listeners = []
+        self.media_controller.listeners = []
+
+    def set_volume(self, level):
+        self.execute("set_volume", cast_changes={"volume_level": level})
+
+    def set_volume_muted(self, muted):
+        self.execute("set_volume_muted", cast_changes={"volume_muted": muted})
+
+    def execute(self, name, cast_changes=None, media_changes=None):
+        if not self.is_online:
+            raise ConnectionError("device %s is offline" % self.name)
+
+        sleep(self.response_latency)
+
+        with self.lock:
+            self.commands.append((name, time()))
+
+            if cast_changes:
+                self.status = self.status._replace(**cast_changes)
+                self.network.call_later(self.status_delay, self.emit_cast_status)
+            if media_changes:
+                self.media_status = self.media_status._replace(**media_changes)
+                self.media_controller.status = self.media_status
+                self.network.call_later(self.status_delay, self.emit_media_status)
+
+    def emit_cast_status(self):
+        for listener in list(self.status_listeners):
+            listener.new_cast_status(self.status)
+
+    def emit_media_status(self, current_time=None):
+        if current_time is not None:
+            with self.lock:
+                self.media_status = self.media_status._replace(current_time=current_time)
+                self.media_controller.status = self.media_status
+
+        for listener in list(self.media_controller.listeners):
+            listener.new_media_status(self.media_status)
+
+    def _emit_connection_status(self, status):
+        for listener in list(self.connection_listeners):
+            listener.new_connection_status(FakeConnectionStatus(status))
+
+    def go_offline(self):
+        self.is_online = False
+        self._emit_connection_status(CONNECTION_STATUS_DISCONNECTED)
+
+    def go_online(self):
+        self.is_online = True
+
+
+class SimulatedConnection(ChromecastConnection):
+    """
+    Device connection using the simulated network instead of looking up the device.
+    """
+
+    network = None
+
+    def _internal_find_device(self, device_name):
+        return self.network.get_device(device_name)
+
+
+class FakeBroker:
+    """
+    In-process MQTT broker: retained messages, wildcard and shared subscriptions, topic aliases, last wills and
+    outages. Messages are delivered by a single thread, like the network thread of a paho client.
+    """
+
+    def __init__(self, topic_alias_maximum=0):
+        self.lock = Lock()
+        self.is_running = True
+        self.clients = []
+        self.subscriptions = {}
+        self.retained = {}
+        self.publish_count = 0
+        self.aliased_count = 0
+        self.shared_counter = 0
+
+        # aliases are announced in the connack and are valid per client and connection
+        self.topic_alias_maximum = topic_alias_maximum
+        self.topic_aliases = {}
+
+        self.deliveries = Queue()
+        self.delivery_thread = Thread(target=self._deliver, name="fake-broker")
+        self.delivery_thread.daemon = True
+        self.delivery_thread.start()
+
+    def connect(self, mqtt_client):
+        with self.lock:
+            if not self.is_running:
+                raise ConnectionRefusedError("broker is down")
+
+            if mqtt_client not in self.clients:
+                self.clients.append(mqtt_client)
+
+            mqtt_client.is_connected_flag = True
+            self.topic_aliases[mqtt_client] = {}
+
+        self.deliveries.put((mqtt_client.on_connect, (mqtt_client, None, {}, 0,
+                                                      FakeConnackProperties(self.topic_alias_maximum))))
+
+    def subscribe(self, mqtt_client, topic_filter):
+        with self.lock:
+            self.subscriptions.setdefault(mqtt_client, set()).add(topic_filter)
+
+            # retained messages are not sent for shared subscriptions
+            retained = [(topic, payload) for topic, payload in self.retained.items()
+                        if not topic_filter.startswith("$share/") and topic_matches_sub(topic_filter, topic)]
+
+        for topic, payload in retained:
+            self.deliveries.put((mqtt_client.on_message, (mqtt_client, None, FakeMqttMessage(topic, payload, True,
+                                                                                             None))))
+
+    def publish(self, mqtt_client, topic, payload, retain, properties):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif payload is None:
+            payload = b""
+
+        with self.lock:
+            if not self.is_running or not mqtt_client.is_connected_flag:
+                return client.MQTT_ERR_NO_CONN
+
+            alias = getattr(properties, "TopicAlias", None)
+            if alias is not None:
+                aliases = self.topic_aliases[mqtt_client]
+                if len(topic) == 0:
+                    topic = aliases[alias]
+                    self.aliased_count += 1
+                elif alias <= self.topic_alias_maximum:
+                    aliases[alias] = topic
+                else:
+                    raise ValueError("topic alias %d exceeds the maximum" % alias)
+
+        self._route(topic, payload, retain, properties)
+        return client.MQTT_ERR_SUCCESS
+
+    def _route(self, topic, payload, retain, properties):
+        with self.lock:
+            self.publish_count += 1
+
+            if retain:
+                if len(payload) == 0:
+                    self.retained.pop(topic, None)
+                else:
+                    self.retained[topic] = payload
+
+            receivers = []
+            shared_receivers = {}
+            for receiver, topic_filters in self.subscriptions.items():
+                for topic_filter in topic_filters:
+                    if not topic_filter.startswith("$share/"):
+                        if topic_matches_sub(topic_filter, topic):
+                            receivers.append(receiver)
+                            break
+                        continue
+
+                    # $share/<group>/<filter>: one receiver per group
+                    _, group, shared_filter = topic_filter.split("/", 2)
+                    if topic_matches_sub(shared_filter, topic):
+                        shared_receivers.setdefault(group, []).append(receiver)
+
+            for group_receivers in shared_receivers.values():
+                self.shared_counter += 1
+                receiver = group_receivers[self.shared_counter % len(group_receivers)]
+                if receiver not in receivers:
+                    receivers.append(receiver)
+
+        for receiver in receivers:
+            self.deliveries.put((receiver.on_message, (receiver, None, FakeMqttMessage(topic, payload, False,
+                                                                                       properties))))
+
+    def get_retained(self, topic):
+        with self.lock:
+            payload = self.retained.get(topic)
+
+        return payload.decode("utf-8") if payload is not None else None
+
+    def stop(self):
+        """
+        Simulate an outage, all clients are disconnected and lose their subscriptions.
+        """
+        with self.lock:
+            self.is_running = False
+            self.subscriptions.clear()
+
+            for mqtt_client in self.clients:
+                mqtt_client.is_connected_flag = False
+
+    def kill(self, mqtt_client):
+        """
+        Simulate a client which died: it is disconnected for good and its last will is published.
+        """
+        with self.lock:
+            if mqtt_client in self.clients:
+                self.clients.remove(mqtt_client)
+            self.subscriptions.pop(mqtt_client, None)
+            mqtt_client.is_connected_flag = False
+
+        if mqtt_client.will is not None:
+            topic, payload, retain = mqtt_client.will
+            self._route(topic, payload.encode("utf-8") if isinstance(payload, str) else payload or b"", retain, None)
+
+    def start(self):
+        """
+        End an outage, all clients reconnect like paho does automatically.
+        """
+        with self.lock:
+            self.is_running = True
+            clients = list(self.clients)
+
+        for mqtt_client in clients:
+            self.connect(mqtt_client)
+
+    def _deliver(self):
+        while True:
+            callback, args = self.deliveries.get()
+
+            if callback is not None:
+                callback(*args)
+
+
+class FakeMqttClient:
+    """
+    Replacement for the paho client, connected to a FakeBroker.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_connected_flag = False
+        self.on_connect = None
+        self.on_message = None
+        self.message_id = 0
+        self.will = None
+
+    def username_pw_set(self, username, password):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.will = (topic, payload, retain)
+
+    def connect(self, host=None, port=None, *args, **kwargs):
+        self.broker.connect(self)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self, *args, **kwargs):
+        self.is_connected_flag = False
+
+    def is_connected(self):
+        return self.is_connected_flag
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        self.broker.subscribe(self, topic)
+        return self._result(client.MQTT_ERR_SUCCESS)
+
+    def unsubscribe(self, topic, properties=None):
+        return self._result(client.MQTT_ERR_SUCCESS)
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        return self._result(self.broker.publish(self, topic, payload, retain, properties))
+
+    def _result(self, rc):
+        self.message_id += 1
+        return rc, self.message_id
+
+
+def attach_fake_client(mqtt_connection, broker):
+    """
+    Replace the paho client of a MqttConnection by a client connected to the fake broker.
+    """
+    fake_client = FakeMqttClient(broker)
+    fake_client.on_connect = mqtt_connection.mqtt.on_connect
+    fake_client.on_message = mqtt_connection.mqtt.on_message
+
+    mqtt_connection.mqtt = fake_client
+    mqtt_connection.network_loop = None
+    return fake_client
@@ -0,0 +1,159 @@
+"""
+Builds the connector like connector.py does, but with simulated devices and the in-process broker.
+"""
+import resource
+import threading
+from time import time, sleep, process_time
+
+from paho.mqtt import client
+
+from benchmark.fakes import SimulatedNetwork, FakeChromecast, SimulatedConnection, FakeBroker, FakeMqttClient, \
+    attach_fake_client
+from handler.adapter import ConnectionSettings
+from handler.event import EventHandler
+from handler.group import GroupSettings
+from helper import metrics
+from helper.aio import AsyncRuntime
+from helper.cluster import ClusterMembership
+from helper.mqtt import MqttConnection
+from helper.pool import WorkerPool
+from helper.reconnect import ReconnectScheduler
+
+
+class SimulatedEventHandler(EventHandler):
+
+    connection_class = SimulatedConnection
+
+
+class BenchmarkConnector:
+    """
+    Connector wired to simulated devices. Options mirror config.ini: runtime (threads or asyncio), worker_pool_size
+    and the connection settings. Connectors sharing the network and the broker form a cluster if an instance_id is
+    given. protocol, shared_group and alias_topic_filters are passed to the mqtt connection, group_settings to the event
+    handler.
+    """
+
+    def __init__(self, device_count, runtime="threads", worker_pool_size=0, settings=ConnectionSettings(),
+                 response_latency=0.005, status_delay=0.01, reconnect_base_delay=0.1, reconnect_max_delay=1,
+                 network=None, broker=None, instance_id=None, lease_duration=15, join_duration=0.2,
+                 protocol=client.MQTTv311, shared_group=None, alias_topic_filters=(), group_settings=GroupSettings()):
+        self.network = network
+        if self.network is None:
+            self.network = SimulatedNetwork()
+            self.network.start()
+
+        self.broker = broker if broker is not None else FakeBroker()
+
+        self.runtime = None
+        worker_pool = None
+        if runtime == "asyncio":
+            self.runtime = AsyncRuntime(worker_pool_size if worker_pool_size > 0 else 8)
+            self.runtime.start()
+            worker_pool = self.runtime
+        elif worker_pool_size > 0:
+            worker_pool = WorkerPool(worker_pool_size)
+
+        self.reconnect_scheduler = ReconnectScheduler(reconnect_base_delay, reconnect_max_delay, 0.5, 8)
+        self.reconnect_scheduler.start_scheduler()
+
+        # the connection class is shared by all devices of this process
+        SimulatedConnection.network = self.network
+
+        self.event_handler = SimulatedEventHandler(worker_pool, None, None, settings, self.reconnect_scheduler,
+                                                   runtime=self.runtime, group_settings=group_settings)
+
+        self.mqtt = MqttConnection("127.0.0.1", 1883, None, None, self.event_handler, runtime=self.runtime,
+                                   protocol=protocol, shared_group=shared_group,
+                                   alias_topic_filters=alias_topic_filters)
+        attach_fake_client(self.mqtt, self.broker)
+        self.event_handler.set_mqtt_connection(self.mqtt)
+
+        self.cluster = None
+        if instance_id is not None:
+            self.cluster = ClusterMembership(self.mqtt, instance_id, self.event_handler, lease_duration)
+            self.event_handler.set_cluster(self.cluster)
+
+        self.mqtt.start_connection()
+
+        if self.cluster is not None:
+            self.cluster.start(join_duration)
+
+        # client publishing the commands, like a home automation system would
+        self.publisher = FakeMqttClient(self.broker)
+        self.publisher.connect()
+
+        self.response_latency = response_latency
+        self.status_delay = status_delay
+        self.devices = []
+        self.add_simulated_devices(["device%03d" % index for index in range(device_count)])
+
+        self.cpu_started_at = process_time()
+
+    def add_simulated_devices(self, device_names):
+        """
+        Create simulated devices, they are not known to the connector until add_devices() has been called.
+        """
+        for device_name in device_names:
+            self.devices.append(FakeChromecast(device_name, self.network, self.response_latency, self.status_delay))
+
+    def add_devices(self):
+        for device in self.devices:
+            self.event_handler.on_chromecast_appeared(device.name, device.cast_info.model_name, device.cast_info.host,
+                                                      device.cast_info.port)
+
+    def wait_connected(self, timeout=30):
+        """
+        Wait until all devices are connected, returns the seconds needed.
+        """
+        started_at = time()
+        while time() - started_at < timeout:
+            connections = list(self.event_handler.known_devices.values())
+            if len(connections) == len(self.devices) and all(c.is_connected() for c in connections):
+                return time() - started_at
+
+            sleep(0.01)
+
+        raise TimeoutError("devices not connected within %d seconds" % timeout)
+
+    def wait_until(self, condition, timeout=30):
+        """
+        Wait until a condition is met, returns the seconds needed or None on timeout.
+        """
+        started_at = time()
+        while time() - started_at < timeout:
+            if condition():
+                return time() - started_at
+
+            sleep(0.005)
+
+        return None
+
+    def publish_command(self, device, command, payload):
+        self.publisher.publish("chromecast/%s/command/%s" % (device.name, command), payload)
+
+    def get_process_stats(self):
+        return {
+            "threads": threading.active_count(),
+            "cpu_seconds": round(process_time() - self.cpu_started_at, 3),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "broker_publishes": self.broker.publish_count,
+        }
+
+    def get_metrics(self):
+        return metrics.REGISTRY.render_json()
+
+
+def percentiles(values):
+    """
+    Summary of latencies in seconds, returned in milliseconds.
+    """
+    if len(values) == 0:
+        return {"count": 0}
+
+    ordered = sorted(values)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {"count": len(ordered), "p50_ms": at(0.5), "p95_ms": at(0.95), "p99_ms": at(0.99),
+            "max_ms": round(ordered[-1] * 1000, 3)}
@@ -0,0 +1,126 @@
+"""
+Replay a recording of the connector (see [recording] in config.ini) against simulated devices, at the original speed
+or accelerated. The results are printed as json.
+
+    python -m benchmark.replay events.jsonl.gz --speed 10
+"""
+import argparse
+import json
+import logging
+import sys
+from json import loads
+from time import time, sleep
+
+from benchmark.harness import BenchmarkConnector, percentiles
+from helper.recorder import read_events, EVENT_MQTT_MESSAGE, EVENT_APPEARED, EVENT_DISAPPEARED, EVENT_CAST_STATUS, \
+    EVENT_MEDIA_STATUS, EVENT_CONNECTION_STATUS
+from handler.properties import get_device_name_from_topic
+
+
+def replay(events, connector, speed):
+    """
+    Feed the events into the connector at their recorded time divided by speed. Returns how late the events have been
+    fed in (seconds per event).
+    """
+    devices = {device.name: device for device in connector.devices}
+    delays = []
+    started_at = time()
+
+    for event in events:
+        scheduled_at = started_at + event.time / speed
+        sleep(max(0, scheduled_at - time()))
+        delays.append(time() - scheduled_at)
+
+        device = devices.get(event.device_name)
+
+        if event.kind == EVENT_MQTT_MESSAGE:
+            # through the broker, like the original command
+            connector.publisher.publish(event.data["topic"], event.data["payload"])
+        elif event.kind == EVENT_APPEARED:
+            connector.event_handler.on_chromecast_appeared(event.device_name, event.data["model_name"],
+                                                           event.data["ip_address"], event.data["port"])
+        elif event.kind == EVENT_DISAPPEARED:
+            connector.event_handler.on_chromecast_disappeared(event.device_name)
+        elif event.kind == EVENT_CAST_STATUS:
+            for listener in list(device.status_listeners):
+                listener.new_cast_status(event.data)
+        elif event.kind == EVENT_MEDIA_STATUS:
+            for listener in list(device.media_controller.listeners):
+                listener.new_media_status(event.data)
+        elif event.kind == EVENT_CONNECTION_STATUS:
+            for listener in list(device.connection_listeners):
+                listener.new_connection_status(event.data)
+
+    return delays
+
+
+def get_device_names(events):
+    names = set()
+    for event in events:
+        if event.device_name is not None:
+            names.add(event.device_name)
+        elif event.kind == EVENT_MQTT_MESSAGE:
+            device_name = get_device_name_from_topic(event.data["topic"])
+            # names starting with an underscore are used by the connector itself, e.g. for groups
+            if device_name and not device_name.startswith("_"):
+                names.add(device_name)
+
+    return sorted(names)
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Replay a recording of the chromecast mqtt connector")
+    parser.add_argument("recording", help="file written by the connector, see [recording] in config.ini")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed, e.g. 10 = ten times faster")
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--worker-pool-size", type=int, default=0)
+    parser.add_argument("--response-latency", type=float, default=0.005, help="seconds each device command blocks")
+    parser.add_argument("--output", help="file to write the results to (default: stdout)")
+    options = parser.parse_args(arguments)
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    events = list(read_events(options.recording))
+    device_names = get_device_names(events)
+
+    connector = BenchmarkConnector(0, options.runtime, options.worker_pool_size,
+                                   response_latency=options.response_latency)
+    connector.add_simulated_devices(device_names)
+
+    started_at = time()
+    delays = replay(events, connector, options.speed)
+    replay_seconds = time() - started_at
+
+    # let the connector catch up with the last events
+    connector.wait_until(lambda: connector.event_handler.processing_queue.empty() and all(
+        depth == 0 for depth in connector.event_handler.get_device_queue_depths().values()), 30)
+
+    counts = {}
+    for event in events:
+        counts[event.kind] = counts.get(event.kind, 0) + 1
+
+    results = {
+        "recording": options.recording,
+        "speed": options.speed,
+        "runtime": options.runtime,
+        "devices": len(device_names),
+        "events": counts,
+        "recorded_seconds": events[-1].time if events else 0,
+        "replay_seconds": round(replay_seconds, 3),
+        "drain_seconds": round(time() - started_at - replay_seconds, 3),
+        "feed_delay": percentiles(delays),
+        "device_commands": sum(len(device.commands) for device in connector.devices),
+        "process": connector.get_process_stats(),
+        "metrics": loads(connector.get_metrics()),
+    }
+
+    document = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(document + "\n")
+    else:
+        print(document)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,454 @@
+"""
+Offline benchmark of the connector. Every scenario runs in its own process, the results are printed as json.
+
+    python -m benchmark.run --devices 20 --rate 5 --duration 5 --output results.json
+"""
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+from json import loads
+from time import time, sleep, perf_counter
+
+from benchmark.harness import BenchmarkConnector, percentiles
+from handler.adapter import ConnectionSettings
+from handler.group import GroupSettings
+from handler.properties import TOPIC_GROUP_COMMAND, TOPIC_GROUP_RESULT
+
+
+def send_commands(connector, options):
+    """
+    Publish options.rate commands per second to every device for options.duration seconds. Returns the times the
+    commands have been published (device name -> times) and when sending has been started.
+    """
+    sent = {device.name: [] for device in connector.devices}
+    interval = 1 / options.rate
+    started_at = time()
+    next_round = started_at
+
+    # pause and resume alternate, so that no commands are merged
+    while time() - started_at < options.duration:
+        for device in connector.devices:
+            sent[device.name].append(time())
+            connector.publish_command(device, "player_state", "PAUSE" if len(sent[device.name]) % 2 else "RESUME")
+
+        next_round += interval
+        sleep(max(0, next_round - time()))
+
+    return sent, started_at
+
+
+def get_latencies(devices, sent, executed_before=0):
+    """
+    Returns the seconds from publishing each command until the device executed it, the commands of a device are
+    executed in order. Only the commands after the first executed_before ones are taken into account.
+    """
+    latencies = []
+    for device in devices:
+        executed_times = [executed_at for _, executed_at in device.commands[executed_before:]]
+        latencies.extend(executed_at - sent_at for sent_at, executed_at in zip(sent[device.name], executed_times))
+
+    return latencies
+
+
+def run_commands(options):
+    """
+    N devices x M commands per second: latency from publishing a command until the device executes it.
+    """
+    connector = BenchmarkConnector(options.devices, options.runtime, options.worker_pool_size)
+    connector.add_devices()
+    connect_seconds = connector.wait_connected()
+
+    sent, started_at = send_commands(connector, options)
+
+    total_sent = sum(len(times) for times in sent.values())
+    connector.wait_until(lambda: sum(len(device.commands) for device in connector.devices) >= total_sent, 10)
+    elapsed = time() - started_at
+
+    latencies = get_latencies(connector.devices, sent)
+    executed = sum(len(device.commands) for device in connector.devices)
+
+    return {
+        "connect_seconds": round(connect_seconds, 3),
+        "sent": total_sent,
+        "executed": executed,
+        "commands_per_second": round(executed / elapsed, 1),
+        "latency": percentiles(latencies),
+        "process": connector.get_process_stats(),
+        "metrics": loads(connector.get_metrics()),
+    }
+
+
+def run_hung_device(options):
+    """
+    One device stops answering (every call blocks for hang_seconds) while all devices keep receiving commands:
+    throughput and latency of the other devices, which must not be held up by the hung one.
+    """
+    connector = BenchmarkConnector(options.devices, options.runtime, options.worker_pool_size)
+    connector.add_devices()
+    connector.wait_connected()
+
+    hung_device = connector.devices[0]
+    other_devices = connector.devices[1:]
+    hung_device.response_latency = options.hang_seconds
+
+    # e.g. the commands of the connection setup
+    executed_before = {device.name: len(device.commands) for device in other_devices}
+
+    sent, started_at = send_commands(connector, options)
+
+    total_sent = sum(len(sent[device.name]) for device in other_devices)
+    connector.wait_until(lambda: sum(len(device.commands) - executed_before[device.name]
+                                     for device in other_devices) >= total_sent, 10)
+    elapsed = time() - started_at
+
+    latencies = []
+    for device in other_devices:
+        latencies.extend(get_latencies([device], sent, executed_before[device.name]))
+
+    return {
+        "sent": total_sent,
+        "executed": len(latencies),
+        "commands_per_second": round(len(latencies) / elapsed, 1),
+        "latency": percentiles(latencies),
+        "hung_device": {"sent": len(sent[hung_device.name]),
+                        "queued": connector.event_handler.known_devices[hung_device.name].processing_queue.qsize()},
+        "process": connector.get_process_stats(),
+        "metrics": loads(connector.get_metrics()),
+    }
+
+
+def run_dispatch(options):
+    """
+    Cost of dispatching a command to its device (EventHandler._worker_mqtt_message_received) for a growing number of
+    devices, it should not grow with them. The devices are served by a worker pool (at least 4 threads), so that the
+    number of threads does not grow either.
+    """
+    results = {}
+    for device_count in options.dispatch_devices:
+        connector = BenchmarkConnector(device_count, options.runtime, options.worker_pool_size or 4)
+        connector.add_devices()
+        connector.wait_connected(120)
+
+        # absolute volume commands are merged into the one queued before, so the device queues do not fill up
+        topics = ["chromecast/%s/command/volume_level" % device.name for device in connector.devices]
+        durations = []
+        for index in range(options.dispatch_messages):
+            topic = topics[index % len(topics)]
+            started_at = perf_counter()
+            connector.event_handler._worker_mqtt_message_received(topic, b"50", None)
+            durations.append(perf_counter() - started_at)
+
+        results[str(device_count)] = {
+            "dispatch": percentiles(durations),
+            "mean_us": round(sum(durations) / len(durations) * 1000000, 3),
+        }
+
+    return {
+        "devices": results,
+        "process": connector.get_process_stats(),
+    }
+
+
+def run_status_flood(options):
+    """
+    Every device reports a burst of media statuses: time until the broker has the newest position of all devices.
+    """
+    connector = BenchmarkConnector(options.devices, options.runtime, options.worker_pool_size,
+                                   ConnectionSettings(status_coalesce_window=options.coalesce_window))
+    connector.add_devices()
+    connector.wait_connected()
+    publishes_before = connector.broker.publish_count
+
+    final_position = float(options.flood_size)
+    started_at = time()
+    for position in range(1, options.flood_size + 1):
+        for device in connector.devices:
+            device.emit_media_status(float(position))
+
+    def is_settled():
+        return all(connector.broker.get_retained("chromecast/%s/player_position" % device.name) ==
+                   str(round(final_position)) for device in connector.devices)
+
+    settle_seconds = connector.wait_until(is_settled, 30)
+
+    return {
+        "statuses_emitted": options.flood_size * options.devices,
+        "emit_seconds": round(time() - started_at, 3),
+        "settle_seconds": round(settle_seconds, 3) if settle_seconds is not None else None,
+        "publishes": connector.broker.publish_count - publishes_before,
+        "process": connector.get_process_stats(),
+        "metrics": loads(connector.get_metrics()),
+    }
+
+
+def run_broker_outage(options):
+    """
+    Statuses keep coming in while the broker is down: size of the offline queue and time until the broker is up to
+    date again after the outage.
+    """
+    connector = BenchmarkConnector(options.devices, options.runtime, options.worker_pool_size)
+    connector.add_devices()
+    connector.wait_connected()
+
+    connector.broker.stop()
+    outage_started_at = time()
+    position = 0
+    max_queued = 0
+    while time() - outage_started_at < options.outage:
+        position += 1
+        for device in connector.devices:
+            device.emit_media_status(float(position))
+
+        max_queued = max(max_queued, len(connector.mqtt.queue))
+        sleep(1 / options.rate)
+
+    # give the device workers time to handle the last statuses before the broker comes back
+    sleep(0.2)
+    max_queued = max(max_queued, len(connector.mqtt.queue))
+
+    restarted_at = time()
+    connector.broker.start()
+
+    def is_recovered():
+        return len(connector.mqtt.queue) == 0 and all(
+            connector.broker.get_retained("chromecast/%s/player_position" % device.name) == str(position)
+            for device in connector.devices)
+
+    recover_seconds = connector.wait_until(is_recovered, 30)
+
+    return {
+        "outage_seconds": round(restarted_at - outage_started_at, 3),
+        "statuses_emitted": position * options.devices,
+        "max_offline_queue": max_queued,
+        "offline_queue_dropped": connector.mqtt.queue_dropped_count,
+        "recover_seconds": round(recover_seconds, 3) if recover_seconds is not None else None,
+        "process": connector.get_process_stats(),
+        "metrics": loads(connector.get_metrics()),
+    }
+
+
+def run_flapping(options):
+    """
+    Devices repeatedly go offline and come back while commands keep coming in: reconnect attempts, executed and
+    rejected commands.
+    """
+    settings = ConnectionSettings(command_buffer_ttl=options.command_buffer_ttl)
+    connector = BenchmarkConnector(options.devices, options.runtime, options.worker_pool_size, settings)
+    connector.add_devices()
+    connector.wait_connected()
+
+    sent = 0
+    reconnect_times = []
+    started_at = time()
+    while time() - started_at < options.duration:
+        for device in connector.devices:
+            device.go_offline()
+
+        for device in connector.devices:
+            connector.publish_command(device, "player_state", "PAUSE" if sent % 2 else "RESUME")
+            sent += 1
+
+        sleep(options.flap_period / 2)
+
+        came_back_at = time()
+        for device in connector.devices:
+            device.go_online()
+
+        for device in connector.devices:
+            connector.publish_command(device, "player_state", "PAUSE" if sent % 2 else "RESUME")
+            sent += 1
+
+        reconnected = connector.wait_until(
+            lambda: all(c.is_connected() for c in connector.event_handler.known_devices.values()), 10)
+        if reconnected is not None:
+            reconnect_times.append(time() - came_back_at)
+
+        sleep(max(0, options.flap_period / 2 - (time() - came_back_at)))
+
+    sleep(0.5)
+
+    return {
+        "sent": sent,
+        "executed": sum(len(device.commands) for device in connector.devices),
+        "reconnect": percentiles(reconnect_times),
+        "reconnect_attempts": connector.reconnect_scheduler.attempt_count,
+        "process": connector.get_process_stats(),
+        "metrics": loads(connector.get_metrics()),
+    }
+
+
+def run_failover(options):
+    """
+    Two instances share the devices (see [cluster] in config.ini), then one of them dies: how the devices are split and
+    time until the remaining instance has taken over all devices.
+    """
+    first = BenchmarkConnector(options.devices, options.runtime, options.worker_pool_size, instance_id="first",
+                               lease_duration=options.lease_duration)
+    second = BenchmarkConnector(0, options.runtime, options.worker_pool_size, network=first.network,
+                                broker=first.broker, instance_id="second", lease_duration=options.lease_duration)
+    second.devices = first.devices
+
+    def get_connected(connector):
+        return set(name for name, c in list(connector.event_handler.known_devices.items()) if c.is_connected())
+
+    first.add_devices()
+    second.add_devices()
+    split_seconds = first.wait_until(
+        lambda: len(get_connected(first) | get_connected(second)) == len(first.devices), 30)
+    split = {"first": len(get_connected(first)), "second": len(get_connected(second)),
+             "both": len(get_connected(first) & get_connected(second))}
+
+    # the broker publishes the last will of the first instance, its devices are not touched anymore
+    died_at = time()
+    first.cluster.stopped.set()
+    first.broker.kill(first.mqtt.mqtt)
+
+    takeover_seconds = second.wait_until(lambda: len(get_connected(second)) == len(second.devices), 30)
+    if takeover_seconds is not None:
+        takeover_seconds = time() - died_at
+
+    return {
+        "split_seconds": round(split_seconds, 3) if split_seconds is not None else None,
+        "split": split,
+        "takeover_seconds": round(takeover_seconds, 3) if takeover_seconds is not None else None,
+        "process": second.get_process_stats(),
+        "metrics": loads(second.get_metrics()),
+    }
+
+
+def run_group(options):
+    """
+    Commands to a group of all devices: latency until each member executes a command, spread between the first and
+    the last member (see group_start_delay) and the results reported per group command.
+    """
+    group_settings = GroupSettings({"all": ["device%03d" % index for index in range(options.devices)]},
+                                   options.group_start_delay)
+    connector = BenchmarkConnector(options.devices, options.runtime, options.worker_pool_size,
+                                   group_settings=group_settings)
+    connector.add_devices()
+    connector.wait_connected()
+
+    results = []
+    connector.publisher.on_message = lambda mqtt_client, userdata, message: results.append(loads(message.payload))
+    connector.publisher.subscribe(TOPIC_GROUP_RESULT % "all")
+
+    sent = []
+    interval = 1 / options.rate
+    started_at = time()
+    next_round = started_at
+
+    # pause and resume alternate, so that no commands are merged
+    while time() - started_at < options.duration:
+        sent.append(time())
+        connector.publisher.publish(TOPIC_GROUP_COMMAND % ("all", "player_state"),
+                                    "PAUSE" if len(sent) % 2 else "RESUME")
+
+        next_round += interval
+        sleep(max(0, next_round - time()))
+
+    connector.wait_until(lambda: len(results) >= len(sent), 30)
+
+    latencies = []
+    spreads = []
+    for index, sent_at in enumerate(sent):
+        executed_times = [device.commands[index][1] for device in connector.devices if len(device.commands) > index]
+        latencies.extend(executed_at - sent_at for executed_at in executed_times)
+
+        if len(executed_times) > 0:
+            spreads.append(max(executed_times) - min(executed_times))
+
+    result_counts = {}
+    for result in results:
+        result_counts[result["result"]] = result_counts.get(result["result"], 0) + 1
+
+    return {
+        "sent": len(sent),
+        "executed": sum(len(device.commands) for device in connector.devices),
+        "latency": percentiles(latencies),
+        "spread": percentiles(spreads),
+        "results": result_counts,
+        "process": connector.get_process_stats(),
+        "metrics": loads(connector.get_metrics()),
+    }
+
+
+SCENARIOS = {
+    "commands": run_commands,
+    "dispatch": run_dispatch,
+    "hung_device": run_hung_device,
+    "status_flood": run_status_flood,
+    "broker_outage": run_broker_outage,
+    "flapping": run_flapping,
+    "failover": run_failover,
+    "group": run_group,
+}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the chromecast mqtt connector")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run, can be given multiple times (default: all)")
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--worker-pool-size", type=int, default=0)
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=5, help="commands or statuses per second and device")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of each scenario")
+    parser.add_argument("--hang-seconds", type=float, default=3600,
+                        help="seconds every call to the hung device blocks (hung_device)")
+    parser.add_argument("--dispatch-devices", type=lambda value: [int(count) for count in value.split(",")],
+                        default=[10, 100, 1000], help="comma separated numbers of devices (dispatch)")
+    parser.add_argument("--dispatch-messages", type=int, default=20000,
+                        help="commands dispatched per number of devices (dispatch)")
+    parser.add_argument("--flood-size", type=int, default=200, help="statuses per device (status_flood)")
+    parser.add_argument("--coalesce-window", type=float, default=0, help="status_coalesce_window (status_flood)")
+    parser.add_argument("--outage", type=float, default=3, help="seconds the broker is down (broker_outage)")
+    parser.add_argument("--flap-period", type=float, default=1, help="seconds per offline/online cycle (flapping)")
+    parser.add_argument("--command-buffer-ttl", type=float, default=5, help="command_buffer_ttl (flapping)")
+    parser.add_argument("--group-start-delay", type=float, default=0, help="group_start_delay (group)")
+    parser.add_argument("--lease-duration", type=float, default=3, help="lease_duration (failover)")
+    parser.add_argument("--output", help="file to write the results to (default: stdout)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    return parser.parse_args(arguments)
+
+
+def main(arguments):
+    options = parse_arguments(arguments)
+    logging.basicConfig(level=logging.CRITICAL)
+
+    if options.child:
+        # run a single scenario in this process, the parent collects the output
+        print(json.dumps(SCENARIOS[options.child](options)))
+        return
+
+    results = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "started_at": time(),
+        "options": {key: value for key, value in vars(options).items() if key not in ("child", "output")},
+        "scenarios": {},
+    }
+
+    for scenario in options.scenario or sorted(SCENARIOS):
+        output = subprocess.check_output([sys.executable, "-m", "benchmark.run", "--child", scenario] + arguments)
+        results["scenarios"][scenario] = loads(output.decode().strip().splitlines()[-1])
+
+    document = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(document + "\n")
+    else:
+        print(document)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 import logging
 import os
+import socket
+from handler.adapter import ConnectionSettings
 from handler.event import EventHandler
+from handler.group import GroupSettings
+from handler.properties import PublishSettings, TOPIC_PREFIX, TOPIC_CONNECTOR_METRICS, HIGH_FREQUENCY_TOPICS
+from helper import metrics
+from helper.aio import AsyncRuntime
+from helper.cluster import ClusterMembership
 from helper.config import Config
 from helper.discovery import ChromecastDiscovery
-from time import sleep
+from paho.mqtt.client import MQTTv5, MQTTv311
+from time import sleep, time
 from helper.mqtt import MqttConnection
+from helper.pool import WorkerPool
+from helper.recorder import EventRecorder
+from helper.reconnect import ReconnectScheduler
+from helper.mdns import ZeroconfService
+from helper.metrics import MetricsServer, MetricsPublisher
+from helper.services import ChromecastServiceCache
+from helper.timeline import StartupTimeline
 
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger("pychromecast").setLevel(logging.DEBUG)
@@ -13,11 +28,63 @@ logging.getLogger("pychromecast.socket_client").setLevel(logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+startup_timeline = StartupTimeline(time())
+
 logger.debug("~ reading config")
 config_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'config.ini')
 config = Config(config_path)
 
-event_handler = EventHandler()
+runtime = None
+worker_pool = None
+worker_pool_size = config.get_worker_pool_size()
+if config.get_runtime() == "asyncio":
+    logger.debug("~ using asyncio runtime")
+    runtime = AsyncRuntime(worker_pool_size if worker_pool_size > 0 else 8)
+    runtime.start()
+
+    # the runtime schedules the device queues just like the worker pool
+    worker_pool = runtime
+elif worker_pool_size > 0:
+    logger.debug("~ using worker pool with %d threads for all devices" % worker_pool_size)
+    worker_pool = WorkerPool(worker_pool_size)
+
+# addresses resolved by the discovery, used by the device connections to connect directly
+device_cache_file = config.get_device_cache_file()
+if device_cache_file:
+    device_cache_file = os.path.join(os.path.abspath(os.path.dirname(__file__)), device_cache_file)
+else:
+    device_cache_file = None
+
+service_cache = ChromecastServiceCache(device_cache_file)
+
+# single zeroconf instance used by the discovery and all device connections
+zeroconf_service = ZeroconfService()
+
+connection_settings = ConnectionSettings(
+    publish=PublishSettings(config.get_mqtt_publish_topics(), config.get_mqtt_publish_state(),
+                            config.get_mqtt_position_min_interval(), config.get_mqtt_position_min_change(),
+                            config.get_mqtt_position_interpolation()),
+    status_coalesce_window=config.get_status_coalesce_window(),
+    queue_size=config.get_queue_size(),
+    status_overflow_policy=config.get_status_overflow_policy(),
+    command_overflow_policy=config.get_command_overflow_policy(),
+    command_buffer_ttl=config.get_command_buffer_ttl(),
+)
+
+recorder = None
+recording_file = config.get_recording_file()
+if recording_file:
+    recorder = EventRecorder(os.path.join(os.path.abspath(os.path.dirname(__file__)), recording_file))
+
+reconnect_scheduler = ReconnectScheduler(config.get_reconnect_base_delay(), config.get_reconnect_max_delay(),
+                                         config.get_reconnect_jitter(), config.get_max_parallel_connects())
+reconnect_scheduler.start_scheduler()
+
+group_settings = GroupSettings(config.get_groups(), config.get_group_start_delay(), config.get_group_result_timeout())
+
+event_handler = EventHandler(worker_pool, service_cache, zeroconf_service, connection_settings,
+                             reconnect_scheduler, startup_timeline, config.get_mqtt_publish_startup_timeline(),
+                             config.get_mqtt_clear_removed_devices(), runtime, recorder, group_settings)
 
 logger.debug("~ connecting to mqtt")
 username = None
@@ -27,27 +94,102 @@ if config.get_mqtt_broker_use_auth():
     username = config.get_mqtt_broker_username()
     password = config.get_mqtt_broker_password()
 
+mqtt_protocol = MQTTv5 if config.get_mqtt_protocol_version() == 5 else MQTTv311
+alias_topic_filters = HIGH_FREQUENCY_TOPICS if config.get_mqtt_topic_aliases() else ()
 mqtt = MqttConnection(config.get_mqtt_broker_address(), config.get_mqtt_broker_port(), username, password,
-                      event_handler)
+                      event_handler, config.get_mqtt_offline_queue_size(), config.get_mqtt_replay_interval(),
+                      runtime, mqtt_protocol, config.get_mqtt_trace_commands(),
+                      config.get_mqtt_shared_subscription_group(), config.get_mqtt_session_expiry(),
+                      config.get_mqtt_command_expiry(), alias_topic_filters)
+
+cluster = None
+if config.get_cluster_enabled():
+    instance_id = config.get_cluster_instance_id() or "%s-%d" % (socket.gethostname(), os.getpid())
+    logger.debug("~ sharing devices with other instances as %s" % instance_id)
+
+    # sets the last will, so it has to be created before connecting
+    cluster = ClusterMembership(mqtt, instance_id, event_handler, config.get_cluster_lease_duration(),
+                                config.get_cluster_virtual_nodes())
+    event_handler.set_cluster(cluster)
+
 if not mqtt.start_connection():
     exit(1)
 
+event_handler.set_mqtt_connection(mqtt)
+
+if cluster is not None:
+    logger.debug("~ joining cluster")
+    cluster.start(config.get_cluster_join_duration())
+
+metrics.gauge("chromecast_queue_depth", "Items waiting in the event and mqtt offline queues", ["queue"],
+              lambda: {("events",): event_handler.processing_queue.qsize(), ("mqtt_offline",): len(mqtt.queue)})
+metrics.gauge("chromecast_device_queue_depth", "Items waiting in the processing queue of each device", ["device"],
+              lambda: {(name,): depth for name, depth in event_handler.get_device_queue_depths().items()})
+
+metrics_server = None
+if config.get_metrics_http_port() > 0:
+    metrics_server = MetricsServer(config.get_metrics_http_address(), config.get_metrics_http_port())
+    metrics_server.start()
+
+metrics_publisher = None
+if config.get_metrics_mqtt_interval() > 0:
+    metrics_publisher = MetricsPublisher(mqtt, TOPIC_CONNECTOR_METRICS, config.get_metrics_mqtt_interval())
+    metrics_publisher.start()
+
+cached_services = service_cache.load()
+
+if config.get_mqtt_prime_write_filter() or config.get_mqtt_clear_orphaned_devices():
+    logger.debug("~ reading retained values")
+    retained_values = mqtt.collect_retained(TOPIC_PREFIX + "#", config.get_mqtt_prime_duration())
+
+    # without a device cache every device would be considered orphaned
+    if config.get_mqtt_clear_orphaned_devices() and len(cached_services) > 0:
+        logger.debug("~ clearing retained values of orphaned devices")
+        retained_values = event_handler.clear_orphaned_devices(
+            retained_values, set(service.device_name for service in cached_services))
+
+    if config.get_mqtt_prime_write_filter():
+        event_handler.prime_write_filters(retained_values)
+
+# connect the devices known from the last run right away, the discovery confirms them in the meantime
+for service in cached_services:
+    logger.debug("~ adding cached device %s" % service.device_name)
+    event_handler.on_chromecast_appeared(service.device_name, service.model_name, service.ip_address, service.port)
+
 logger.debug("~ starting chromecast discovery")
-discovery = ChromecastDiscovery(event_handler)
+discovery = ChromecastDiscovery(event_handler, zeroconf_service, service_cache)
 discovery.start_discovery()
 
 logger.debug("~ initialization finished")
 
-is_running = True
-while is_running:
-    try:
-        sleep(1)
-    except KeyboardInterrupt:
-        is_running = False
+try:
+    if runtime is not None:
+        runtime.join()
+    else:
+        while True:
+            sleep(1)
+except KeyboardInterrupt:
+    pass
 
 logger.debug("~ stop signal received, shutting down")
 
 discovery.stop_discovery()
+
+if cluster is not None:
+    cluster.stop()
+
+if metrics_publisher is not None:
+    metrics_publisher.stop()
+if metrics_server is not None:
+    metrics_server.stop()
+
 mqtt.stop_connection()
+zeroconf_service.close()
+
+if runtime is not None:
+    runtime.stop()
+
+if recorder is not None:
+    recorder.close()
 
 logger.debug("~ shutdown completed")
@@ -1,21 +1,34 @@
 import logging
-from collections import namedtuple
-from queue import Queue
-from threading import Thread
+from collections import namedtuple, deque
+from queue import Queue, Empty
+from threading import Thread, Lock, local
+from time import time
 
-from pychromecast import IDLE_APP_ID, get_listed_chromecasts, PyChromecastError
+from pychromecast import IDLE_APP_ID, get_listed_chromecasts, get_chromecast_from_host, PyChromecastError
 from pychromecast.controllers.media import MEDIA_PLAYER_STATE_IDLE
 from pychromecast.socket_client import CONNECTION_STATUS_CONNECTED, CONNECTION_STATUS_FAILED, \
     CONNECTION_STATUS_DISCONNECTED
 
-from handler.properties import MqttPropertyHandler, MqttChangesCallback
+from handler.properties import MqttPropertyHandler, MqttChangesCallback, PublishSettings
+from helper import metrics
+from helper.pool import WorkerPoolLane
+from helper.reconnect import ReconnectTarget
+from helper.recorder import EVENT_CAST_STATUS, EVENT_MEDIA_STATUS, EVENT_CONNECTION_STATUS
+from helper.trace import TraceCollector, HOP_QUEUED, HOP_STARTED, HOP_POSTPONED, HOP_SENT, HOP_STATUS, RESULT_OK, \
+    RESULT_INVALID, RESULT_REJECTED, RESULT_FAILED, RESULT_EXPIRED
 
 CONNECTION_STATUS_WAITING_FOR_DEVICE = "WAITING"
 CONNECTION_STATUS_ERROR = "ERROR"
 CONNECTION_STATUS_NOT_FOUND = "NOT_FOUND"
 
+# seconds to wait for a device at its cached address before falling back to a lookup
+DIRECT_CONNECT_TIMEOUT = 5
+
+# seconds to wait for the first status of a device after a traced command has been sent
+TRACE_STATUS_TIMEOUT = 5
+
 CreateConnectionCommand = namedtuple("CreateConnectionCommand", ["device_name"])
-DisconnectCommand = namedtuple("DisconnectCommand", [])
+DisconnectCommand = namedtuple("DisconnectCommand", ["clear_retained", "publish_status"], defaults=[False, True])
 InfoConnectionCommand = namedtuple("InfoConnectionCommand", ["device_name", "model_name", "ip_address", "port"])
 VolumeMuteCommand = namedtuple("VolumeMuteCommand", ["muted"])
 VolumeLevelRelativeCommand = namedtuple("VolumeLevelRelativeCommand", ["value"])
@@ -30,9 +43,308 @@ PlayerRewindCommand = namedtuple("PlayerRewindCommand", [])
 PlayerPreviousCommand = namedtuple("PlayerPreviousCommand", [])
 PlayerNextCommand = namedtuple("PlayerNextCommand", [])
 
-CastReceivedStatus = namedtuple("CastReceivedStatus", ["status"])
+# what to do with a new item if the lane of a device queue is full
+OVERFLOW_POLICY_DROP_OLDEST = "drop_oldest"  # drop the oldest item of the lane
+OVERFLOW_POLICY_REJECT = "reject"  # reject the new item
+OVERFLOW_POLICY_COALESCE = "coalesce"  # replace (or merge into) the newest queued item of the same kind, in place
+OVERFLOW_POLICIES = (OVERFLOW_POLICY_DROP_OLDEST, OVERFLOW_POLICY_REJECT, OVERFLOW_POLICY_COALESCE)
+
+# settings shared by all device connections, status_coalesce_window = seconds to collect cast and media statuses
+# before the newest one is queued (0 = queue every status right away), queue_size = maximum size of the command and
+# status lane of each device, command_buffer_ttl = seconds to keep commands while the device is reconnecting (0 = reject them immediately)
+ConnectionSettings = namedtuple("ConnectionSettings", ["publish", "status_coalesce_window", "queue_size",
+                                                       "status_overflow_policy", "command_overflow_policy",
+                                                       "command_buffer_ttl"],
+                                defaults=[PublishSettings(), 0, 100, OVERFLOW_POLICY_DROP_OLDEST,
+                                          OVERFLOW_POLICY_REJECT, 0])
+
+ITEMS_PROCESSED = metrics.counter("chromecast_device_items_total", "Items processed by the device queues", ["type"])
+COMMAND_LATENCY = metrics.histogram("chromecast_command_latency_seconds",
+                                    "Seconds from queueing a command until it has been sent to the device", ["type"])
+COMMANDS_MERGED = metrics.counter("chromecast_commands_merged_total",
+                                  "Commands merged into the command queued right before them", ["device"])
+QUEUE_DROPPED = metrics.counter("chromecast_device_queue_dropped_total",
+                                "Items dropped or replaced by the overflow policy of a full device queue",
+                                ["device", "lane"])
+QUEUE_REJECTED = metrics.counter("chromecast_device_queue_rejected_total",
+                                 "Items rejected because the lane of their device queue was full", ["device", "lane"])
+STATUSES_COALESCED = metrics.counter("chromecast_statuses_coalesced_total",
+                                     "Cast and media statuses skipped because a newer one has been received",
+                                     ["device"])
+CONNECT_DURATION = metrics.histogram("chromecast_connect_duration_seconds",
+                                     "Seconds needed for connection attempts to devices", ["result"])
+
+CastReceivedStatus = namedtuple("CastReceivedStatus", ["status", "received_at"])
 CastConnectionStatus = namedtuple("CastConnectionStatus", ["status"])
-CastMediaStatus = namedtuple("CastMediaStatus", ["status"])
+CastMediaStatus = namedtuple("CastMediaStatus", ["status", "received_at"])
+
+
+def is_connection_command(item):
+    """
+    Check if an item handles or changes the connection of the device itself, including connection statuses reported
+    by the device.
+    """
+
+    return isinstance(item, CreateConnectionCommand) or isinstance(item, DisconnectCommand) \
+        or isinstance(item, InfoConnectionCommand) or isinstance(item, CastConnectionStatus)
+
+
+def is_status(item):
+    """
+    Check if an item is a status received from the device (in contrast to a command which has been requested).
+    """
+
+    return isinstance(item, CastReceivedStatus) or isinstance(item, CastConnectionStatus) \
+        or isinstance(item, CastMediaStatus)
+
+
+def is_coalescable_status(item):
+    """
+    Check if an item is a status which is outdated by any newer status of the same kind.
+    """
+
+    return isinstance(item, CastReceivedStatus) or isinstance(item, CastMediaStatus)
+
+
+def merge_commands(queued_command, command):
+    """
+    Merge a command into the command queued right before it, e.g. bursts sent by rotary encoders or sliders. Returns
+    the merged command or None if the commands cannot be merged.
+    """
+
+    if isinstance(queued_command, VolumeLevelRelativeCommand) and isinstance(command, VolumeLevelRelativeCommand):
+        return VolumeLevelRelativeCommand(queued_command.value + command.value)
+    elif isinstance(queued_command, VolumeLevelAbsoluteCommand) and isinstance(command, VolumeLevelAbsoluteCommand):
+        return command
+    elif isinstance(queued_command, PlayerPositionCommand) and isinstance(command, PlayerPositionCommand):
+        return command
+
+    return None
+
+
+class DeviceQueue(Queue):
+    """
+    Processing queue of a device with two lanes: commands (including connection handling and connection statuses, which
+    have to stay in order with the commands) are always taken before cast and media statuses received from the device,
+    which are only processed to republish the device state. Items of the same lane are processed in order. Consecutive
+    volume and position commands are merged before they are sent.
+
+    A command taken too early (e.g. before the start time of a group command) is put back with hold(), no further
+    command is taken until release() has been called.
+
+    Items are added using offer(), which never blocks: if a lane is full, the overflow policy of the lane decides what
+    happens. Connection handling commands are always accepted. The device name labels the metrics of the queue.
+    """
+
+    def __init__(self, lane_size=100, status_overflow_policy=OVERFLOW_POLICY_DROP_OLDEST,
+                 command_overflow_policy=OVERFLOW_POLICY_REJECT, device_name=""):
+        for policy in (status_overflow_policy, command_overflow_policy):
+            if policy not in OVERFLOW_POLICIES:
+                raise ValueError("unknown overflow policy %s" % policy)
+
+        # lanes are bounded by offer(), put() must not block the caller for all lanes therefore
+        Queue.__init__(self, 0)
+        self.lane_size = lane_size
+        self.status_overflow_policy = status_overflow_policy
+        self.command_overflow_policy = command_overflow_policy
+        self.device_name = device_name
+
+        # time the command taken last has been added and its traces (both None for statuses)
+        self.last_enqueued_at = None
+        self.last_traces = None
+        self.dropped_traces = []
+
+    def _init(self, maxsize):
+        self.is_held = False
+        self.queue = deque()
+        self.queue_times = deque()
+        self.queue_traces = deque()
+        self.status_queue = deque()
+        # number of queued statuses per type
+        self.status_counts = {}
+
+    def _qsize(self):
+        # number of items which can be taken right now
+        return (0 if self.is_held else len(self.queue)) + len(self.status_queue)
+
+    def _put(self, item):
+        # called by put() while holding the mutex
+        if is_coalescable_status(item):
+            self.status_queue.append(item)
+            self.status_counts[type(item)] = self.status_counts.get(type(item), 0) + 1
+            return
+
+        if len(self.queue) > 0:
+            merged_command = merge_commands(self.queue[-1], item)
+
+            if merged_command is not None:
+                self.queue[-1] = merged_command
+                COMMANDS_MERGED.inc(self.device_name)
+                # put() counts every item as unfinished task, but no new item has been added
+                self.unfinished_tasks -= 1
+                return
+
+        self.queue.append(item)
+        self.queue_times.append(time())
+        self.queue_traces.append(None)
+
+    def _get(self):
+        if len(self.queue) > 0 and not self.is_held:
+            self.last_enqueued_at = self.queue_times.popleft()
+            self.last_traces = self.queue_traces.popleft()
+            return self.queue.popleft()
+
+        self.last_enqueued_at = None
+        self.last_traces = None
+        return self._remove_status(0)
+
+    def _remove_command(self, index):
+        traces = self.queue_traces[index]
+        if traces is not None:
+            self.dropped_traces.extend(traces)
+
+        del self.queue[index]
+        del self.queue_times[index]
+        del self.queue_traces[index]
+
+    def _remove_status(self, index):
+        item = self.status_queue[index]
+        del self.status_queue[index]
+        self.status_counts[type(item)] -= 1
+        return item
+
+    def hold(self, item, enqueued_at, traces):
+        """
+        Put a command taken from the queue back in front of the command lane, commands are not taken again until
+        release() has been called. Statuses are still taken in the meantime.
+        """
+        with self.mutex:
+            self.queue.appendleft(item)
+            self.queue_times.appendleft(enqueued_at)
+            self.queue_traces.appendleft(traces)
+            self.unfinished_tasks += 1
+            self.is_held = True
+
+    def release(self):
+        with self.mutex:
+            self.is_held = False
+            self.not_empty.notify()
+
+    def clear_statuses(self):
+        """
+        Drop all queued cast and media statuses, e.g. because the device has been disconnected.
+        """
+        with self.mutex:
+            self.unfinished_tasks -= len(self.status_queue)
+            self.status_queue.clear()
+            self.status_counts.clear()
+
+    def has_newer_status(self, item):
+        """
+        Check if a status of the same kind has been queued after a status taken from the queue.
+        """
+        with self.mutex:
+            return self.status_counts.get(type(item), 0) > 0
+
+    def take_dropped_traces(self):
+        """
+        Returns the traces of the commands dropped since the last call, they have to be finished by the caller.
+        """
+        with self.mutex:
+            traces = self.dropped_traces
+            self.dropped_traces = []
+            return traces
+
+    def offer(self, item, trace=None):
+        """
+        Add an item without blocking. Returns False if the item has been rejected because its lane is full. The trace
+        of a command is kept with it, a merged command keeps the traces of all commands merged into it.
+        """
+
+        with self.mutex:
+            if is_coalescable_status(item):
+                lane = self.status_queue
+                policy = self.status_overflow_policy
+            else:
+                lane = self.queue
+                policy = self.command_overflow_policy
+
+            is_mergeable = lane is self.queue and len(lane) > 0 and merge_commands(lane[-1], item) is not None
+
+            if len(lane) >= self.lane_size and not is_mergeable and not is_connection_command(item):
+                if policy == OVERFLOW_POLICY_COALESCE and self._coalesce(lane, item, trace):
+                    return True
+
+                if not self._make_room(lane, item, policy):
+                    QUEUE_REJECTED.inc(self.device_name, self._get_lane_name(lane))
+                    return False
+
+            self._put(item)
+
+            if trace is not None and lane is self.queue:
+                self.queue_traces[-1] = (self.queue_traces[-1] or []) + [trace]
+
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+    def _coalesce(self, lane, item, trace):
+        # called by offer() while holding the mutex: replace the newest item of the same kind in place, e.g. an older
+        # media status or volume change, so that it stays in order with the items queued after it
+        for index in range(len(lane) - 1, -1, -1):
+            if type(lane[index]) is not type(item):
+                continue
+
+            if lane is self.status_queue:
+                lane[index] = item
+                QUEUE_DROPPED.inc(self.device_name, self._get_lane_name(lane))
+                return True
+
+            merged_command = merge_commands(lane[index], item)
+            if merged_command is not None:
+                # e.g. relative volume changes are added up, the merged command keeps the traces of both
+                lane[index] = merged_command
+                COMMANDS_MERGED.inc(self.device_name)
+            else:
+                lane[index] = item
+                QUEUE_DROPPED.inc(self.device_name, self._get_lane_name(lane))
+
+                if self.queue_traces[index] is not None:
+                    self.dropped_traces.extend(self.queue_traces[index])
+                self.queue_traces[index] = None
+
+            if trace is not None:
+                self.queue_traces[index] = (self.queue_traces[index] or []) + [trace]
+
+            return True
+
+        return False
+
+    def _make_room(self, lane, item, policy):
+        # called by offer() while holding the mutex
+        if policy == OVERFLOW_POLICY_REJECT:
+            return False
+
+        # nothing to coalesce with, statuses are outdated anyway while commands have to be rejected
+        if policy == OVERFLOW_POLICY_COALESCE and lane is self.queue:
+            return False
+
+        if lane is self.queue:
+            # connection handling and connection statuses are never dropped, the oldest other command is
+            index = next((index for index, queued in enumerate(lane) if not is_connection_command(queued)), None)
+            if index is None:
+                return False
+
+            self._remove_command(index)
+        else:
+            self._remove_status(0)
+
+        QUEUE_DROPPED.inc(self.device_name, self._get_lane_name(lane))
+        self.unfinished_tasks -= 1
+        return True
+
+    def _get_lane_name(self, lane):
+        return "statuses" if lane is self.status_queue else "commands"
 
 
 class ChromecastConnectionCallback:
@@ -43,6 +355,9 @@ class ChromecastConnectionCallback:
     def on_connection_dead(self, chromecast_connection, device_name):
         pass
 
+    def on_connection_established(self, chromecast_connection, device_name):
+        pass
+
 
 class ConnectionUnavailableException(Exception):
     """
@@ -51,38 +366,143 @@ class ConnectionUnavailableException(Exception):
     pass
 
 
-class ChromecastConnection(MqttChangesCallback):
+class ChromecastConnection(MqttChangesCallback, WorkerPoolLane, ReconnectTarget):
 
-    def __init__(self, device_name, mqtt_connection, connection_callback):
+    def __init__(self, device_name, mqtt_connection, connection_callback, worker_pool=None, service_cache=None,
+                 zeroconf_service=None, settings=ConnectionSettings(), reconnect_scheduler=None, retained_values=None,
+                 recorder=None, timeout_scheduler=None):
         """
-        Called if a new Chromecast device has been found.
+        Called if a new Chromecast device has been found. If no worker pool is given, a dedicated worker thread is
+        started for this device. If a service cache is given, the device is connected to its cached address directly.
+        Lookups use the shared zeroconf service if given, otherwise pychromecast creates its own zeroconf instance.
+        If a reconnect scheduler is given, commands for a disconnected device do not trigger a connection attempt
+        themselves, the scheduler retries with a backoff instead. Retained values (topic -> payload) of the device
+        are used to skip publishing values which the broker already has. If a recorder is given, the statuses
+        received from the device are recorded. Traced commands which are not followed by a status of the device are
+        finished by the timeout scheduler, if given.
         """
 
         self.logger = logging.getLogger("chromecast")
         self.device_name = device_name
         self.connection_callback = connection_callback
+        self.worker_pool = worker_pool
+        self.service_cache = service_cache
+        self.zeroconf_service = zeroconf_service
+        self.settings = settings
+        self.reconnect_scheduler = reconnect_scheduler
+        self.recorder = recorder
+        self.timeout_scheduler = timeout_scheduler
+        self.device = None
         self.connection_failure_count = 0
         self.device_connected = False
 
-        self.mqtt_properties = MqttPropertyHandler(mqtt_connection, device_name, self)
-        self.processing_queue = Queue(maxsize=100)
+        # commands received while the device is reconnecting, as (expiry time, command, enqueue time, traces)
+        self.buffered_commands = deque()
+
+        # trace of the mqtt message currently handled by the calling thread, see handle_message()
+        self.message_context = local()
+        self.status_traces = TraceCollector(timeout_scheduler, TRACE_STATUS_TIMEOUT)
+
+        # newest cast and media status (per type) received within the coalescing window, queued once it has passed
+        self.pending_statuses = {}
+        self.pending_statuses_lock = Lock()
 
-        self.processing_worker = Thread(target=self._worker)
-        self.processing_worker.daemon = True
-        self.processing_worker.start()
+        self.mqtt_properties = MqttPropertyHandler(mqtt_connection, device_name, self, settings.publish,
+                                                   retained_values)
+        self.processing_queue = DeviceQueue(settings.queue_size, settings.status_overflow_policy,
+                                            settings.command_overflow_policy, device_name)
+
+        if worker_pool is None:
+            self.processing_worker = Thread(target=self._worker)
+            self.processing_worker.daemon = True
+            self.processing_worker.start()
+        else:
+            self.processing_worker = None
+
+        self._enqueue(CreateConnectionCommand(device_name))
+
+    def _enqueue(self, item):
+        """
+        Hand an item to the processing queue of this device without blocking the caller. The caller is either the
+        event handler worker (shared by all devices) or the pychromecast socket thread, so a slow or unreachable
+        device must never stall them.
+        """
+        trace = None
+        if not is_status(item):
+            trace = getattr(self.message_context, "trace", None)
 
-        self.processing_queue.put(CreateConnectionCommand(device_name))
+        if trace is not None:
+            trace.mark(HOP_QUEUED)
+
+        is_accepted = self.processing_queue.offer(item, trace)
+
+        if self.processing_queue.dropped_traces:
+            self._finish_traces(self.processing_queue.take_dropped_traces(), RESULT_REJECTED, "dropped, queue full")
+
+        if not is_accepted:
+            self.logger.warning("processing queue of chromecast %s is full, rejected %s" % (self.device_name, item))
+
+            if not is_status(item):
+                self.mqtt_properties.write_command_error("queue full, rejected %s" % type(item).__name__)
+
+            if trace is not None:
+                trace.finish(RESULT_REJECTED, "queue full")
+
+            return False
+
+        if self.worker_pool is not None:
+            self.worker_pool.schedule(self)
+
+        return True
+
+    def _enqueue_status(self, item):
+        """
+        Queue a cast or media status. Within the coalescing window, only the newest status of each kind is queued once
+        the window has passed. Nothing waits for the window, the timeout scheduler queues the status.
+        """
+        if self.settings.status_coalesce_window <= 0 or self.timeout_scheduler is None:
+            self._enqueue(item)
+            return
+
+        with self.pending_statuses_lock:
+            is_scheduled = type(item) in self.pending_statuses
+            self.pending_statuses[type(item)] = item
+
+        if is_scheduled:
+            STATUSES_COALESCED.inc(self.device_name)
+        else:
+            self.timeout_scheduler.call_later(self.settings.status_coalesce_window, self._enqueue_pending_status,
+                                              type(item))
+
+    def _enqueue_pending_status(self, status_type):
+        with self.pending_statuses_lock:
+            item = self.pending_statuses.pop(status_type, None)
+
+        if item is not None:
+            self._enqueue(item)
+
+    def get_device_name(self):
+        return self.device_name
+
+    def request_connection(self):
+        """
+        Called by the reconnect scheduler if the next connection attempt is due.
+        """
+
+        self._enqueue(CreateConnectionCommand(self.device_name))
 
     def is_connected(self):
         # TODO thread sync
         return self.device_connected
 
-    def unregister_device(self):
+    def unregister_device(self, clear_retained=False, publish_status=True):
         """
-        Called if this Chromecast device has disappeared and resources should be cleaned up.
+        Called if this Chromecast device has disappeared and resources should be cleaned up. If clear_retained is set,
+        the retained topics of the device are removed from the broker. Without publish_status the connection status is
+        left as is, e.g. if the device is handed over to another connector instance.
         """
 
-        self.processing_queue.put(DisconnectCommand())
+        self._enqueue(DisconnectCommand(clear_retained, publish_status))
 
     def is_interesting_message(self, topic):
         """
@@ -91,19 +511,40 @@ class ChromecastConnection(MqttChangesCallback):
         """
         return self.mqtt_properties.is_topic_filter_matching(topic)
 
-    def handle_message(self, topic, payload):
+    def handle_message(self, topic, payload, trace=None):
+        """
+        Handle an incoming mqtt message. The trace (if given) is handed to the command queued for the message.
+        """
+
+        self.handle_request(lambda connection: connection.mqtt_properties.handle_message(topic, payload), trace)
+
+        if trace is not None and not trace.has_hop(HOP_QUEUED):
+            trace.finish(RESULT_INVALID, "no command for payload")
+
+    def handle_request(self, request, trace=None):
         """
-        Handle an incoming mqtt message.
+        Call request(self), e.g. one of the on_*_requested callbacks. The trace (if given) is handed to the command
+        queued by the request.
         """
 
-        self.mqtt_properties.handle_message(topic, payload)
+        self.message_context.trace = trace
+        try:
+            request(self)
+        finally:
+            self.message_context.trace = None
 
     def new_cast_status(self, status):
         """
         PyChromecast cast status callback.
         """
 
-        self.processing_queue.put(CastReceivedStatus(status))
+        if self.recorder is not None:
+            self.recorder.record_status(EVENT_CAST_STATUS, self.device_name, status)
+
+        if self.status_traces.has_traces():
+            self.status_traces.finish(HOP_STATUS, RESULT_OK)
+
+        self._enqueue_status(CastReceivedStatus(status, time()))
 
     def new_launch_error(self, launch_failure):
         """
@@ -113,146 +554,307 @@ class ChromecastConnection(MqttChangesCallback):
         self.logger.error("received error from chromecast %s: %s" % (self.device_name, launch_failure))
 
     def new_connection_info(self, device_name, model_name, ip_address, port):
-        self.processing_queue.put(InfoConnectionCommand(device_name, model_name, ip_address, port))
+        self._enqueue(InfoConnectionCommand(device_name, model_name, ip_address, port))
 
     def new_connection_status(self, status):
         """
         PyChromecast connection status callback.
         """
 
-        self.processing_queue.put(CastConnectionStatus(status))
+        if self.recorder is not None:
+            self.recorder.record_status(EVENT_CONNECTION_STATUS, self.device_name, status)
+
+        self._enqueue(CastConnectionStatus(status))
 
     def new_media_status(self, status):
         """
         PyChromecast media status callback.
         """
 
-        self.processing_queue.put(CastMediaStatus(status))
+        if self.recorder is not None:
+            self.recorder.record_status(EVENT_MEDIA_STATUS, self.device_name, status)
+
+        if self.status_traces.has_traces():
+            self.status_traces.finish(HOP_STATUS, RESULT_OK)
+
+        self._enqueue_status(CastMediaStatus(status, time()))
 
     def on_volume_mute_requested(self, is_muted):
-        self.processing_queue.put(VolumeMuteCommand(is_muted))
+        self._enqueue(VolumeMuteCommand(is_muted))
 
     def on_volume_level_relative_requested(self, relative_value):
-        self.processing_queue.put(VolumeLevelRelativeCommand(relative_value))
+        self._enqueue(VolumeLevelRelativeCommand(relative_value))
 
     def on_volume_level_absolute_requested(self, absolute_value):
-        self.processing_queue.put(VolumeLevelAbsoluteCommand(absolute_value))
+        self._enqueue(VolumeLevelAbsoluteCommand(absolute_value))
 
     def on_player_position_requested(self, position):
-        self.processing_queue.put(PlayerPositionCommand(position))
+        self._enqueue(PlayerPositionCommand(position))
 
     def on_player_play_stream_requested(self, url, content_type, title=None, thumb=None, current_time=None, autoplay=True, stream_type="BUFFERED", metadata=None, subtitles=None, subtitles_lang="en-US", subtitles_mime="text/vtt", subtitle_id=1, enqueue=False):
-        self.processing_queue.put(PlayerPlayStreamCommand(url, content_type, title, thumb, current_time, autoplay, stream_type, metadata, subtitles, subtitles_lang, subtitles_mime, subtitle_id, enqueue))
+        self._enqueue(PlayerPlayStreamCommand(url, content_type, title, thumb, current_time, autoplay, stream_type, metadata, subtitles, subtitles_lang, subtitles_mime, subtitle_id, enqueue))
 
     def on_player_pause_requested(self):
-        self.processing_queue.put(PlayerPauseCommand())
+        self._enqueue(PlayerPauseCommand())
 
     def on_player_resume_requested(self):
-        self.processing_queue.put(PlayerResumeCommand())
+        self._enqueue(PlayerResumeCommand())
 
     def on_player_stop_requested(self):
-        self.processing_queue.put(PlayerStopCommand())
+        self._enqueue(PlayerStopCommand())
 
     def on_player_skip_requested(self):
-        self.processing_queue.put(PlayerSkipCommand())
+        self._enqueue(PlayerSkipCommand())
 
     def on_player_rewind_requested(self):
-        self.processing_queue.put(PlayerRewindCommand())
+        self._enqueue(PlayerRewindCommand())
 
     def on_player_previous_requested(self):
-        self.processing_queue.put(PlayerPreviousCommand())
+        self._enqueue(PlayerPreviousCommand())
 
     def on_player_next_requested(self):
-        self.processing_queue.put(PlayerNextCommand())
+        self._enqueue(PlayerNextCommand())
+
+    def process_pending(self, max_items):
+        """
+        Worker pool entry point: process up to max_items queued items.
+        """
+
+        for _ in range(max_items):
+            try:
+                item = self.processing_queue.get_nowait()
+            except Empty:
+                return
+
+            self._process_item(item)
+
+    def has_pending(self):
+        return not self.processing_queue.empty()
 
     def _worker(self):
         while True:
             # TODO we should actually only get commands from the command queue if we are connected
             item = self.processing_queue.get()
+            self._process_item(item)
 
-            # noinspection PyBroadException
-            try:
-                requires_connection = not isinstance(item, CreateConnectionCommand) \
-                                      and not isinstance(item, DisconnectCommand) \
-                                      and not isinstance(item, InfoConnectionCommand) \
-                                      and not isinstance(item, CastReceivedStatus) \
-                                      and not isinstance(item, CastConnectionStatus) \
-                                      and not isinstance(item, CastMediaStatus)
-
-                if requires_connection and not self.device_connected:
-                    self.logger.info("no connection found but connection is required")
-                    self._internal_create_connection(self.device_name)
-
-                    if not self.device_connected:
-                        self.logger.error("was not able to connect to device for command %s" % (item,))
-                        raise ConnectionUnavailableException()
-
-                if isinstance(item, CreateConnectionCommand):
-                    self._worker_create_connection(item.device_name)
-                elif isinstance(item, DisconnectCommand):
-                    self._worker_disconnect()
-                if isinstance(item, InfoConnectionCommand):
-                    self._worker_info_connection(item.device_name, item.model_name, item.ip_address, item.port)
-                elif isinstance(item, VolumeMuteCommand):
-                    self._worker_volume_muted(item.muted)
-                elif isinstance(item, VolumeLevelRelativeCommand):
-                    self._worker_volume_level_relative(item.value)
-                elif isinstance(item, VolumeLevelAbsoluteCommand):
-                    self._worker_volume_level_absolute(item.value)
-                elif isinstance(item, PlayerPositionCommand):
-                    self._worker_player_position(item.position)
-                elif isinstance(item, PlayerPlayStreamCommand):
-                    self._worker_player_play_stream(item)
-                elif isinstance(item, PlayerPauseCommand):
-                    self._worker_player_pause()
-                elif isinstance(item, PlayerResumeCommand):
-                    self._worker_player_resume()
-                elif isinstance(item, PlayerStopCommand):
-                    self._worker_player_stop()
-                elif isinstance(item, PlayerSkipCommand):
-                    self._worker_player_skip()
-                elif isinstance(item, PlayerRewindCommand):
-                    self._worker_player_rewind()
-                elif isinstance(item, PlayerPreviousCommand):
-                    self._worker_player_previous()
-                elif isinstance(item, PlayerNextCommand):
-                    self._worker_player_next()
-                elif isinstance(item, CastReceivedStatus):
-                    self._worker_cast_received_status(item.status)
-                elif isinstance(item, CastConnectionStatus):
-                    self._worker_cast_connection_status(item.status)
-                elif isinstance(item, CastMediaStatus):
-                    self._worker_cast_media_status(item.status)
-            except Exception as error:
-                self.logger.exception("command %s failed" % (item,))
-
-                if isinstance(error, ConnectionUnavailableException):
-                    self.mqtt_properties.write_connection_status(CONNECTION_STATUS_NOT_FOUND)
-                else:
-                    self.mqtt_properties.write_connection_status(CONNECTION_STATUS_ERROR)
-
-                # e.g. AttributeError: 'NoneType' object has no attribute 'media_controller'
-                # at least something indicating that the connection is really dead for sure
-                if isinstance(error, AttributeError):
-                    self.connection_callback.on_connection_dead(self, self.device_name)
-                else:
-                    self.connection_callback.on_connection_failed(self, self.device_name)
-            finally:
-                self.logger.debug("command %s finished" % (item,))
-                self.processing_queue.task_done()
+    def _is_status_superseded(self, item):
+        """
+        Check if a newer status of the same kind is already queued. Superseded statuses are skipped, as only the newest
+        status is relevant. Statuses rejected by a full queue do not count, the newest accepted one is processed.
+        """
+        if not is_coalescable_status(item) or not self.processing_queue.has_newer_status(item):
+            return False
+
+        STATUSES_COALESCED.inc(self.device_name)
+        self.logger.debug("skipping superseded status of chromecast %s" % self.device_name)
+        return True
+
+    def _process_item(self, item):
+        if self._hold_until_start(item, self.processing_queue.last_enqueued_at, self.processing_queue.last_traces):
+            self.processing_queue.task_done()
+            return
+
+        ITEMS_PROCESSED.inc(type(item).__name__)
+
+        try:
+            self._execute_item(item, self.processing_queue.last_enqueued_at, self.processing_queue.last_traces)
+        finally:
+            self.logger.debug("command %s finished" % (item,))
+            self.processing_queue.task_done()
+
+    def _hold_until_start(self, item, enqueued_at, traces):
+        """
+        Hold a command until the start time of its traces, e.g. a group command sent to all members at the same time.
+        Nothing waits for it, the lane is released by the timeout scheduler. Returns True if the command is held.
+        """
+        if traces is None or self.timeout_scheduler is None:
+            return False
+
+        start_times = [trace.start_at for trace in traces if trace.start_at is not None]
+        if len(start_times) == 0:
+            return False
+
+        delay = max(start_times) - time()
+        if delay <= 0:
+            return False
+
+        self.processing_queue.hold(item, enqueued_at, traces)
+        self.timeout_scheduler.call_later(delay, self._release_held_command)
+        return True
+
+    def _release_held_command(self):
+        self.processing_queue.release()
+
+        if self.worker_pool is not None:
+            self.worker_pool.schedule(self)
+
+    def _execute_item(self, item, enqueued_at=None, traces=None):
+        if traces is not None:
+            for trace in traces:
+                trace.mark(HOP_STARTED)
+
+        # noinspection PyBroadException
+        try:
+            if self._is_status_superseded(item):
+                return
+
+            # a merged command is sent as long as one of the commands merged into it has not expired
+            if traces is not None and len(traces) > 0 and all(trace.is_expired() for trace in traces):
+                self.logger.warning("command %s has expired, not sending it" % (item,))
+                self._finish_traces(traces, RESULT_EXPIRED, "expired before it could be sent")
+                return
+
+            requires_connection = not isinstance(item, CreateConnectionCommand) \
+                                  and not isinstance(item, DisconnectCommand) \
+                                  and not isinstance(item, InfoConnectionCommand) \
+                                  and not isinstance(item, CastReceivedStatus) \
+                                  and not isinstance(item, CastConnectionStatus) \
+                                  and not isinstance(item, CastMediaStatus)
+
+            if requires_connection and not self.device_connected and self.reconnect_scheduler is not None:
+                self._postpone_command(item, enqueued_at, traces)
+                return
+
+            if requires_connection and not self.device_connected:
+                self.logger.info("no connection found but connection is required")
+                self._internal_create_connection(self.device_name)
+
+                if not self.device_connected:
+                    self.logger.error("was not able to connect to device for command %s" % (item,))
+                    raise ConnectionUnavailableException()
+
+            if isinstance(item, CreateConnectionCommand):
+                self._worker_create_connection(item.device_name)
+            elif isinstance(item, DisconnectCommand):
+                self._worker_disconnect(item.clear_retained, item.publish_status)
+            if isinstance(item, InfoConnectionCommand):
+                self._worker_info_connection(item.device_name, item.model_name, item.ip_address, item.port)
+            elif isinstance(item, VolumeMuteCommand):
+                self._worker_volume_muted(item.muted)
+            elif isinstance(item, VolumeLevelRelativeCommand):
+                self._worker_volume_level_relative(item.value)
+            elif isinstance(item, VolumeLevelAbsoluteCommand):
+                self._worker_volume_level_absolute(item.value)
+            elif isinstance(item, PlayerPositionCommand):
+                self._worker_player_position(item.position)
+            elif isinstance(item, PlayerPlayStreamCommand):
+                self._worker_player_play_stream(item)
+            elif isinstance(item, PlayerPauseCommand):
+                self._worker_player_pause()
+            elif isinstance(item, PlayerResumeCommand):
+                self._worker_player_resume()
+            elif isinstance(item, PlayerStopCommand):
+                self._worker_player_stop()
+            elif isinstance(item, PlayerSkipCommand):
+                self._worker_player_skip()
+            elif isinstance(item, PlayerRewindCommand):
+                self._worker_player_rewind()
+            elif isinstance(item, PlayerPreviousCommand):
+                self._worker_player_previous()
+            elif isinstance(item, PlayerNextCommand):
+                self._worker_player_next()
+            elif isinstance(item, CastReceivedStatus):
+                self._worker_cast_received_status(item.status)
+            elif isinstance(item, CastConnectionStatus):
+                self._worker_cast_connection_status(item.status)
+            elif isinstance(item, CastMediaStatus):
+                self._worker_cast_media_status(item.status, item.received_at)
+
+            if enqueued_at is not None and not is_connection_command(item):
+                COMMAND_LATENCY.observe(time() - enqueued_at, type(item).__name__)
+
+            if traces is not None:
+                self._await_status(traces)
+        except Exception as error:
+            self.logger.exception("command %s failed" % (item,))
+
+            if traces is not None:
+                self._finish_traces(traces, RESULT_FAILED, "%s: %s" % (type(error).__name__, error))
+
+            if isinstance(error, ConnectionUnavailableException):
+                self.mqtt_properties.write_connection_status(CONNECTION_STATUS_NOT_FOUND)
+            else:
+                self.mqtt_properties.write_connection_status(CONNECTION_STATUS_ERROR)
+
+            # e.g. AttributeError: 'NoneType' object has no attribute 'media_controller'
+            # at least something indicating that the connection is really dead for sure
+            if isinstance(error, AttributeError):
+                self.connection_callback.on_connection_dead(self, self.device_name)
+            else:
+                self.connection_callback.on_connection_failed(self, self.device_name)
+
+    def _postpone_command(self, item, enqueued_at, traces):
+        """
+        Keep a command until the device is connected again or reject it, if commands should not be buffered. A
+        connection attempt is requested in both cases, the scheduler decides when it is made.
+        """
+
+        now = time()
+        while len(self.buffered_commands) > 0 and self.buffered_commands[0][0] < now:
+            _, expired_item, _, expired_traces = self.buffered_commands.popleft()
+            self.logger.warning("buffered command %s expired" % (expired_item,))
+            self._finish_traces(expired_traces, RESULT_REJECTED, "expired while not connected")
+
+        if self.settings.command_buffer_ttl > 0:
+            self.logger.info("chromecast %s is not connected, buffering command %s" % (self.device_name, item))
+
+            if len(self.buffered_commands) >= self.settings.queue_size:
+                _, dropped_item, _, dropped_traces = self.buffered_commands.popleft()
+                self.logger.warning("dropping buffered command %s" % (dropped_item,))
+                self._finish_traces(dropped_traces, RESULT_REJECTED, "dropped while not connected")
+
+            self.buffered_commands.append((now + self.settings.command_buffer_ttl, item, enqueued_at, traces))
+
+            if traces is not None:
+                for trace in traces:
+                    trace.mark(HOP_POSTPONED)
+        else:
+            self.logger.warning("chromecast %s is not connected, rejecting command %s" % (self.device_name, item))
+            self.mqtt_properties.write_command_error("not connected, rejected %s" % type(item).__name__)
+            self._finish_traces(traces, RESULT_REJECTED, "not connected")
+
+        self.reconnect_scheduler.request_reconnect(self)
+
+    def _await_status(self, traces):
+        """
+        Finish the traces of a sent command with the first status received from the device afterwards.
+        """
+        for trace in traces:
+            trace.mark(HOP_SENT)
+
+        # finished with RESULT_NO_STATUS if no status is received within TRACE_STATUS_TIMEOUT
+        self.status_traces.add(traces)
+
+    def _finish_traces(self, traces, result, error=None):
+        if traces is None:
+            return
+
+        for trace in traces:
+            trace.finish(result, error)
+
+    def _execute_buffered_commands(self):
+        now = time()
+        while len(self.buffered_commands) > 0:
+            expiry_time, item, enqueued_at, traces = self.buffered_commands.popleft()
+
+            if expiry_time < now:
+                self.logger.warning("buffered command %s expired" % (item,))
+                self._finish_traces(traces, RESULT_REJECTED, "expired while not connected")
+            else:
+                self._execute_item(item, enqueued_at, traces)
 
     def _internal_create_connection(self, device_name):
+        started_at = time()
         try:
             self.mqtt_properties.write_connection_status(CONNECTION_STATUS_WAITING_FOR_DEVICE)
-            devices, browser = get_listed_chromecasts(friendly_names=[device_name])
 
-            if not devices:
-                self.logger.error("was not able to find chromecast %s" % self.device_name)
-                raise ConnectionUnavailableException()
+            self.device = None
+            if self.reconnect_scheduler is not None:
+                with self.reconnect_scheduler.connect_slot():
+                    self.device = self._internal_find_device(device_name)
             else:
-                self.device = devices[0]
+                self.device = self._internal_find_device(device_name)
 
-            self.device.wait()
             self.device.register_status_listener(self)
             self.device.media_controller.register_status_listener(self)
             self.device.register_launch_error_listener(self)
@@ -260,30 +862,139 @@ class ChromecastConnection(MqttChangesCallback):
 
             self.device_connected = True  # alibi action
             self.logger.info("connected to chromecast %s" % self.device_name)
+            self.connection_callback.on_connection_established(self, self.device_name)
         except PyChromecastError:
             self.logger.exception("had connection error while finding chromecast %s" % self.device_name)
 
             self.device_connected = False
+        finally:
+            CONNECT_DURATION.observe(time() - started_at, "connected" if self.device_connected else "failed")
+
+    def _internal_find_device(self, device_name):
+        device = None
+        if self.service_cache is not None:
+            device = self._internal_connect_cached_service(device_name)
+
+        if device is None:
+            device = self._internal_lookup_device(device_name)
+
+        if self.service_cache is not None:
+            cast_info = device.cast_info
+            self.service_cache.update(device_name, cast_info.model_name, cast_info.host, cast_info.port,
+                                      cast_info.uuid, device.cast_type)
+
+        return device
+
+    def _internal_connect_cached_service(self, device_name):
+        """
+        Connect to the address the discovery has resolved for this device. Returns None if no usable address is cached.
+        """
+
+        service = self.service_cache.get(device_name)
+        if service is None:
+            self.logger.debug("no cached service found for chromecast %s" % device_name)
+            return None
+
+        self.logger.debug("connecting to chromecast %s at %s:%d" % (device_name, service.ip_address, service.port))
+        device = get_chromecast_from_host((service.ip_address, service.port, service.uuid, service.model_name,
+                                           service.device_name))
+
+        # noinspection PyBroadException
+        try:
+            device.wait(timeout=DIRECT_CONNECT_TIMEOUT)
+        except Exception:
+            self.logger.exception("error while connecting to cached address of chromecast %s" % device_name)
+
+        if device.status is None:
+            self.logger.warning("chromecast %s not reachable at cached address, looking it up" % device_name)
+
+            device.disconnect()
+            self.service_cache.mark_stale(device_name)
+            return None
+
+        return device
+
+    def _internal_lookup_device(self, device_name):
+        zeroconf_instance = None
+        if self.zeroconf_service is not None:
+            zeroconf_instance = self.zeroconf_service.get()
+
+        devices, browser = get_listed_chromecasts(friendly_names=[device_name], zeroconf_instance=zeroconf_instance)
+
+        if zeroconf_instance is not None:
+            # the browser is only needed for this lookup, the shared zeroconf instance stays open
+            browser.stop_discovery()
+
+        if not devices:
+            self.logger.error("was not able to find chromecast %s" % self.device_name)
+            raise ConnectionUnavailableException()
+
+        device = devices[0]
+        device.wait()
+
+        return device
 
     def _worker_create_connection(self, device_name):
-        # uncaught exceptions bubble to the try-except handler of the worker thread
-        self._internal_create_connection(device_name)
+        if self.reconnect_scheduler is None:
+            # uncaught exceptions bubble to the try-except handler of the worker thread
+            self._internal_create_connection(device_name)
+
+            if not self.device_connected:
+                self.mqtt_properties.write_connection_status(CONNECTION_STATUS_ERROR)
 
-        if not self.device_connected:
+            return
+
+        if self.device_connected:
+            self.logger.debug("chromecast %s is already connected" % device_name)
+            return
+
+        if self.reconnect_scheduler.is_in_backoff(device_name):
+            self.logger.debug("chromecast %s is in backoff, postponing connection attempt" % device_name)
+            self.reconnect_scheduler.request_reconnect(self)
+            return
+
+        is_connected = False
+        try:
+            # uncaught exceptions bubble to the try-except handler of the worker thread
+            self._internal_create_connection(device_name)
+            is_connected = self.device_connected
+        finally:
+            if is_connected:
+                self.reconnect_scheduler.on_connected(self)
+            else:
+                self.reconnect_scheduler.on_connection_failed(self)
+
+        if not is_connected:
             self.mqtt_properties.write_connection_status(CONNECTION_STATUS_ERROR)
+            return
 
-    def _worker_disconnect(self):
+        self._execute_buffered_commands()
+
+    def _worker_disconnect(self, clear_retained, publish_status):
         self.logger.info("disconnecting chromecast %s" % self.device_name)
 
         self.device_connected = False
 
+        while len(self.buffered_commands) > 0:
+            self._finish_traces(self.buffered_commands.popleft()[3], RESULT_REJECTED, "device disconnected")
+
+        # statuses still waiting would publish the topics of the device again, e.g. after they have been cleared
+        with self.pending_statuses_lock:
+            self.pending_statuses.clear()
+        self.processing_queue.clear_statuses()
+
         if self.device is not None:
             self.device.disconnect()
             self.device = None
         else:
             self.logger.warning("device is not available (at disconnection)")
 
-        self.mqtt_properties.write_connection_status(CONNECTION_STATUS_DISCONNECTED)
+        if clear_retained:
+            self.mqtt_properties.clear_retained()
+        else:
+            if publish_status:
+                self.mqtt_properties.write_connection_status(CONNECTION_STATUS_DISCONNECTED)
+            self.mqtt_properties.clear_write_filter()
 
     def _worker_info_connection(self, device_name, model_name, ip_address, port):
         self.mqtt_properties.write_connection_info(device_name, model_name, ip_address, port)
@@ -366,27 +1077,43 @@ class ChromecastConnection(MqttChangesCallback):
 
     # ##################################################################################
 
+    def _is_status_outdated(self):
+        # statuses received before the device has been disconnected must not publish its topics again
+        if self.device is not None:
+            return False
+
+        self.logger.debug("ignoring status of disconnected chromecast %s" % self.device_name)
+        return True
+
     def _worker_cast_received_status(self, status):
         # CastStatus(is_active_input=None, is_stand_by=None, volume_level=0.3499999940395355, volume_muted=False,
         # app_id='CC1AD845', display_name='Default Media Receiver', namespaces=['urn:x-cast:com.google.cast.media'],
         # session_id='xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxx', transport_id='web-0', status_text='Now Casting')
         self.logger.info("received new cast status from chromecast %s" % self.device_name)
 
+        if self._is_status_outdated():
+            return
+
         if status is None:
             self.logger.warning("received empty status")
             return
 
-        self.mqtt_properties.write_cast_status(status.display_name, status.volume_level, status.volume_muted)
-        # dummy write as connection status callback does not work at the moment
-        self.mqtt_properties.write_connection_status(CONNECTION_STATUS_CONNECTED)
-        self.connection_failure_count = 0
+        with self.mqtt_properties.update():
+            self.mqtt_properties.write_cast_status(status.display_name, status.volume_level, status.volume_muted)
+            # dummy write as connection status callback does not work at the moment
+            self.mqtt_properties.write_connection_status(CONNECTION_STATUS_CONNECTED)
+            self.connection_failure_count = 0
 
-        # reset player state if necessary
-        if status.app_id is None or status.app_id == IDLE_APP_ID:  # no app active = idle
-            self.mqtt_properties.write_player_status(MEDIA_PLAYER_STATE_IDLE, None, None)
+            # reset player state if necessary
+            if status.app_id is None or status.app_id == IDLE_APP_ID:  # no app active = idle
+                self.mqtt_properties.write_player_status(MEDIA_PLAYER_STATE_IDLE, None, None)
 
     def _worker_cast_connection_status(self, status):
         self.logger.info("received new connection status from chromecast %s: %s" % (self.device_name, status.status))
+
+        if self._is_status_outdated():
+            return
+
         self.mqtt_properties.write_connection_status(status.status)
 
         self.device_connected = status.status == CONNECTION_STATUS_CONNECTED
@@ -404,7 +1131,7 @@ class ChromecastConnection(MqttChangesCallback):
                 self.logger.warning("failure counter too high, treating chromecast as dead")
                 self.connection_callback.on_connection_dead(self, self.device_name)
 
-    def _worker_cast_media_status(self, status):
+    def _worker_cast_media_status(self, status, received_at):
         #  <MediaStatus {'media_metadata': {}, 'content_id': 'http://some.url.com/', 'player_state': 'PLAYING',
         # 'episode': None, 'media_custom_data': {}, 'supports_stream_mute': True, 'track': None,
         # 'supports_stream_volume': True, 'volume_level': 1, 'album_name': None, 'idle_reason': None,
@@ -415,6 +1142,9 @@ class ChromecastConnection(MqttChangesCallback):
         # 'supports_seek': True, 'current_time': 13938.854693, 'supported_media_commands': 15}>
         self.logger.info("received new media status from chromecast %s" % self.device_name)
 
+        if self._is_status_outdated():
+            return
+
         images = status.media_metadata.get('images', [])
         image_filtered = None
 
@@ -423,6 +1153,9 @@ class ChromecastConnection(MqttChangesCallback):
                 image_filtered = image["url"]
                 break  # only take the first image
 
-        self.mqtt_properties.write_player_status(status.player_state, status.current_time, status.duration)
-        self.mqtt_properties.write_media_status(status.title, status.album_name, status.artist, status.album_artist,
-                                                status.track, image_filtered, status.content_type, status.content_id)
+        with self.mqtt_properties.update():
+            self.mqtt_properties.write_player_status(status.player_state, status.current_time, status.duration,
+                                                     status.playback_rate, received_at)
+            self.mqtt_properties.write_media_status(status.title, status.album_name, status.artist,
+                                                    status.album_artist, status.track, image_filtered,
+                                                    status.content_type, status.content_id)
@@ -1,18 +1,31 @@
-from handler.adapter import ChromecastConnection, ChromecastConnectionCallback
+from handler.adapter import ChromecastConnection, ChromecastConnectionCallback, ConnectionSettings
+from handler.group import GroupSettings, DeviceGroup, GroupCommand, get_member_topic
 from handler.properties import TOPIC_COMMAND_VOLUME_LEVEL, TOPIC_COMMAND_VOLUME_MUTED, TOPIC_COMMAND_PLAYER_POSITION, \
-    TOPIC_COMMAND_PLAYER_STATE
+    TOPIC_COMMAND_PLAYER_STATE, TOPIC_CONNECTOR_STARTUP, TOPIC_GROUP_COMMAND, get_device_name_from_topic, \
+    get_group_name_from_topic, is_command_topic
+from helper import metrics
+from helper.cluster import ClusterCallback
 from helper.discovery import DiscoveryCallback
 from helper.mqtt import MqttConnectionCallback
+from helper.pool import WorkerPoolLane
+from helper.recorder import EVENT_MQTT_MESSAGE, EVENT_APPEARED, EVENT_DISAPPEARED
+from helper.timeouts import TimeoutScheduler
+from helper.trace import CommandTrace, HOP_DISPATCHED, RESULT_INVALID
 import logging
 from collections import namedtuple
-from queue import PriorityQueue
+from json import dumps
+from queue import PriorityQueue, Empty
 from threading import Thread
+from time import time
 
-MqttMessage = namedtuple("MqttMessage", ["topic", "payload"])
+MqttMessage = namedtuple("MqttMessage", ["topic", "payload", "trace", "forwarded"], defaults=[None, False])
 DeviceAppeared = namedtuple("DeviceAppeared", ["device_name", "model_name", "ip_address", "port"])
 DeviceDisappeared = namedtuple("DeviceDisappeared", ["device_name"])
 DeviceConnectionFailure = namedtuple("DeviceConnectionFailure", ["device_name", "connection"])
 DeviceConnectionDead = namedtuple("DeviceConnectionDead", ["device_name", "connection"])
+OwnershipChanged = namedtuple("OwnershipChanged", [])
+
+EVENTS_PROCESSED = metrics.counter("chromecast_events_total", "Events processed by the event handler", ["type"])
 
 
 class SortedPriorityQueue(PriorityQueue):
@@ -33,103 +46,361 @@ class SortedPriorityQueue(PriorityQueue):
         return item
 
 
-class EventHandler(DiscoveryCallback, MqttConnectionCallback, ChromecastConnectionCallback):
+class EventHandler(DiscoveryCallback, MqttConnectionCallback, ChromecastConnectionCallback, WorkerPoolLane,
+                   ClusterCallback):
     """
     Class that ties MQTT, discovery and Chromecast events together.
     """
 
-    def __init__(self):
+    # class of the device connections, can be replaced e.g. for simulated devices
+    connection_class = ChromecastConnection
+
+    def __init__(self, worker_pool=None, service_cache=None, zeroconf_service=None,
+                 connection_settings=ConnectionSettings(), reconnect_scheduler=None, startup_timeline=None,
+                 publish_startup_timeline=False, clear_removed_devices=False, runtime=None, recorder=None,
+                 group_settings=GroupSettings(), timeout_scheduler=None):
         self.logger = logging.getLogger("event")
 
         self.mqtt_client = None
+        self.retained_values = {}
+        self.worker_pool = worker_pool
+        self.service_cache = service_cache
+        self.zeroconf_service = zeroconf_service
+        self.connection_settings = connection_settings
+        self.reconnect_scheduler = reconnect_scheduler
+        self.startup_timeline = startup_timeline
+        self.publish_startup_timeline = publish_startup_timeline
+        self.clear_removed_devices = clear_removed_devices
+        self.runtime = runtime
+        self.recorder = recorder
         self.known_devices = {}
 
+        # timeouts of traced commands, shared by all devices
+        self.timeout_scheduler = timeout_scheduler
+        if self.timeout_scheduler is None:
+            self.timeout_scheduler = TimeoutScheduler()
+            self.timeout_scheduler.start_scheduler()
+
+        # devices are shared with other connector instances if set, only the owned devices are connected
+        self.cluster = None
+        # connection info of all discovered devices (including those owned by other instances)
+        self.discovered_devices = {}
+
+        # groups addressed by chromecast/_group/<name>/command/..., created once the mqtt connection has been set
+        self.group_settings = group_settings
+        self.device_groups = {}
+
         # processing queue used to add and remove devices
         self.processing_queue = SortedPriorityQueue()
 
-        self.processing_worker = Thread(target=self._worker)
-        self.processing_worker.daemon = True
-        self.processing_worker.start()
+        # events are processed on the event loop of the runtime if given, otherwise by an own thread
+        if runtime is None:
+            self.processing_worker = Thread(target=self._worker)
+            self.processing_worker.daemon = True
+            self.processing_worker.start()
+
+    def set_mqtt_connection(self, mqtt_connection):
+        """
+        Set the mqtt connection before it has been established, e.g. for devices added from the device cache. Messages
+        are queued by the connection until it has been established.
+        """
+        self.mqtt_client = mqtt_connection
+
+    def set_cluster(self, cluster):
+        """
+        Share the devices with other connector instances, has to be set before the devices are added.
+        """
+        self.cluster = cluster
+
+    def is_owner(self, device_name):
+        return self.cluster is None or self.cluster.is_owner(device_name)
+
+    def prime_write_filters(self, retained_values):
+        """
+        Remember the values retained by the broker (topic -> payload) for devices which are added later on.
+        """
+        for topic, payload in retained_values.items():
+            device_name = get_device_name_from_topic(topic)
+            if device_name:
+                self.retained_values.setdefault(device_name, {})[topic] = payload
+
+        self.logger.debug("received retained values for %d devices" % len(self.retained_values))
+
+    def clear_orphaned_devices(self, retained_values, known_device_names):
+        """
+        Remove the retained topics (topic -> payload) of devices which are not known anymore from the broker. Returns
+        the retained values of all other devices.
+        """
+        orphaned_topics = {}
+        remaining_values = {}
+
+        for topic, payload in retained_values.items():
+            device_name = get_device_name_from_topic(topic)
+
+            # names starting with an underscore are used by the connector itself
+            if device_name and not device_name.startswith("_") and device_name not in known_device_names:
+                orphaned_topics.setdefault(device_name, []).append(topic)
+            else:
+                remaining_values[topic] = payload
+
+        for device_name, topics in orphaned_topics.items():
+            self.logger.info("clearing %d retained topics of orphaned device %s" % (len(topics), device_name))
+            self.mqtt_client.clear_topics(topics)
+
+        return remaining_values
+
+    def get_device_queue_depths(self):
+        """
+        Returns the number of items waiting in the processing queue of each device (device name -> depth).
+        """
+        # the devices are added and removed by the worker, copy them first
+        return {device_name: device.processing_queue.qsize()
+                for device_name, device in list(self.known_devices.items())}
 
     def on_mqtt_connected(self, client):
         self.logger.debug("mqtt connected callback has been invoked")
         self.mqtt_client = client
         # insert + as identifier so that every command to every identifier (= friendly names) will be recognized
-        self.mqtt_client.subscribe(TOPIC_COMMAND_VOLUME_LEVEL % "+")
-        self.mqtt_client.subscribe(TOPIC_COMMAND_VOLUME_MUTED % "+")
-        self.mqtt_client.subscribe(TOPIC_COMMAND_PLAYER_POSITION % "+")
-        self.mqtt_client.subscribe(TOPIC_COMMAND_PLAYER_STATE % "+")
+        self.mqtt_client.subscribe_command(TOPIC_COMMAND_VOLUME_LEVEL % "+")
+        self.mqtt_client.subscribe_command(TOPIC_COMMAND_VOLUME_MUTED % "+")
+        self.mqtt_client.subscribe_command(TOPIC_COMMAND_PLAYER_POSITION % "+")
+        self.mqtt_client.subscribe_command(TOPIC_COMMAND_PLAYER_STATE % "+")
+
+        if self.group_settings.groups:
+            self.mqtt_client.subscribe_command(TOPIC_GROUP_COMMAND % ("+", "+"))
+
+        if self.cluster is not None:
+            self.cluster.on_mqtt_connected(client)
 
         self.logger.debug("mqtt topics have been subscribed")
 
-    def on_mqtt_message_received(self, topic, payload):
-        self.processing_queue.put(MqttMessage(topic, payload), 2)
+    def on_mqtt_message_received(self, topic, payload, trace=None):
+        if self.cluster is not None and self.cluster.is_cluster_topic(topic):
+            self.cluster.handle_message(topic, payload)
+            return
+
+        forwarded = False
+        if self.cluster is not None:
+            forwarded_topic = self.cluster.get_forwarded_topic(topic)
+
+            if forwarded_topic is not None:
+                topic = forwarded_topic
+                forwarded = True
+
+                if trace is not None:
+                    trace.topic = topic
+
+        if self.recorder is not None:
+            self.recorder.record(EVENT_MQTT_MESSAGE, None, {"topic": topic, "payload": _decode_payload(payload)})
+
+        self._enqueue(MqttMessage(topic, payload, trace, forwarded), 2)
 
     def on_chromecast_appeared(self, device_name, model_name, ip_address, port):
-        self.processing_queue.put(DeviceAppeared(device_name, model_name, ip_address, port), 0)
+        if self.recorder is not None:
+            self.recorder.record(EVENT_APPEARED, device_name,
+                                 {"model_name": model_name, "ip_address": ip_address, "port": port})
+
+        self._enqueue(DeviceAppeared(device_name, model_name, ip_address, port), 0)
 
     def on_chromecast_disappeared(self, device_name):
-        self.processing_queue.put(DeviceDisappeared(device_name), 0)
+        if self.recorder is not None:
+            self.recorder.record(EVENT_DISAPPEARED, device_name, None)
+
+        self._enqueue(DeviceDisappeared(device_name), 0)
+
+    def on_cluster_changed(self):
+        self._enqueue(OwnershipChanged(), 0)
 
     def on_connection_failed(self, chromecast_connection, device_name):
-        self.processing_queue.put(DeviceConnectionFailure(device_name, chromecast_connection), 2)
+        self._enqueue(DeviceConnectionFailure(device_name, chromecast_connection), 2)
 
     def on_connection_dead(self, chromecast_connection, device_name):
-        self.processing_queue.put(DeviceConnectionDead(device_name, chromecast_connection), 0)
+        self._enqueue(DeviceConnectionDead(device_name, chromecast_connection), 0)
+
+    def on_connection_established(self, chromecast_connection, device_name):
+        # called by the device worker, the timeline is thread safe
+        if self.startup_timeline is None:
+            return
+
+        summary = self.startup_timeline.on_device_connected(device_name)
+        if summary is not None and self.publish_startup_timeline and self.mqtt_client is not None:
+            self.mqtt_client.send_message(TOPIC_CONNECTOR_STARTUP, dumps(summary, sort_keys=True))
+
+    def _enqueue(self, item, priority):
+        self.processing_queue.put(item, priority)
+
+        if self.runtime is not None:
+            # events do not block, so they are processed on the event loop itself
+            self.runtime.schedule(self, blocking=False)
+
+    def process_pending(self, max_items):
+        """
+        Runtime entry point: process up to max_items queued events.
+        """
+
+        for _ in range(max_items):
+            try:
+                item = self.processing_queue.get_nowait()
+            except Empty:
+                return
+
+            self._process_item(item)
+
+    def has_pending(self):
+        return not self.processing_queue.empty()
 
     def _worker(self):
         while True:
             item = self.processing_queue.get()
+            self._process_item(item)
+
+    def _process_item(self, item):
+        EVENTS_PROCESSED.inc(type(item).__name__)
+
+        try:
+            if isinstance(item, MqttMessage):
+                self._worker_mqtt_message_received(item.topic, item.payload, item.trace, item.forwarded)
+            elif isinstance(item, DeviceAppeared):
+                self._worker_chromecast_appeared(item.device_name, item.model_name, item.ip_address, item.port)
+            elif isinstance(item, DeviceDisappeared):
+                self._worker_chromecast_disappeared(item.device_name)
+            elif isinstance(item, DeviceConnectionFailure):
+                self._worker_chromecast_connection_failed(item.device_name, item.connection)
+            elif isinstance(item, DeviceConnectionDead):
+                self._worker_chromecast_connection_dead(item.device_name, item.connection)
+            elif isinstance(item, OwnershipChanged):
+                self._worker_ownership_changed()
+        except:
+            self.logger.exception("event %s failed" % (item,))
+        finally:
+            self.processing_queue.task_done()
+
+    def _create_device(self, device_name):
+        if self.startup_timeline is not None:
+            self.startup_timeline.on_device_added(device_name)
+
+        # retained values are only used once, a device added again starts with its own values
+        return self.connection_class(device_name, self.mqtt_client, self, self.worker_pool, self.service_cache,
+                                     self.zeroconf_service, self.connection_settings, self.reconnect_scheduler,
+                                     self.retained_values.pop(device_name, None), self.recorder,
+                                     self.timeout_scheduler)
+
+    def _worker_mqtt_message_received(self, topic, payload, trace, forwarded=False):
+        if trace is not None:
+            trace.mark(HOP_DISPATCHED)
+
+        group_name = get_group_name_from_topic(topic)
+        if group_name is not None:
+            self._worker_group_command(group_name, topic, payload, trace)
+            return
 
-            try:
-                if isinstance(item, MqttMessage):
-                    self._worker_mqtt_message_received(item.topic, item.payload)
-                elif isinstance(item, DeviceAppeared):
-                    self._worker_chromecast_appeared(item.device_name, item.model_name, item.ip_address, item.port)
-                elif isinstance(item, DeviceDisappeared):
-                    self._worker_chromecast_disappeared(item.device_name)
-                elif isinstance(item, DeviceConnectionFailure):
-                    self._worker_chromecast_connection_failed(item.device_name, item.connection)
-                elif isinstance(item, DeviceConnectionDead):
-                    self._worker_chromecast_connection_dead(item.device_name, item.connection)
-            except:
-                self.logger.exception("event %s failed" % (item,))
-            finally:
-                self.processing_queue.task_done()
-
-    def _worker_mqtt_message_received(self, topic, payload):
-        for ip in self.known_devices:
-            device = self.known_devices[ip]
-            if device.is_interesting_message(topic):
-                self.logger.debug("found device to handle mqtt message")
-
-                device.handle_message(topic, payload)
-                return
+        # topic is e.g. "chromecast/%s/command/volume_level", known devices are indexed by name
+        device_name = get_device_name_from_topic(topic)
+        if not device_name or not is_command_topic(topic):
+            self.logger.warning("received change for topic %s, but no device command is addressed" % topic)
 
-        self.logger.warning("received change for topic %s, but was not handled - creating new device" % topic)
+            if trace is not None:
+                trace.finish(RESULT_INVALID, "no device command addressed")
+            return
+
+        if not self.is_owner(device_name):
+            owner = self.cluster.get_owner(device_name)
+
+            # with shared subscriptions no other instance has received the command, forwarded commands are not passed
+            # on again (e.g. while the instances disagree about the owner)
+            if self.mqtt_client.shared_group is not None and not forwarded:
+                self.logger.debug("forwarding topic %s to instance %s" % (topic, owner))
+                self.mqtt_client.forward_command(self.cluster.get_forward_topic(owner, topic), payload, trace)
+            else:
+                # handled by the owning instance, which also answers traced commands
+                self.logger.debug("ignoring topic %s, device is owned by instance %s" % (topic, owner))
+            return
+
+        self._get_addressed_device(device_name, topic).handle_message(topic, payload, trace)
 
-        # topic is e.g. "chromecast/%s/command/volume_level"
-        parts = topic.split("/")
-        if len(parts) > 2:
-            device_name = parts[1]
-            device = ChromecastConnection(device_name, self.mqtt_client, self)
+    def _get_addressed_device(self, device_name, topic):
+        device = self.known_devices.get(device_name)
+        if device is None:
+            self.logger.warning("received change for topic %s, but was not handled - creating new device" % topic)
+
+            device = self._create_device(device_name)
 
             self.known_devices[device_name] = device
             self.logger.info("added device %s after receiving topic addressing it" % device_name)
+        else:
+            self.logger.debug("found device to handle mqtt message")
 
-            device.handle_message(topic, payload)
+        return device
+
+    def _worker_group_command(self, group_name, topic, payload, trace):
+        member_names = (self.group_settings.groups or {}).get(group_name)
+        if member_names is None:
+            self.logger.warning("received command %s for unknown group %s" % (topic, group_name))
+
+            if trace is not None:
+                trace.finish(RESULT_INVALID, "unknown group")
+            return
+
+        group = self.device_groups.get(group_name)
+        if group is None:
+            group = DeviceGroup(self.mqtt_client, group_name, member_names)
+            self.device_groups[group_name] = group
+
+        local_members = []
+        forwarded_members = {}
+        for device_name in member_names:
+            if self.is_owner(device_name):
+                local_members.append(device_name)
+            elif self.mqtt_client.shared_group is not None:
+                # with shared subscriptions no other instance has received the group command, only the expiry is
+                # forwarded as the group command is answered here
+                owner = self.cluster.get_owner(device_name)
+                member_topic = get_member_topic(topic, device_name)
+                member_trace = CommandTrace(member_topic, expires_at=trace.expires_at) if trace is not None else None
+
+                self.mqtt_client.forward_command(self.cluster.get_forward_topic(owner, member_topic), payload,
+                                                 member_trace)
+                forwarded_members[device_name] = owner
+
+        # the members hold the command until the start time, so that they start at the same time even if some of them
+        # have other commands queued
+        start_at = None
+        if self.group_settings.start_delay > 0:
+            start_at = time() + self.group_settings.start_delay
+
+        command = GroupCommand(self.mqtt_client, group_name, topic, local_members, forwarded_members, trace, start_at,
+                               self.group_settings.result_timeout, self.timeout_scheduler)
+
+        # all members are queued before any of them is waited for, the devices work on the command in parallel
+        targets = [(self._get_addressed_device(device_name, topic), command.member_traces[device_name])
+                   for device_name in local_members]
+        group.dispatch(topic, payload, targets)
+
+        command.start()
 
     def _worker_chromecast_appeared(self, device_name, model_name, ip_address, port):
+        self.discovered_devices[device_name] = DeviceAppeared(device_name, model_name, ip_address, port)
+
+        if not self.is_owner(device_name):
+            # another instance connects to the device, it is added here once this instance owns it
+            self.logger.debug("device %s is owned by instance %s" % (device_name, self.cluster.get_owner(device_name)))
+            return
+
         if device_name in self.known_devices:
             self.logger.warning("device %s already known" % device_name)
             return
 
-        self.known_devices[device_name] = ChromecastConnection(device_name, self.mqtt_client, self)
+        self.known_devices[device_name] = self._create_device(device_name)
         self.known_devices[device_name].new_connection_info(device_name, model_name, ip_address, port)
         self.logger.info("added device %s" % device_name)
 
     def _worker_chromecast_disappeared(self, device_name):
         if device_name not in self.known_devices:
+            if self.discovered_devices.pop(device_name, None) is not None and not self.is_owner(device_name):
+                self.logger.debug("device %s of instance %s has disappeared" % (
+                    device_name, self.cluster.get_owner(device_name)))
+                return
+
             self.logger.warning("device %s not known" % device_name)
             return
 
@@ -141,12 +412,60 @@ class EventHandler(DiscoveryCallback, MqttConnectionCallback, ChromecastConnecti
             self.logger.debug("de-registering device %s" % device_name)
 
             self.known_devices.pop(device_name)  # ignore result, we already have the device
-            device.unregister_device()
+            self.discovered_devices.pop(device_name, None)
+            device.unregister_device(self.clear_removed_devices)
+
+            if self.startup_timeline is not None:
+                self.startup_timeline.on_device_removed(device_name)
 
     def _worker_chromecast_connection_failed(self, device_name, connection):
-        self.logger.warning("connection to device %s failed too often" % device_name)
-        # TODO if the connection fails to often, treat it as dead
+        self.logger.warning("connection to device %s failed" % device_name)
+
+        if self.reconnect_scheduler is not None and not connection.is_connected():
+            # no-op if an attempt is already scheduled, the scheduler handles the backoff
+            self.reconnect_scheduler.request_reconnect(connection)
 
     def _worker_chromecast_connection_dead(self, device_name, connection):
         self.logger.error("connection to device %s is dead, removing" % device_name)
-        self.known_devices.pop(device_name)
+
+        if self.known_devices.get(device_name) is connection:
+            self.known_devices.pop(device_name)
+
+        if self.reconnect_scheduler is not None:
+            self.reconnect_scheduler.cancel(device_name)
+
+        connection.unregister_device(self.clear_removed_devices)
+
+        if self.startup_timeline is not None:
+            self.startup_timeline.on_device_removed(device_name)
+
+    def _worker_ownership_changed(self):
+        # hand over the devices now owned by another instance, it publishes their statuses from now on
+        for device_name, device in list(self.known_devices.items()):
+            if self.is_owner(device_name):
+                continue
+
+            self.logger.info("handing over device %s to instance %s" % (device_name,
+                                                                       self.cluster.get_owner(device_name)))
+            self.known_devices.pop(device_name)
+
+            if self.reconnect_scheduler is not None:
+                self.reconnect_scheduler.cancel(device_name)
+
+            device.unregister_device(publish_status=False)
+
+            if self.startup_timeline is not None:
+                self.startup_timeline.on_device_removed(device_name)
+
+        # take over the discovered devices now owned by this instance, e.g. of an instance which has died
+        for device_name, appeared in list(self.discovered_devices.items()):
+            if device_name not in self.known_devices and self.is_owner(device_name):
+                self.logger.info("taking over device %s" % device_name)
+                self._worker_chromecast_appeared(*appeared)
+
+
+def _decode_payload(payload):
+    if isinstance(payload, bytes):
+        return payload.decode("utf-8", errors="replace")
+
+    return payload
@@ -0,0 +1,204 @@
+import logging
+from collections import namedtuple
+from json import dumps
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+from handler.properties import MqttChangesCallback, MqttPropertyHandler, TOPIC_GROUP_RESULT
+from helper.trace import CommandTrace, HOP_QUEUED, RESULT_OK, RESULT_INVALID, RESULT_PARTIAL, RESULT_PENDING, \
+    RESULT_FORWARDED
+
+# groups = group name -> friendly names of the members, start_delay = seconds after receiving a group command until it
+# is sent to all members at the same time (0 = as soon as possible), result_timeout = seconds to wait for the members
+# before the result of a group command is published
+GroupSettings = namedtuple("GroupSettings", ["groups", "start_delay", "result_timeout"], defaults=[None, 0, 10])
+
+
+def get_member_topic(topic, device_name):
+    """
+    Device command of a group command, e.g. chromecast/_group/floor/command/player_state ->
+    chromecast/device_name/command/player_state.
+    """
+    return "chromecast/%s/command/%s" % (device_name, topic.rsplit("/", 1)[1])
+
+
+class GroupChangesCallback(MqttChangesCallback):
+    """
+    Passes the changes requested by a group command to the members, each with the trace of its member command.
+    """
+
+    def __init__(self):
+        # (device connection, trace) of the command currently dispatched
+        self.targets = []
+
+    def _dispatch(self, request):
+        for connection, trace in self.targets:
+            connection.handle_request(request, trace)
+
+    def on_volume_mute_requested(self, is_muted):
+        self._dispatch(lambda connection: connection.on_volume_mute_requested(is_muted))
+
+    def on_volume_level_relative_requested(self, relative_value):
+        self._dispatch(lambda connection: connection.on_volume_level_relative_requested(relative_value))
+
+    def on_volume_level_absolute_requested(self, absolute_value):
+        self._dispatch(lambda connection: connection.on_volume_level_absolute_requested(absolute_value))
+
+    def on_player_position_requested(self, position):
+        self._dispatch(lambda connection: connection.on_player_position_requested(position))
+
+    def on_player_play_stream_requested(self, *args, **kwargs):
+        self._dispatch(lambda connection: connection.on_player_play_stream_requested(*args, **kwargs))
+
+    def on_player_pause_requested(self):
+        self._dispatch(lambda connection: connection.on_player_pause_requested())
+
+    def on_player_resume_requested(self):
+        self._dispatch(lambda connection: connection.on_player_resume_requested())
+
+    def on_player_stop_requested(self):
+        self._dispatch(lambda connection: connection.on_player_stop_requested())
+
+    def on_player_skip_requested(self):
+        self._dispatch(lambda connection: connection.on_player_skip_requested())
+
+    def on_player_rewind_requested(self):
+        self._dispatch(lambda connection: connection.on_player_rewind_requested())
+
+    def on_player_previous_requested(self):
+        self._dispatch(lambda connection: connection.on_player_previous_requested())
+
+    def on_player_next_requested(self):
+        self._dispatch(lambda connection: connection.on_player_next_requested())
+
+
+class DeviceGroup:
+    """
+    Devices addressed together by chromecast/_group/<name>/command/..., a command is parsed once for all members.
+    """
+
+    def __init__(self, mqtt_connection, name, member_names):
+        self.name = name
+        self.member_names = member_names
+
+        self.changes_callback = GroupChangesCallback()
+        self.mqtt_properties = MqttPropertyHandler(mqtt_connection, "_group/%s" % name, self.changes_callback)
+
+    def dispatch(self, topic, payload, targets):
+        """
+        Queue a group command at every target (device connection, trace of the member command) without waiting for
+        the devices.
+        """
+        self.changes_callback.targets = targets
+        try:
+            self.mqtt_properties.handle_message(topic, payload)
+        finally:
+            self.changes_callback.targets = []
+
+        for _, trace in targets:
+            if not trace.has_hop(HOP_QUEUED):
+                trace.finish(RESULT_INVALID, "no command for payload")
+
+
+class GroupCommand:
+    """
+    Results of a group command. The result is published to chromecast/_group/<group>/result once all member commands
+    have finished or result_timeout seconds after the start time (kept by the timeout scheduler), members still running
+    are reported as pending. The trace of the group command (if any) is finished along with it, its reply contains the
+    results of the members.
+    """
+
+    def __init__(self, mqtt_connection, group_name, topic, member_names, forwarded_members, trace, start_at,
+                 result_timeout, timeout_scheduler):
+        self.logger = logging.getLogger("group")
+        self.mqtt = mqtt_connection
+        self.group_name = group_name
+        self.topic = topic
+        self.trace = trace
+
+        # device name -> instance the member command has been forwarded to, see [cluster]
+        self.forwarded_members = forwarded_members
+
+        # the member commands share the correlation id of the group command
+        self.correlation_id = trace.correlation_id if trace is not None else uuid4().hex[:16]
+        expires_at = trace.expires_at if trace is not None else None
+
+        self.member_traces = {}
+        for device_name in member_names:
+            self.member_traces[device_name] = CommandTrace(get_member_topic(topic, device_name), self.correlation_id,
+                                                           finished_callback=self._on_member_finished,
+                                                           expires_at=expires_at, start_at=start_at)
+
+        self.lock = Lock()
+        self.finished_count = 0
+        self.is_published = False
+
+        self.start_at = start_at
+        self.result_timeout = result_timeout
+        self.timeout_scheduler = timeout_scheduler
+        self.timeout = None
+
+    def start(self):
+        """
+        Wait for the member commands, called after they have been queued.
+        """
+        with self.lock:
+            is_complete = self.finished_count == len(self.member_traces)
+
+            if not is_complete:
+                delay = self.result_timeout
+                if self.start_at is not None:
+                    delay += max(0, self.start_at - time())
+
+                self.timeout = self.timeout_scheduler.call_later(delay, self._publish_result)
+
+        if is_complete:
+            self._publish_result()
+
+    def _on_member_finished(self, trace):
+        with self.lock:
+            self.finished_count += 1
+            is_complete = self.finished_count == len(self.member_traces)
+
+        if is_complete:
+            self._publish_result()
+
+    def _publish_result(self):
+        with self.lock:
+            if self.is_published:
+                return
+
+            self.is_published = True
+            timeout = self.timeout
+
+        if timeout is not None:
+            self.timeout_scheduler.cancel(timeout)
+
+        members = {}
+        for device_name, trace in self.member_traces.items():
+            members[device_name] = {"result": trace.result or RESULT_PENDING, "timings": trace.get_timings()}
+
+            if trace.error is not None:
+                members[device_name]["error"] = trace.error
+
+        for device_name, instance_id in self.forwarded_members.items():
+            members[device_name] = {"result": RESULT_FORWARDED, "instance": instance_id}
+
+        member_results = set(member["result"] for member in members.values())
+        if len(member_results) == 0:
+            result = RESULT_OK
+        elif len(member_results) == 1:
+            result = member_results.pop()
+        else:
+            result = RESULT_PARTIAL
+
+        self.logger.info("group command %s to %s: %s" % (self.correlation_id, self.topic, result))
+
+        document = {"correlation_id": self.correlation_id, "group": self.group_name, "topic": self.topic,
+                    "result": result, "members": members}
+        self.mqtt.send_reply(TOPIC_GROUP_RESULT % self.group_name, dumps(document, sort_keys=True))
+
+        if self.trace is not None:
+            self.trace.members = members
+            self.trace.finish(result)
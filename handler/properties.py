@@ -1,7 +1,14 @@
 import logging
-from json import loads
+from collections import namedtuple
+from contextlib import contextmanager
+from json import loads, dumps
+from time import time
 import mimetypes
 
+from pychromecast.controllers.media import MEDIA_PLAYER_STATE_PLAYING
+
+from helper import metrics
+
 # only used for publishing
 TOPIC_FRIENDLY_NAME = "chromecast/%s/friendly_name"
 TOPIC_MODEL_NAME = "chromecast/%s/model_name"
@@ -11,6 +18,8 @@ TOPIC_CAST_TYPE = "chromecast/%s/cast_type"
 TOPIC_CURRENT_APP = "chromecast/%s/current_app"
 TOPIC_PLAYER_DURATION = "chromecast/%s/player_duration"
 TOPIC_PLAYER_POSITION = "chromecast/%s/player_position"
+TOPIC_PLAYER_POSITION_UPDATED_AT = "chromecast/%s/player_position_updated_at"
+TOPIC_PLAYER_PLAYBACK_RATE = "chromecast/%s/player_playback_rate"
 TOPIC_PLAYER_STATE = "chromecast/%s/player_state"
 TOPIC_VOLUME_LEVEL = "chromecast/%s/volume_level"
 TOPIC_VOLUME_MUTED = "chromecast/%s/volume_muted"
@@ -22,6 +31,25 @@ TOPIC_MEDIA_TRACK = "chromecast/%s/media/track"
 TOPIC_MEDIA_IMAGES = "chromecast/%s/media/images"
 TOPIC_MEDIA_CONTENT_TYPE = "chromecast/%s/media/content_type"
 TOPIC_MEDIA_CONTENT_URL = "chromecast/%s/media/content_url"
+# aggregated json document of all of the above
+TOPIC_STATE = "chromecast/%s/state"
+# reason why the last command was not executed
+TOPIC_COMMAND_ERROR = "chromecast/%s/command_error"
+
+# every topic published per device, filtered by the write filter
+PUBLISHED_TOPICS = (TOPIC_FRIENDLY_NAME, TOPIC_MODEL_NAME, TOPIC_ADDRESS, TOPIC_CONNECTION_STATUS, TOPIC_CAST_TYPE,
+                    TOPIC_CURRENT_APP, TOPIC_PLAYER_DURATION, TOPIC_PLAYER_POSITION, TOPIC_PLAYER_POSITION_UPDATED_AT,
+                    TOPIC_PLAYER_PLAYBACK_RATE, TOPIC_PLAYER_STATE, TOPIC_VOLUME_LEVEL, TOPIC_VOLUME_MUTED,
+                    TOPIC_MEDIA_TITLE, TOPIC_MEDIA_ALBUM_NAME, TOPIC_MEDIA_ARTIST, TOPIC_MEDIA_ALBUM_ARTIST,
+                    TOPIC_MEDIA_TRACK, TOPIC_MEDIA_IMAGES, TOPIC_MEDIA_CONTENT_TYPE, TOPIC_MEDIA_CONTENT_URL)
+
+# topic filters of the values changing most often, published with a topic alias (mqtt 5)
+HIGH_FREQUENCY_TOPICS = (TOPIC_PLAYER_POSITION % "+", TOPIC_PLAYER_POSITION_UPDATED_AT % "+", TOPIC_PLAYER_STATE % "+",
+                         TOPIC_VOLUME_LEVEL % "+", TOPIC_STATE % "+")
+
+# published by the connector itself, names starting with an underscore are not used for devices
+TOPIC_CONNECTOR_STARTUP = "chromecast/_connector/startup"
+TOPIC_CONNECTOR_METRICS = "chromecast/_connector/metrics"
 
 # subscribe
 TOPIC_COMMAND_VOLUME_LEVEL = "chromecast/%s/command/volume_level"
@@ -29,6 +57,12 @@ TOPIC_COMMAND_VOLUME_MUTED = "chromecast/%s/command/volume_muted"
 TOPIC_COMMAND_PLAYER_POSITION = "chromecast/%s/command/player_position"
 TOPIC_COMMAND_PLAYER_STATE = "chromecast/%s/command/player_state"
 
+# commands to all members of a group (group name, command name) and their results
+TOPIC_GROUP_COMMAND = "chromecast/_group/%s/command/%s"
+TOPIC_GROUP_RESULT = "chromecast/_group/%s/result"
+
+TOPIC_PREFIX = "chromecast/"
+
 STATE_REQUEST_RESUME = "RESUME"
 STATE_REQUEST_PAUSE = "PAUSE"
 STATE_REQUEST_STOP = "STOP"
@@ -40,6 +74,53 @@ STATE_REQUEST_NEXT = "NEXT"
 
 # play stream has another syntax, not listed here therefore
 
+# kind = topic (single property) or state (json document), result = published or filtered
+WRITES = metrics.counter("chromecast_mqtt_writes_total", "Property writes, published or filtered as unchanged",
+                         ["kind", "result"])
+
+# seconds the reported position may deviate from the interpolated one before it is treated as seek
+POSITION_INTERPOLATION_TOLERANCE = 1
+
+# topics = publish every property to its own topic, state = publish all properties as one json document,
+# position_* = publish policy of the player position, see PlayerPositionFilter
+PublishSettings = namedtuple("PublishSettings", ["topics", "state", "position_min_interval", "position_min_change",
+                                                 "position_interpolation"], defaults=[True, False, 0, 0, False])
+
+
+def get_device_name_from_topic(topic):
+    """
+    Extract the device name (= friendly name) from a topic like chromecast/my_device_name/command/player_state.
+    Returns None if the topic is not addressing a device.
+    """
+    if not topic.startswith(TOPIC_PREFIX):
+        return None
+
+    end = topic.find("/", len(TOPIC_PREFIX))
+    if end == -1:
+        return None
+
+    return topic[len(TOPIC_PREFIX):end]
+
+
+def get_group_name_from_topic(topic):
+    """
+    Extract the group name from a topic like chromecast/_group/my_group/command/player_state. Returns None if the
+    topic is not addressing a group.
+    """
+    parts = topic.split("/")
+    if len(parts) != 5 or TOPIC_GROUP_COMMAND % (parts[2], parts[4]) != topic:
+        return None
+
+    return parts[2]
+
+
+def is_command_topic(topic):
+    """
+    Check if a topic is a command topic like chromecast/my_device_name/command/player_state.
+    """
+    parts = topic.split("/")
+    return len(parts) == 4 and parts[2] == "command"
+
 
 class MqttChangesCallback:
     def on_volume_mute_requested(self, is_muted):
@@ -79,22 +160,91 @@ class MqttChangesCallback:
         pass
 
 
+def get_state_field_name(topic):
+    """
+    Name of a property in the json state document, e.g. chromecast/%s/media/title -> media_title.
+    """
+    return topic.split("/", 2)[2].replace("/", "_")
+
+
+class PlayerPositionFilter:
+    """
+    Decides if a player position has to be published. The position changes with every media status while playing,
+    so without a filter it is by far the noisiest topic.
+
+    Without interpolation, a position is only published if it has changed by at least position_min_change seconds
+    and the last published position is at least position_min_interval seconds old. With interpolation, position,
+    update time and playback rate are published together so that consumers can calculate the current position on
+    their own. The position is then only published again if the player state or playback rate has changed or if
+    the position does not match the interpolated one anymore (= seek).
+    """
+
+    def __init__(self, publish_settings):
+        self.settings = publish_settings
+        self.published = None
+
+    def should_publish(self, state, position, playback_rate, updated_at):
+        if position is None or self.published is None or self._is_changed(state, position, playback_rate, updated_at):
+            self.published = (state, position, playback_rate, updated_at)
+            return True
+
+        return False
+
+    def _is_changed(self, state, position, playback_rate, updated_at):
+        published_state, published_position, published_playback_rate, published_at = self.published
+
+        if state != published_state or playback_rate != published_playback_rate or published_position is None:
+            return True
+
+        elapsed = updated_at - published_at
+
+        if self.settings.position_interpolation:
+            expected_position = published_position
+            if state == MEDIA_PLAYER_STATE_PLAYING:
+                expected_position += elapsed * (published_playback_rate or 1)
+
+            tolerance = max(self.settings.position_min_change, POSITION_INTERPOLATION_TOLERANCE)
+            return abs(position - expected_position) >= tolerance
+
+        return abs(position - published_position) >= self.settings.position_min_change \
+            and elapsed >= self.settings.position_min_interval
+
+
 class MqttPropertyHandler:
-    def __init__(self, mqtt_connection, mqtt_topic_filter, changes_callback):
+    def __init__(self, mqtt_connection, mqtt_topic_filter, changes_callback, publish_settings=PublishSettings(),
+                 retained_values=None):
         self.logger = logging.getLogger("mqtt")
         self.mqtt = mqtt_connection
         self.topic_filter = mqtt_topic_filter
         self.changes_callback = changes_callback
+        self.publish_settings = publish_settings
+        self.position_filter = PlayerPositionFilter(publish_settings)
+
+        # last written value per topic, keyed by the (shared) topic template instead of the formatted topic, so that
+        # the filter is bounded by PUBLISHED_TOPICS
         self.write_filter = {}
 
+        # properties of the json state document and the last published document
+        self.state = {}
+        self.state_published = None
+        self.state_update_depth = 0
+
+        if retained_values is not None:
+            self.prime_write_filter(retained_values)
+
+        # precompiled command table, avoids formatting and comparing every command topic per message
+        self.command_handlers = {
+            TOPIC_COMMAND_VOLUME_MUTED % mqtt_topic_filter: self.handle_volume_mute_change,
+            TOPIC_COMMAND_VOLUME_LEVEL % mqtt_topic_filter: self.handle_volume_level_change,
+            TOPIC_COMMAND_PLAYER_POSITION % mqtt_topic_filter: self.handle_player_position_change,
+            TOPIC_COMMAND_PLAYER_STATE % mqtt_topic_filter: self.handle_player_state_change,
+        }
+
     def is_topic_filter_matching(self, topic):
         """
         Check if a topic (e.g.: chromecast/my_device_name/player_state) matches our filter (the name part).
         """
-        try:
-            return topic.split("/")[1] == self.topic_filter
-        except IndexError:
-            return False
+        return get_device_name_from_topic(topic) == self.topic_filter
 
     def _write(self, topic, value):
         # noinspection PyBroadException
@@ -114,26 +264,112 @@ class MqttPropertyHandler:
             else:
                 value = str(value)
 
-            formatted_topic = topic % self.topic_filter
+            if self.publish_settings.state:
+                self.state[get_state_field_name(topic)] = value
+
+            if not self.publish_settings.topics:
+                return
 
             # filter to prevent writing the same value again until it has changed
-            if formatted_topic in self.write_filter and self.write_filter[formatted_topic] == value:
+            if topic in self.write_filter and self.write_filter[topic] == value:
+                WRITES.inc("topic", "filtered")
                 return
 
-            self.write_filter[formatted_topic] = value
-            self.mqtt.send_message(formatted_topic, value)
+            WRITES.inc("topic", "published")
+            self.write_filter[topic] = value
+            self.mqtt.send_message(topic % self.topic_filter, value)
         except Exception:
             self.logger.exception("value conversion error")
 
+    def prime_write_filter(self, retained_values):
+        """
+        Fill the write filter with the values retained by the broker (formatted topic -> payload), so that values
+        which are already known by the broker are not published again.
+        """
+        templates = {topic % self.topic_filter: topic for topic in PUBLISHED_TOPICS}
+
+        for formatted_topic, value in retained_values.items():
+            if formatted_topic == TOPIC_STATE % self.topic_filter:
+                # noinspection PyBroadException
+                try:
+                    self.state = loads(value)
+                    self.state_published = value
+                except Exception:
+                    self.logger.warning("ignoring invalid retained state of %s" % self.topic_filter)
+            elif formatted_topic in templates:
+                self.write_filter[templates[formatted_topic]] = value
+
+        self.logger.debug("primed write filter of %s with %d retained values" %
+                          (self.topic_filter, len(self.write_filter)))
+
+    def clear_write_filter(self):
+        """
+        Free the written values, e.g. if the device has been unregistered.
+        """
+        self.write_filter.clear()
+        self.state.clear()
+        self.state_published = None
+        self.position_filter = PlayerPositionFilter(self.publish_settings)
+
+    def clear_retained(self):
+        """
+        Remove all retained topics of the device from the broker, e.g. because the device has been removed.
+        """
+        topics = [topic % self.topic_filter for topic in PUBLISHED_TOPICS + (TOPIC_STATE, TOPIC_COMMAND_ERROR)]
+        self.mqtt.clear_topics(topics)
+        self.clear_write_filter()
+
+    def _write_state(self):
+        """
+        Publish the json state document, but only if a property has changed since it has been published last.
+        """
+        if not self.publish_settings.state or self.state_update_depth > 0:
+            return
+
+        document = dumps(self.state, sort_keys=True, separators=(",", ":"))
+        if document == self.state_published:
+            WRITES.inc("state", "filtered")
+            return
+
+        WRITES.inc("state", "published")
+        self.state_published = document
+        self.mqtt.send_message(TOPIC_STATE % self.topic_filter, document)
+
+    @contextmanager
+    def update(self):
+        """
+        Group several write_* calls belonging to the same status update, so that the json state document is only
+        published once at the end.
+        """
+        self.state_update_depth += 1
+        try:
+            yield
+        finally:
+            self.state_update_depth -= 1
+            self._write_state()
+
     def write_cast_status(self, app_name, volume_level, is_volume_muted):
         self._write(TOPIC_CURRENT_APP, app_name)
         self._write(TOPIC_VOLUME_LEVEL, volume_level)
         self._write(TOPIC_VOLUME_MUTED, is_volume_muted)
+        self._write_state()
+
+    def write_player_status(self, state, current_time, duration, playback_rate=None, updated_at=None):
+        if updated_at is None:
+            updated_at = time()
 
-    def write_player_status(self, state, current_time, duration):
         self._write(TOPIC_PLAYER_STATE, state)
-        self._write(TOPIC_PLAYER_POSITION, current_time)
+
+        if self.position_filter.should_publish(state, current_time, playback_rate, updated_at):
+            self._write(TOPIC_PLAYER_POSITION, current_time)
+
+            if self.publish_settings.position_interpolation:
+                # written as strings, floats would be treated as volume by _write
+                self._write(TOPIC_PLAYER_POSITION_UPDATED_AT, "%.3f" % updated_at)
+                self._write(TOPIC_PLAYER_PLAYBACK_RATE, "" if playback_rate is None else "%g" % playback_rate)
+
         self._write(TOPIC_PLAYER_DURATION, duration)
+        self._write_state()
 
     def write_media_status(self, title, album_name, artist, album_artist, track, images, content_type, content_id):
         self._write(TOPIC_MEDIA_TITLE, title)
@@ -144,33 +380,37 @@ class MqttPropertyHandler:
         self._write(TOPIC_MEDIA_IMAGES, images)
         self._write(TOPIC_MEDIA_CONTENT_TYPE, content_type)
         self._write(TOPIC_MEDIA_CONTENT_URL, content_id)
+        self._write_state()
 
     def write_connection_info(self, device_name, model_name, ip_address, port):
         self._write(TOPIC_FRIENDLY_NAME, device_name)
         self._write(TOPIC_MODEL_NAME, model_name)
         self._write(TOPIC_ADDRESS, "%s:%d" % (ip_address, port))
+        self._write_state()
 
     def write_connection_status(self, status):
         self._write(TOPIC_CONNECTION_STATUS, status)
+        self._write_state()
 
     def write_cast_data(self, cast_type, friendly_name):
         self._write(TOPIC_CAST_TYPE, cast_type)
         self._write(TOPIC_FRIENDLY_NAME, friendly_name)
+        self._write_state()
+
+    def write_command_error(self, message):
+        # not filtered, the same error can happen again
+        self.mqtt.send_message(TOPIC_COMMAND_ERROR % self.topic_filter, message)
 
     def handle_message(self, topic, payload):
+        handler = self.command_handlers.get(topic)
+        if handler is None:
+            self.logger.warning("no command handler found for topic %s" % topic)
+            return
+
         if isinstance(payload, bytes):
             payload = payload.decode('utf-8')
 
-        payload = str(payload).strip()
-
-        if TOPIC_COMMAND_VOLUME_MUTED % self.topic_filter == topic:
-            self.handle_volume_mute_change(payload)
-        elif TOPIC_COMMAND_VOLUME_LEVEL % self.topic_filter == topic:
-            self.handle_volume_level_change(payload)
-        elif TOPIC_COMMAND_PLAYER_POSITION % self.topic_filter == topic:
-            self.handle_player_position_change(payload)
-        elif TOPIC_COMMAND_PLAYER_STATE % self.topic_filter == topic:
-            self.handle_player_state_change(payload)
+        handler(str(payload).strip())
 
     def handle_volume_mute_change(self, payload):
         """
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, get_ident
+
+from paho.mqtt import client
+
+
+class AsyncRuntime:
+    """
+    asyncio event loop serving the processing queues (lanes) of the event handler and of all devices, used instead of
+    the worker threads. Provides the same schedule() interface as the WorkerPool. The pychromecast API is blocking, so
+    device lanes are bridged through a bounded executor and the number of threads does not grow with the devices.
+    """
+
+    def __init__(self, executor_size, batch_size=10):
+        self.logger = logging.getLogger("aio")
+        self.batch_size = batch_size
+        self.executor_size = executor_size
+
+        self.loop = asyncio.new_event_loop()
+        # only used for the device lanes, the default executor of the loop is left alone
+        self.executor = ThreadPoolExecutor(executor_size, thread_name_prefix="aio-executor")
+
+        self.scheduled_lanes = set()
+        self.lock = Lock()
+
+        self.loop_thread = Thread(target=self._run, name="aio-loop")
+        self.loop_thread.daemon = True
+
+    def start(self):
+        self.loop_thread.start()
+        self.logger.info("started event loop with an executor of %d threads" % self.executor_size)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.executor.shutdown(wait=False)
+
+    def join(self):
+        """
+        Block until the event loop has been stopped.
+        """
+        self.loop_thread.join()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run_coroutine(self, coroutine):
+        """
+        Run a coroutine on the event loop, can be called from any thread. Returns a concurrent.futures.Future.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call_soon(self, callback, *args):
+        """
+        Call a function on the event loop, can be called from any thread.
+        """
+        if self.loop_thread.ident is not None and self.loop_thread.ident == get_ident():
+            self.loop.call_soon(callback, *args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def schedule(self, lane, blocking=True):
+        """
+        Mark a lane as having pending items. Lanes which are already scheduled or running are not queued twice. Lanes
+        which might block (e.g. calls to the device) are processed in the executor, all others on the event loop.
+        """
+
+        with self.lock:
+            if lane in self.scheduled_lanes:
+                return
+
+            self.scheduled_lanes.add(lane)
+
+        self.call_soon(self._start_lane, lane, blocking)
+
+    def _start_lane(self, lane, blocking):
+        self.loop.create_task(self._run_lane(lane, blocking))
+
+    async def _run_lane(self, lane, blocking):
+        # noinspection PyBroadException
+        try:
+            # process only a batch, so that a busy lane does not starve the others
+            if blocking:
+                await self.loop.run_in_executor(self.executor, lane.process_pending, self.batch_size)
+            else:
+                lane.process_pending(self.batch_size)
+        except Exception:
+            self.logger.exception("processing lane %s failed" % (lane,))
+        finally:
+            with self.lock:
+                self.scheduled_lanes.discard(lane)
+
+            # items might have been added while the lane was running, schedule() ignored them in that case
+            if lane.has_pending():
+                self.schedule(lane, blocking)
+
+
+class MqttNetworkLoop:
+    """
+    Drives the network I/O of a paho client from the event loop of an AsyncRuntime instead of the network thread of
+    paho (loop_start()). paho does not reconnect by itself in this mode, this is done here as well, using an own
+    thread so that busy device lanes cannot delay it.
+    """
+
+    def __init__(self, runtime, mqtt_client, reconnect_delay=5):
+        self.logger = logging.getLogger("aio")
+        self.runtime = runtime
+        self.mqtt = mqtt_client
+        self.reconnect_delay = reconnect_delay
+
+        self.is_running = False
+        self.misc_future = None
+        self.reconnect_executor = ThreadPoolExecutor(1, thread_name_prefix="aio-mqtt-reconnect")
+
+        self.mqtt.on_socket_open = self._on_socket_open
+        self.mqtt.on_socket_close = self._on_socket_close
+        self.mqtt.on_socket_register_write = self._on_socket_register_write
+        self.mqtt.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def start(self):
+        self.is_running = True
+        self.misc_future = self.runtime.run_coroutine(self._misc_loop())
+
+    def stop(self):
+        self.is_running = False
+        if self.misc_future is not None:
+            self.misc_future.cancel()
+
+        self.reconnect_executor.shutdown(wait=False)
+
+    # the socket callbacks are invoked by any thread calling into paho, e.g. a device publishing a status
+    def _on_socket_open(self, client, userdata, sock):
+        self.runtime.call_soon(self.runtime.loop.add_reader, sock, self._on_readable)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.runtime.call_soon(self.runtime.loop.remove_reader, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.runtime.call_soon(self.runtime.loop.add_writer, sock, self._on_writable)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.runtime.call_soon(self.runtime.loop.remove_writer, sock)
+
+    def _on_readable(self):
+        self.mqtt.loop_read()
+
+    def _on_writable(self):
+        self.mqtt.loop_write()
+
+    async def _misc_loop(self):
+        while self.is_running:
+            if self.mqtt.loop_misc() == client.MQTT_ERR_NO_CONN:
+                self.logger.debug("mqtt connection lost, reconnecting")
+
+                try:
+                    # connecting blocks until the tcp connection has been established
+                    await self.runtime.loop.run_in_executor(self.reconnect_executor, self.mqtt.reconnect)
+                except (ConnectionError, OSError):
+                    self.logger.warning("reconnecting to mqtt failed, retrying in %d seconds" % self.reconnect_delay)
+                    await asyncio.sleep(self.reconnect_delay)
+                    continue
+
+            await asyncio.sleep(1)
@@ -0,0 +1,207 @@
+import logging
+from bisect import bisect
+from hashlib import md5
+from json import dumps, loads
+from threading import Thread, Event, Lock
+from time import time, sleep
+
+from helper import metrics
+
+# every instance publishes its lease (retained) to its own topic, the broker clears it via the last will
+TOPIC_CLUSTER_MEMBER = "chromecast/_cluster/members/%s"
+TOPIC_CLUSTER_MEMBERS = TOPIC_CLUSTER_MEMBER % "+"
+# commands received by an instance which does not own the device (shared subscriptions) are forwarded to the owner,
+# followed by the topic of the command
+TOPIC_CLUSTER_FORWARD = "chromecast/_cluster/forward/%s/"
+
+CLUSTER_CHANGES = metrics.counter("chromecast_cluster_changes_total", "Changes of the connector instances")
+
+
+def _hash(value):
+    return int(md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hashing of device names onto instances. Every instance is placed virtual_nodes times on the ring, so
+    that only the devices of an instance which joins or leaves are moved.
+    """
+
+    def __init__(self, members, virtual_nodes=64):
+        points = sorted((_hash("%s#%d" % (member, index)), member)
+                        for member in members for index in range(virtual_nodes))
+
+        self.members = frozenset(members)
+        self.hashes = [point for point, _ in points]
+        self.owners = [member for _, member in points]
+
+    def get_owner(self, key):
+        if len(self.owners) == 0:
+            return None
+
+        return self.owners[bisect(self.hashes, _hash(key)) % len(self.owners)]
+
+
+class ClusterCallback:
+
+    def on_cluster_changed(self):
+        pass
+
+
+class ClusterMembership:
+    """
+    Membership of this connector instance in a cluster of instances sharing the devices. Every instance renews a
+    retained lease on chromecast/_cluster/members/<instance id> every lease_duration / 3 seconds. A lease is removed
+    by the last will of an instance which lost its connection, by the instance itself on shutdown or by the other
+    instances once they have not received a renewal for lease_duration seconds (measured with their own clock only).
+    The devices are assigned to the instances with a HashRing of the friendly names.
+    """
+
+    def __init__(self, mqtt_connection, instance_id, callback, lease_duration=15, virtual_nodes=64):
+        self.logger = logging.getLogger("cluster")
+        self.mqtt = mqtt_connection
+        self.instance_id = instance_id
+        self.callback = callback
+        self.lease_duration = lease_duration
+        self.virtual_nodes = virtual_nodes
+
+        # instance id -> local time the lease has been received last (the clocks of the hosts may differ, so the time
+        # published with the lease is not used)
+        self.members = {}
+        self.lock = Lock()
+        self.ring = HashRing([instance_id], virtual_nodes)
+
+        self.stopped = Event()
+        self.heartbeat_thread = Thread(target=self._worker, name="cluster-heartbeat")
+        self.heartbeat_thread.daemon = True
+
+        # the lease of an instance which lost its connection is removed by the broker
+        self.mqtt.set_will(TOPIC_CLUSTER_MEMBER % instance_id, "")
+
+        metrics.gauge("chromecast_cluster_members", "Connector instances sharing the devices", (),
+                      lambda: {(): len(self.ring.members)})
+
+    def start(self, join_duration):
+        """
+        Publish the lease and wait join_duration seconds for the leases of the other instances, the devices should be
+        added afterwards.
+        """
+        self.logger.info("joining cluster as %s" % self.instance_id)
+        self._publish_lease()
+        self.heartbeat_thread.start()
+
+        sleep(join_duration)
+        self.logger.info("cluster members: %s" % ", ".join(sorted(self.ring.members)))
+
+    def stop(self):
+        """
+        Leave the cluster, the devices of this instance are taken over by the others right away.
+        """
+        self.stopped.set()
+        self.mqtt.send_message(TOPIC_CLUSTER_MEMBER % self.instance_id, "")
+
+    def is_owner(self, device_name):
+        return self.ring.get_owner(device_name) == self.instance_id
+
+    def get_owner(self, device_name):
+        return self.ring.get_owner(device_name)
+
+    def on_mqtt_connected(self, client):
+        client.subscribe(TOPIC_CLUSTER_MEMBERS)
+        client.subscribe_command(TOPIC_CLUSTER_FORWARD % self.instance_id + "#")
+
+        # the lease might have been removed by the last will while disconnected
+        if not self.stopped.is_set():
+            self._publish_lease()
+
+    def is_cluster_topic(self, topic):
+        return topic.startswith(TOPIC_CLUSTER_MEMBER % "")
+
+    def get_forward_topic(self, instance_id, topic):
+        return TOPIC_CLUSTER_FORWARD % instance_id + topic
+
+    def get_forwarded_topic(self, topic):
+        """
+        Returns the topic of a command forwarded to this instance, None if the topic is no forwarded command.
+        """
+        prefix = TOPIC_CLUSTER_FORWARD % self.instance_id
+        if not topic.startswith(prefix):
+            return None
+
+        return topic[len(prefix):]
+
+    def handle_message(self, topic, payload):
+        """
+        Called for every lease published, runs in the network thread of the mqtt connection.
+        """
+        instance_id = topic[len(TOPIC_CLUSTER_MEMBER % ""):]
+
+        if instance_id == self.instance_id:
+            # removed by another instance or by the last will of an earlier run
+            if len(payload) == 0 and not self.stopped.is_set():
+                self.logger.warning("lease of this instance has been removed, renewing it")
+                self._publish_lease()
+            return
+
+        if len(payload) == 0:
+            self._remove_members([instance_id])
+            return
+
+        try:
+            lease = loads(payload)
+        except ValueError:
+            lease = None
+
+        if not isinstance(lease, dict) or "instance_id" not in lease:
+            self.logger.warning("ignoring invalid lease of instance %s" % instance_id)
+            return
+
+        # leases of dead instances stay retained until they are removed, e.g. if the last will got lost: such a lease
+        # is not renewed and expires lease_duration seconds after it has been received
+        with self.lock:
+            is_new = instance_id not in self.members
+            self.members[instance_id] = time()
+
+        if is_new:
+            self.logger.info("instance %s has joined the cluster" % instance_id)
+            self._update_ring()
+
+    def _publish_lease(self):
+        lease = {"instance_id": self.instance_id, "renewed_at": time(), "lease_duration": self.lease_duration}
+        self.mqtt.send_message(TOPIC_CLUSTER_MEMBER % self.instance_id, dumps(lease, sort_keys=True))
+
+    def _remove_members(self, instance_ids):
+        with self.lock:
+            removed = [instance_id for instance_id in instance_ids if self.members.pop(instance_id, None) is not None]
+
+        if len(removed) == 0:
+            return
+
+        self.logger.info("instances %s have left the cluster" % ", ".join(sorted(removed)))
+        self._update_ring()
+
+    def _update_ring(self):
+        with self.lock:
+            self.ring = HashRing([self.instance_id] + list(self.members), self.virtual_nodes)
+
+        CLUSTER_CHANGES.inc()
+        self.callback.on_cluster_changed()
+
+    def _worker(self):
+        while not self.stopped.wait(self.lease_duration / 3):
+            # noinspection PyBroadException
+            try:
+                self._publish_lease()
+
+                now = time()
+                with self.lock:
+                    expired = [instance_id for instance_id, received_at in self.members.items()
+                               if now - received_at > self.lease_duration]
+
+                for instance_id in expired:
+                    self.logger.warning("lease of instance %s has expired" % instance_id)
+                    self.mqtt.send_message(TOPIC_CLUSTER_MEMBER % instance_id, "")
+
+                self._remove_members(expired)
+            except Exception:
+                self.logger.exception("renewing the lease failed")
@@ -31,3 +31,136 @@ class Config:
 
     def get_mqtt_broker_password(self):
         return self.config.get('mqtt', 'password', fallback=None)
+
+    def get_mqtt_offline_queue_size(self):
+        return self.config.getint('mqtt', 'offline_queue_size', fallback=1000)
+
+    def get_mqtt_replay_interval(self):
+        return self.config.getfloat('mqtt', 'replay_interval', fallback=0.01)
+
+    def get_mqtt_publish_topics(self):
+        return self.config.getboolean('mqtt', 'publish_topics', fallback=True)
+
+    def get_mqtt_publish_state(self):
+        return self.config.getboolean('mqtt', 'publish_state', fallback=False)
+
+    def get_mqtt_position_min_interval(self):
+        return self.config.getfloat('mqtt', 'position_min_interval', fallback=0)
+
+    def get_mqtt_position_min_change(self):
+        return self.config.getfloat('mqtt', 'position_min_change', fallback=0)
+
+    def get_mqtt_position_interpolation(self):
+        return self.config.getboolean('mqtt', 'position_interpolation', fallback=False)
+
+    def get_mqtt_publish_startup_timeline(self):
+        return self.config.getboolean('mqtt', 'publish_startup_timeline', fallback=False)
+
+    def get_mqtt_prime_write_filter(self):
+        return self.config.getboolean('mqtt', 'prime_write_filter', fallback=False)
+
+    def get_mqtt_prime_duration(self):
+        return self.config.getfloat('mqtt', 'prime_duration', fallback=1)
+
+    def get_mqtt_clear_removed_devices(self):
+        return self.config.getboolean('mqtt', 'clear_removed_devices', fallback=False)
+
+    def get_mqtt_clear_orphaned_devices(self):
+        return self.config.getboolean('mqtt', 'clear_orphaned_devices', fallback=False)
+
+    def get_mqtt_protocol_version(self):
+        return self.config.getint('mqtt', 'protocol_version', fallback=3)
+
+    def get_mqtt_trace_commands(self):
+        return self.config.getboolean('mqtt', 'trace_commands', fallback=False)
+
+    def get_mqtt_shared_subscription_group(self):
+        return self.config.get('mqtt', 'shared_subscription_group', fallback='')
+
+    def get_mqtt_session_expiry(self):
+        return self.config.getint('mqtt', 'session_expiry', fallback=0)
+
+    def get_mqtt_command_expiry(self):
+        return self.config.getfloat('mqtt', 'command_expiry', fallback=0)
+
+    def get_mqtt_topic_aliases(self):
+        return self.config.getboolean('mqtt', 'topic_aliases', fallback=False)
+
+    def get_groups(self):
+        """
+        Groups of devices (group name -> friendly names), every option of the groups section is a group.
+        """
+        if not self.config.has_section('groups'):
+            return {}
+
+        return {name: [device_name.strip() for device_name in value.split(",") if device_name.strip()]
+                for name, value in self.config.items('groups')}
+
+    def get_group_start_delay(self):
+        return self.config.getfloat('chromecast', 'group_start_delay', fallback=0)
+
+    def get_group_result_timeout(self):
+        return self.config.getfloat('chromecast', 'group_result_timeout', fallback=10)
+
+    def get_runtime(self):
+        return self.config.get('chromecast', 'runtime', fallback='threads')
+
+    def get_worker_pool_size(self):
+        return self.config.getint('chromecast', 'worker_pool_size', fallback=0)
+
+    def get_status_coalesce_window(self):
+        return self.config.getfloat('chromecast', 'status_coalesce_window', fallback=0)
+
+    def get_queue_size(self):
+        return self.config.getint('chromecast', 'queue_size', fallback=100)
+
+    def get_status_overflow_policy(self):
+        return self.config.get('chromecast', 'status_overflow_policy', fallback="drop_oldest")
+
+    def get_command_overflow_policy(self):
+        return self.config.get('chromecast', 'command_overflow_policy', fallback="reject")
+
+    def get_command_buffer_ttl(self):
+        return self.config.getfloat('chromecast', 'command_buffer_ttl', fallback=0)
+
+    def get_reconnect_base_delay(self):
+        return self.config.getfloat('chromecast', 'reconnect_base_delay', fallback=1)
+
+    def get_reconnect_max_delay(self):
+        return self.config.getfloat('chromecast', 'reconnect_max_delay', fallback=300)
+
+    def get_reconnect_jitter(self):
+        return self.config.getfloat('chromecast', 'reconnect_jitter', fallback=0.5)
+
+    def get_max_parallel_connects(self):
+        return self.config.getint('chromecast', 'max_parallel_connects', fallback=8)
+
+    def get_device_cache_file(self):
+        return self.config.get('chromecast', 'device_cache_file', fallback="devices.json")
+
+    def get_metrics_http_address(self):
+        return self.config.get('metrics', 'http_address', fallback='127.0.0.1')
+
+    def get_metrics_http_port(self):
+        return self.config.getint('metrics', 'http_port', fallback=0)
+
+    def get_metrics_mqtt_interval(self):
+        return self.config.getfloat('metrics', 'mqtt_interval', fallback=0)
+
+    def get_recording_file(self):
+        return self.config.get('recording', 'file', fallback='')
+
+    def get_cluster_enabled(self):
+        return self.config.getboolean('cluster', 'enabled', fallback=False)
+
+    def get_cluster_instance_id(self):
+        return self.config.get('cluster', 'instance_id', fallback='')
+
+    def get_cluster_lease_duration(self):
+        return self.config.getfloat('cluster', 'lease_duration', fallback=15)
+
+    def get_cluster_join_duration(self):
+        return self.config.getfloat('cluster', 'join_duration', fallback=2)
+
+    def get_cluster_virtual_nodes(self):
+        return self.config.getint('cluster', 'virtual_nodes', fallback=64)
@@ -1,7 +1,8 @@
 import logging
 from threading import Thread, Condition
+from uuid import UUID
 
-from zeroconf import ServiceBrowser, Zeroconf
+from zeroconf import ServiceBrowser
 
 
 GOOGLE_CAST_IDENTIFIER = "_googlecast._tcp.local."
@@ -21,11 +22,13 @@ class ChromecastDiscovery(Thread):
     Original code borrowed from pychromecast discovery, adapted to run in background all the time.
     """
 
-    def __init__(self, discovery_callback):
+    def __init__(self, discovery_callback, zeroconf_service, service_cache=None):
         super().__init__()
 
         self.logger = logging.getLogger("discovery")
         self.discovery_callback = discovery_callback
+        self.zeroconf_service = zeroconf_service
+        self.service_cache = service_cache
         self.run_condition = Condition()
         self.services = {}
 
@@ -40,8 +43,8 @@ class ChromecastDiscovery(Thread):
             self.run_condition.notify_all()
 
     def run(self):
-        zeroconf = Zeroconf()
-        browser = ServiceBrowser(zeroconf, GOOGLE_CAST_IDENTIFIER, self)
+        # the zeroconf instance is shared with the device connections and therefore not closed here
+        browser = ServiceBrowser(self.zeroconf_service.get(), GOOGLE_CAST_IDENTIFIER, self)
 
         try:
             with self.run_condition:
@@ -51,7 +54,6 @@ class ChromecastDiscovery(Thread):
 
         finally:
             browser.cancel()
-            zeroconf.close()
 
     def remove_service(self, zconf, typ, name):
         """ Remove a service from the collection. """
@@ -63,9 +65,27 @@ class ChromecastDiscovery(Thread):
         self.logger.info("removing chromecast with name \"%s\"" % name)
 
         if name in self.services:
+            if self.service_cache is not None:
+                self.service_cache.invalidate(self.services[name])
+
             self.discovery_callback.on_chromecast_disappeared(self.services[name])
             self.services.pop(name, None)
 
+    def update_service(self, zconf, typ, name):
+        """ Refresh a service of the collection, e.g. because its address has changed. """
+
+        # easy filtering
+        if not name.endswith(GOOGLE_CAST_IDENTIFIER):
+            return
+
+        if name not in self.services:
+            self.add_service(zconf, typ, name)
+            return
+
+        service = self._get_service_info(zconf, typ, name)
+        if service and self.service_cache is not None:
+            self._update_service_cache(service)
+
     def add_service(self, zconf, typ, name):
         """ Add a service to the collection. """
         # easy filtering
@@ -74,6 +94,24 @@ class ChromecastDiscovery(Thread):
 
         self.logger.info("adding chromecast with name \"%s\"" % name)
 
+        service = self._get_service_info(zconf, typ, name)
+        if not service:
+            self.logger.warn("services not discovered for device")
+            return
+
+        address = service.parsed_scoped_addresses()[0]
+        model_name = self._get_property(service, 'md')
+        device_name = self._get_property(service, 'fn')
+        self.logger.info("chromecast device name \"%s\"" % device_name)
+
+        if self.service_cache is not None:
+            self._update_service_cache(service)
+
+        self.services[name] = device_name
+        self.discovery_callback.on_chromecast_appeared(device_name, model_name, address, service.port)
+
+    @staticmethod
+    def _get_service_info(zconf, typ, name):
         service = None
         tries = 0
         while service is None and tries < 4:
@@ -84,20 +122,20 @@ class ChromecastDiscovery(Thread):
                 break
             tries += 1
 
-        if not service:
-            self.logger.warn("services not discovered for device")
-            return
-
-        address = service.parsed_scoped_addresses()[0]
+        return service
 
-        def get_value(key):
-            value = service.properties.get(key.encode('utf-8'))
+    @staticmethod
+    def _get_property(service, key):
+        value = service.properties.get(key.encode('utf-8'))
+        if value is None:
+            return None
 
-            return value.decode('utf-8')
+        return value.decode('utf-8')
 
-        model_name = get_value('md')
-        device_name = get_value('fn')
-        self.logger.info("chromecast device name \"%s\"" % device_name)
+    def _update_service_cache(self, service):
+        uuid = self._get_property(service, 'id')
+        if uuid is not None:
+            uuid = UUID(uuid)
 
-        self.services[name] = device_name
-        self.discovery_callback.on_chromecast_appeared(device_name, model_name, address, service.port)
+        self.service_cache.update(self._get_property(service, 'fn'), self._get_property(service, 'md'),
+                                  service.parsed_scoped_addresses()[0], service.port, uuid)
@@ -0,0 +1,57 @@
+import logging
+from threading import Lock
+
+from zeroconf import Zeroconf
+
+
+class CountingZeroconf(Zeroconf):
+    """
+    Zeroconf instance counting the multicast queries it has sent.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.query_count = 0
+
+    def async_send(self, out, *args, **kwargs):
+        if out.is_query():
+            self.query_count += 1
+
+        return super().async_send(out, *args, **kwargs)
+
+
+class ZeroconfService:
+    """
+    Process-wide zeroconf instance shared by the discovery and all device connections, so that reconnecting devices
+    do not open their own sockets and browsers.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("mdns")
+        self.lock = Lock()
+        self.zeroconf = None
+
+    def get(self):
+        with self.lock:
+            if self.zeroconf is None:
+                self.logger.debug("creating shared zeroconf instance")
+                self.zeroconf = CountingZeroconf()
+
+            return self.zeroconf
+
+    def get_query_count(self):
+        with self.lock:
+            if self.zeroconf is None:
+                return 0
+
+            return self.zeroconf.query_count
+
+    def close(self):
+        with self.lock:
+            if self.zeroconf is None:
+                return
+
+            self.logger.debug("closing shared zeroconf instance, %d queries have been sent" %
+                              self.zeroconf.query_count)
+            self.zeroconf.close()
+            self.zeroconf = None
@@ -0,0 +1,272 @@
+import logging
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from threading import Thread, Lock, Event
+
+# upper bounds of the default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(label_names, label_values, extra_labels=()):
+    pairs = list(zip(label_names, label_values)) + list(extra_labels)
+    if len(pairs) == 0:
+        return ""
+
+    return "{%s}" % ",".join("%s=\"%s\"" % (name, _escape(value)) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of all metrics, values are kept per combination of label values.
+    """
+
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = Lock()
+        self.values = {}
+
+    def get_samples(self):
+        """
+        Returns the samples as (name, label values, extra labels, value) tuples.
+        """
+        with self.lock:
+            if len(self.label_names) == 0:
+                return [(self.name, (), (), self.values.get((), 0))]
+
+            return [(self.name, label_values, (), value) for label_values, value in sorted(self.values.items())]
+
+    def get_values(self):
+        """
+        Returns the values as dict, e.g. for publishing them as json.
+        """
+        with self.lock:
+            if len(self.label_names) == 0:
+                return self.values.get((), 0)
+
+            return {",".join(str(value) for value in label_values): value
+                    for label_values, value in sorted(self.values.items())}
+
+
+class Counter(Metric):
+
+    metric_type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge whose values are read when the metrics are collected, callback returns a dict (label values -> value).
+    """
+
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, label_names=(), callback=None):
+        Metric.__init__(self, name, documentation, label_names)
+        self.callback = callback
+
+    def get_samples(self):
+        self._update()
+        return Metric.get_samples(self)
+
+    def get_values(self):
+        self._update()
+        return Metric.get_values(self)
+
+    def _update(self):
+        values = self.callback()
+        with self.lock:
+            self.values = dict(values)
+
+
+class Histogram(Metric):
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts, total = self.values.get(label_values, ([0] * len(self.buckets), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[label_values] = (counts, total + value)
+
+    def get_samples(self):
+        samples = []
+        with self.lock:
+            for label_values, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + "_bucket", label_values, (("le", _format_value(bound)),),
+                                    cumulative))
+
+                samples.append((self.name + "_count", label_values, (), cumulative))
+                samples.append((self.name + "_sum", label_values, (), total))
+
+        return samples
+
+    def get_values(self):
+        with self.lock:
+            values = {label_values: {"count": sum(counts), "sum": total}
+                      for label_values, (counts, total) in self.values.items()}
+
+        if len(self.label_names) == 0:
+            return values.get((), {"count": 0, "sum": 0})
+
+        return {",".join(str(value) for value in label_values): value
+                for label_values, value in sorted(values.items())}
+
+
+class MetricsRegistry:
+    """
+    Collection of all metrics, rendered in the text format of Prometheus or as json document.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            # metrics are declared on module level, a second declaration returns the existing one
+            return self.metrics.setdefault(metric.name, metric)
+
+    def unregister(self, name):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=(), callback=None):
+        return self.register(Gauge(name, documentation, label_names, callback))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def _get_metrics(self):
+        with self.lock:
+            return sorted(self.metrics.values(), key=lambda metric: metric.name)
+
+    def render_text(self):
+        lines = []
+        for metric in self._get_metrics():
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.metric_type))
+
+            for name, label_values, extra_labels, value in metric.get_samples():
+                lines.append("%s%s %s" % (name, _format_labels(metric.label_names, label_values, extra_labels),
+                                          _format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def render_json(self):
+        return dumps({metric.name: metric.get_values() for metric in self._get_metrics()}, sort_keys=True)
+
+
+# registry used by the connector, metrics are declared by the modules using them
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, documentation, label_names=()):
+    return REGISTRY.counter(name, documentation, label_names)
+
+
+def gauge(name, documentation, label_names=(), callback=None):
+    return REGISTRY.gauge(name, documentation, label_names, callback)
+
+
+def histogram(name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, documentation, label_names, buckets)
+
+
+class MetricsServer:
+    """
+    Plain http server providing the metrics at /metrics in the text format of Prometheus.
+    """
+
+    def __init__(self, address, port, registry=REGISTRY):
+        self.logger = logging.getLogger("metrics")
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.render_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, message_format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+
+        self.server_thread = Thread(target=self.server.serve_forever, name="metrics-server")
+        self.server_thread.daemon = True
+
+    def start(self):
+        self.server_thread.start()
+        self.logger.info("serving metrics at http://%s:%d/metrics" % self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsPublisher:
+    """
+    Publishes the metrics as json document to an mqtt topic periodically.
+    """
+
+    def __init__(self, mqtt_connection, topic, interval, registry=REGISTRY):
+        self.logger = logging.getLogger("metrics")
+        self.mqtt = mqtt_connection
+        self.topic = topic
+        self.interval = interval
+        self.registry = registry
+
+        self.stopped = Event()
+        self.publisher_thread = Thread(target=self._worker, name="metrics-publisher")
+        self.publisher_thread.daemon = True
+
+    def start(self):
+        self.publisher_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _worker(self):
+        while not self.stopped.wait(self.interval):
+            # noinspection PyBroadException
+            try:
+                self.mqtt.send_message(self.topic, self.registry.render_json())
+            except Exception:
+                self.logger.exception("publishing metrics failed")
@@ -1,32 +1,88 @@
+from collections import OrderedDict
+from math import ceil
+from threading import Thread, Lock
+from time import sleep, time
+
+from json import dumps
+
 from paho.mqtt import client
+from paho.mqtt.client import topic_matches_sub
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import logging
 
+from helper.aio import MqttNetworkLoop
+from helper.trace import CommandTrace
+
 
 class MqttConnectionCallback:
 
     def on_mqtt_connected(self, client):
         pass
 
-    def on_mqtt_message_received(self, topic, payload):
+    def on_mqtt_message_received(self, topic, payload, trace=None):
         pass
 
 
 class MqttConnection:
 
-    def __init__(self, ip, port, username, password, connection_callback):
+    def __init__(self, ip, port, username, password, connection_callback, offline_queue_size=1000,
+                 replay_interval=0.01, runtime=None, protocol=client.MQTTv311, trace_commands=False, shared_group=None,
+                 session_expiry=0, command_expiry=0, alias_topic_filters=()):
         self.logger = logging.getLogger("mqtt")
 
-        self.mqtt = client.Client(client.CallbackAPIVersion.VERSION2)
+        self.mqtt = client.Client(client.CallbackAPIVersion.VERSION2, protocol=protocol)
         if username is not None:
             self.mqtt.username_pw_set(username, password)
 
         self.mqtt.on_connect = self._on_connect
         self.mqtt.on_message = self._on_message
 
+        # network i/o is handled by the event loop of the runtime if given, otherwise by the network thread of paho
+        self.network_loop = None
+        if runtime is not None:
+            self.network_loop = MqttNetworkLoop(runtime, self.mqtt)
+
         self.ip = ip
         self.port = port
         self.connection_callback = connection_callback
-        self.queue = []
+
+        # commands are traced if enabled or if a response topic is given (mqtt 5)
+        self.trace_commands = trace_commands
+        self.trace_logger = logging.getLogger("trace")
+
+        self.is_mqtt5 = protocol == client.MQTTv5
+        if not self.is_mqtt5 and (shared_group or session_expiry > 0 or len(alias_topic_filters) > 0):
+            self.logger.warning("shared subscriptions, session expiry and topic aliases require mqtt 5, not using them")
+            shared_group = None
+            session_expiry = 0
+            alias_topic_filters = ()
+
+        # commands are received by one connector instance of the group only, see subscribe_command()
+        self.shared_group = shared_group or None
+        # seconds the broker keeps the session (and the commands published in the meantime) after disconnecting
+        self.session_expiry = session_expiry
+        # seconds after receiving a command without message expiry interval until it is not sent anymore (0 = never)
+        self.command_expiry = command_expiry
+
+        # topics matching the filters are published with a topic alias, as far as the broker allows
+        self.alias_topic_filters = alias_topic_filters
+        self.alias_lock = Lock()
+        self.topic_aliases = {}
+        self.topic_alias_maximum = 0
+        self.alias_candidates = {}
+
+        # messages published while offline, only the latest value per topic is kept
+        self.queue = OrderedDict()
+        self.queue_lock = Lock()
+        self.queue_size = offline_queue_size
+        self.queue_dropped_count = 0
+        self.replay_interval = replay_interval
+        self.replay_worker = None
+
+        # retained messages received while collecting them, see collect_retained()
+        self.retained_filter = None
+        self.retained_messages = {}
 
     def _on_connect(self, client, userdata, flags, rc, properties):
         """
@@ -34,31 +90,159 @@ class MqttConnection:
         """
         self.logger.debug("connected to mqtt with result code %s" % rc)
 
+        # aliases are only valid for a single connection
+        with self.alias_lock:
+            self.topic_aliases = {}
+            if len(self.alias_topic_filters) > 0:
+                self.topic_alias_maximum = getattr(properties, "TopicAliasMaximum", 0) or 0
+
         # subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
         self.connection_callback.on_mqtt_connected(self)
 
-        if len(self.queue) > 0:
-            self.logger.debug("found %d queued messages" % len(self.queue))
-            for msg in self.queue:
-                self._internal_send_message(msg[0], msg[1], False)
-
-            self.queue.clear()
-            self.logger.debug("handled all queued messages")
+        # replay in a separate thread, this callback runs in the network thread of paho
+        self._start_replay()
 
     def _on_message(self, client, userdata, msg):
         """
         The callback for when a PUBLISH message is received from the server.
         """
         self.logger.debug("received mqtt publish of %s with data \"%s\"" % (msg.topic, msg.payload))
-        self.connection_callback.on_mqtt_message_received(msg.topic, msg.payload)
+
+        retained_filter = self.retained_filter
+        if retained_filter is not None and msg.retain and topic_matches_sub(retained_filter, msg.topic):
+            self.retained_messages[msg.topic] = msg.payload.decode('utf-8', errors='replace')
+            return
+
+        trace = None
+        properties = getattr(msg, "properties", None)
+        response_topic = getattr(properties, "ResponseTopic", None)
+
+        # the broker sends the remaining seconds, e.g. of a command it has kept while the connector was disconnected
+        expires_at = None
+        expiry_interval = getattr(properties, "MessageExpiryInterval", None)
+        if expiry_interval is not None:
+            expires_at = time() + expiry_interval
+        elif self.command_expiry > 0:
+            expires_at = time() + self.command_expiry
+
+        if self.trace_commands or response_topic is not None or expires_at is not None:
+            correlation_data = getattr(properties, "CorrelationData", None)
+            trace = CommandTrace(msg.topic, _get_correlation_id(correlation_data), response_topic, correlation_data,
+                                 self._on_trace_finished, expires_at)
+
+        self.connection_callback.on_mqtt_message_received(msg.topic, msg.payload, trace)
+
+    def _on_trace_finished(self, trace):
+        # commands are also traced for their expiry or their reply, only log them if tracing has been enabled
+        self.trace_logger.log(logging.INFO if self.trace_commands else logging.DEBUG, "command %s to %s: %s %s" % (
+            trace.correlation_id, trace.topic, trace.result, trace.get_timings()))
+
+        if trace.response_topic is not None:
+            self.send_reply(trace.response_topic, dumps(trace.to_dict(), sort_keys=True), trace.correlation_data)
+
+    def send_reply(self, topic, payload, correlation_data=None):
+        """
+        Publish the result of a command. Replies are not retained and not queued while offline, they are of no use
+        later on.
+        """
+        properties = None
+        if correlation_data is not None:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.CorrelationData = correlation_data
+
+        result = self.mqtt.publish(topic, payload, properties=properties)
+        if result[0] != client.MQTT_ERR_SUCCESS:
+            self.logger.warning("failed sending reply to %s, mqtt error %s" % (topic, result))
+            return False
+
+        return True
+
+    def collect_retained(self, topic_filter, duration):
+        """
+        Subscribe to a topic filter for some seconds and return the retained messages received (topic -> payload).
+        Collected messages are not passed to the connection callback.
+        """
+        self.retained_messages = {}
+        self.retained_filter = topic_filter
+
+        if not self.subscribe(topic_filter):
+            self.retained_filter = None
+            return {}
+
+        try:
+            sleep(duration)
+        finally:
+            self.unsubscribe(topic_filter)
+            self.retained_filter = None
+
+        self.logger.debug("collected %d retained messages of %s" % (len(self.retained_messages), topic_filter))
+        return self.retained_messages
+
+    def clear_topics(self, topics):
+        """
+        Remove the retained values of the given topics from the broker. The topics are cleared in the background,
+        paced like the replay of queued messages. A value published for one of the topics in the meantime replaces
+        the pending removal.
+        """
+        with self.queue_lock:
+            for topic in topics:
+                # not bounded by the queue size, all of the topics have to be removed
+                self.queue[topic] = ""
+
+        self.logger.debug("clearing %d retained topics" % len(topics))
+
+        # while offline the replay stops at the first message and continues after the connection is established
+        self._start_replay()
+
+    def set_will(self, topic, payload):
+        """
+        Retained message published by the broker if the connection is lost, has to be set before connecting.
+        """
+        self.mqtt.will_set(topic, payload, qos=1, retain=True)
 
     def send_message(self, topic, payload):
         return self._internal_send_message(topic, payload, True)
 
-    def subscribe(self, topic):
+    def forward_command(self, topic, payload, trace=None):
+        """
+        Publish a received command to another topic (not retained), e.g. to the connector instance owning the device.
+        The response topic, correlation data and remaining expiry of the traced command are kept (mqtt 5).
+        """
+        properties = None
+        if self.is_mqtt5 and trace is not None:
+            properties = Properties(PacketTypes.PUBLISH)
+            if trace.response_topic is not None:
+                properties.ResponseTopic = trace.response_topic
+            if trace.correlation_data is not None:
+                properties.CorrelationData = trace.correlation_data
+            if trace.expires_at is not None:
+                properties.MessageExpiryInterval = max(1, int(ceil(trace.expires_at - time())))
+
+        result = self.mqtt.publish(topic, payload, qos=self._get_command_qos(), properties=properties)
+        if result[0] != client.MQTT_ERR_SUCCESS:
+            self.logger.warning("failed forwarding command to %s, mqtt error %s" % (topic, result))
+            return False
+
+        return True
+
+    def subscribe_command(self, topic):
+        """
+        Subscribe to a command topic. With a shared subscription group (mqtt 5) every command is received by only one
+        of the connector instances subscribed with the same group. If the broker keeps the session, commands are
+        subscribed with qos 1, so that commands published while disconnected are received after reconnecting.
+        """
+        if self.shared_group is not None:
+            topic = "$share/%s/%s" % (self.shared_group, topic)
+
+        return self.subscribe(topic, self._get_command_qos())
+
+    def _get_command_qos(self):
+        return 1 if self.session_expiry > 0 else 0
+
+    def subscribe(self, topic, qos=0):
         self.logger.debug("subscribing to topic %s" % topic)
-        result = self.mqtt.subscribe(topic)
+        result = self.mqtt.subscribe(topic, qos)
 
         if result[0] == client.MQTT_ERR_NO_CONN:
             self.logger.warning("no connection while trying to subscribe to topic %s" % topic)
@@ -77,28 +261,150 @@ class MqttConnection:
         return result[0] == client.MQTT_ERR_SUCCESS
 
     def _internal_send_message(self, topic, payload, queue):
+        if queue:
+            with self.queue_lock:
+                # an older value is still waiting to be replayed, replace it so that it is not sent after this one
+                if topic in self.queue:
+                    self.logger.debug("replacing queued value of topic %s" % topic)
+                    self.queue[topic] = payload
+                    return True
+
         self.logger.debug("sending topic %s with value \"%s\"" % (topic, payload))
-        result = self.mqtt.publish(topic, payload, retain=True)
+        result = self._publish(topic, payload)
 
         if result[0] == client.MQTT_ERR_NO_CONN and queue:
             self.logger.debug("no connection, saving message with topic %s to queue" % topic)
-            self.queue.append([topic, payload])
+            self._queue_message(topic, payload)
         elif result[0] != client.MQTT_ERR_SUCCESS:
             self.logger.warning("failed sending message %s, mqtt error %s" % (topic, result))
             return False
 
         return True
 
+    def _publish(self, topic, payload):
+        """
+        Publish a retained message. Topics matching the alias filters are replaced by a topic alias after they have
+        been sent once, as long as the broker accepts more aliases.
+        """
+        if self.topic_alias_maximum == 0 or not self._is_alias_candidate(topic):
+            return self.mqtt.publish(topic, payload, retain=True)
+
+        with self.alias_lock:
+            alias = self.topic_aliases.get(topic)
+            if alias is None and len(self.topic_aliases) >= self.topic_alias_maximum:
+                return self.mqtt.publish(topic, payload, retain=True)
+
+            properties = Properties(PacketTypes.PUBLISH)
+
+            if alias is not None:
+                properties.TopicAlias = alias
+                return self.mqtt.publish("", payload, retain=True, properties=properties)
+
+            # published while holding the lock, the alias must not be used before it has been sent along with the topic
+            properties.TopicAlias = len(self.topic_aliases) + 1
+            result = self.mqtt.publish(topic, payload, retain=True, properties=properties)
+            if result[0] == client.MQTT_ERR_SUCCESS:
+                self.topic_aliases[topic] = properties.TopicAlias
+
+            return result
+
+    def _is_alias_candidate(self, topic):
+        is_candidate = self.alias_candidates.get(topic)
+        if is_candidate is None:
+            is_candidate = any(topic_matches_sub(topic_filter, topic) for topic_filter in self.alias_topic_filters)
+            self.alias_candidates[topic] = is_candidate
+
+        return is_candidate
+
+    def _queue_message(self, topic, payload):
+        with self.queue_lock:
+            self.queue[topic] = payload
+            self.queue.move_to_end(topic)
+
+            if len(self.queue) > self.queue_size:
+                dropped_topic, _ = self.queue.popitem(last=False)
+                self.queue_dropped_count += 1
+                self.logger.warning("offline queue is full, dropped oldest message with topic %s" % dropped_topic)
+
+    def _start_replay(self):
+        with self.queue_lock:
+            if len(self.queue) > 0 and self.replay_worker is None:
+                self.logger.debug("found %d queued messages" % len(self.queue))
+
+                self.replay_worker = Thread(target=self._replay_worker)
+                self.replay_worker.daemon = True
+                self.replay_worker.start()
+
+    def _replay_worker(self):
+        """
+        Send the messages queued while offline, paced so that the broker is not flooded after a reconnect.
+        """
+
+        replayed = 0
+        while True:
+            with self.queue_lock:
+                if len(self.queue) == 0:
+                    self.replay_worker = None
+                    break
+
+                # publish while holding the lock, a newer value must not be sent before the queued one
+                topic, payload = self.queue.popitem(last=False)
+                result = self._publish(topic, payload)
+
+                if result[0] == client.MQTT_ERR_NO_CONN:
+                    self.logger.debug("connection lost while replaying queued messages")
+                    self.queue[topic] = payload
+                    self.queue.move_to_end(topic, last=False)
+                    self.replay_worker = None
+                    return
+                elif result[0] != client.MQTT_ERR_SUCCESS:
+                    self.logger.warning("failed sending queued message %s, mqtt error %s" % (topic, result))
+
+            replayed += 1
+            sleep(self.replay_interval)
+
+        self.logger.debug("handled all queued messages (%d replayed)" % replayed)
+
     def start_connection(self):
+        properties = None
+        if self.session_expiry > 0:
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = int(self.session_expiry)
+
         try:
-            self.mqtt.connect(self.ip, self.port)
+            # the first connection starts a clean session, reconnections resume it (mqtt 5)
+            self.mqtt.connect(self.ip, self.port, properties=properties)
         except ConnectionError:
             self.logger.exception("failed connecting to mqtt")
             return False
 
-        self.mqtt.loop_start()
+        if self.network_loop is not None:
+            self.network_loop.start()
+        else:
+            self.mqtt.loop_start()
         return True
 
     def stop_connection(self):
         self.mqtt.disconnect()
-        self.mqtt.loop_stop()
+
+        if self.network_loop is not None:
+            self.network_loop.stop()
+        else:
+            self.mqtt.loop_stop()
+
+
+def _get_correlation_id(correlation_data):
+    """
+    Use the correlation data of a message as id if it is readable, otherwise its hex representation.
+    """
+    if correlation_data is None:
+        return None
+
+    try:
+        correlation_id = correlation_data.decode("utf-8")
+        if correlation_id.isprintable():
+            return correlation_id
+    except UnicodeDecodeError:
+        pass
+
+    return correlation_data.hex()
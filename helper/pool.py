@@ -0,0 +1,70 @@
+import logging
+from queue import Queue
+from threading import Thread, Lock
+
+
+class WorkerPoolLane:
+
+    def process_pending(self, max_items):
+        pass
+
+    def has_pending(self):
+        return False
+
+
+class WorkerPool:
+    """
+    Fixed number of threads serving the processing queues (lanes) of all devices. A lane is handed to at most one
+    thread at a time, so items of a single device are still processed strictly in order.
+    """
+
+    def __init__(self, size, batch_size=10):
+        self.logger = logging.getLogger("pool")
+        self.batch_size = batch_size
+
+        self.ready_queue = Queue()
+        self.scheduled_lanes = set()
+        self.lock = Lock()
+
+        self.workers = []
+        for index in range(size):
+            worker = Thread(target=self._worker, name="pool-worker-%d" % index)
+            worker.daemon = True
+            worker.start()
+
+            self.workers.append(worker)
+
+        self.logger.info("started worker pool with %d threads" % size)
+
+    def schedule(self, lane):
+        """
+        Mark a lane as having pending items. Lanes which are already scheduled or running are not queued twice.
+        """
+
+        with self.lock:
+            if lane in self.scheduled_lanes:
+                return
+
+            self.scheduled_lanes.add(lane)
+
+        self.ready_queue.put(lane)
+
+    def _worker(self):
+        while True:
+            lane = self.ready_queue.get()
+
+            # noinspection PyBroadException
+            try:
+                # process only a batch, so that a busy lane does not starve the others
+                lane.process_pending(self.batch_size)
+            except Exception:
+                self.logger.exception("processing lane %s failed" % (lane,))
+            finally:
+                with self.lock:
+                    self.scheduled_lanes.discard(lane)
+
+                # items might have been added while the lane was running, schedule() ignored them in that case
+                if lane.has_pending():
+                    self.schedule(lane)
+
+                self.ready_queue.task_done()
@@ -0,0 +1,162 @@
+import heapq
+import logging
+from contextlib import contextmanager
+from random import uniform
+from threading import Thread, Condition, BoundedSemaphore
+from time import time
+
+from helper import metrics
+
+RECONNECT_ATTEMPTS = metrics.counter("chromecast_reconnect_attempts_total",
+                                     "Connection attempts started by the reconnect scheduler")
+RECONNECT_DURATION = metrics.histogram("chromecast_reconnect_duration_seconds",
+                                       "Seconds from requesting a reconnect until the device is connected again",
+                                       buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+
+
+class ReconnectTarget:
+
+    def get_device_name(self):
+        pass
+
+    def request_connection(self):
+        pass
+
+
+class DeviceBackoff:
+    """
+    Reconnect state of a single device.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time()
+        self.failure_count = 0
+        self.next_attempt = 0
+        self.scheduled = False
+        self.generation = 0
+
+
+class ReconnectScheduler(Thread):
+    """
+    Central scheduler for connection attempts. Devices which failed to connect are retried with an exponential
+    backoff (with jitter, so that devices which went offline together do not reconnect together). The number of
+    connection attempts running at the same time is limited by max_parallel_connects (0 = unlimited).
+    """
+
+    def __init__(self, base_delay=1, max_delay=300, jitter=0.5, max_parallel_connects=0):
+        super().__init__()
+        self.daemon = True
+
+        self.logger = logging.getLogger("reconnect")
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+        self.connect_slots = None
+        if max_parallel_connects > 0:
+            self.connect_slots = BoundedSemaphore(max_parallel_connects)
+
+        self.condition = Condition()
+        self.devices = {}
+        self.schedule = []
+        self.counter = 0
+        self.attempt_count = 0
+
+    def start_scheduler(self):
+        self.logger.debug("starting reconnect scheduler")
+        self.start()
+
+    @contextmanager
+    def connect_slot(self):
+        """
+        Wait until a connection attempt may be started.
+        """
+        if self.connect_slots is None:
+            yield
+            return
+
+        with self.connect_slots:
+            yield
+
+    def is_in_backoff(self, device_name):
+        with self.condition:
+            backoff = self.devices.get(device_name)
+            return backoff is not None and backoff.next_attempt > time()
+
+    def request_reconnect(self, connection):
+        """
+        Schedule a connection attempt, as soon as the backoff of the device allows it.
+        """
+
+        with self.condition:
+            backoff = self._get_backoff(connection)
+            if not backoff.scheduled:
+                self._schedule(connection.get_device_name(), backoff, max(backoff.next_attempt, time()))
+
+    def on_connection_failed(self, connection):
+        with self.condition:
+            backoff = self._get_backoff(connection)
+            backoff.failure_count += 1
+
+            delay = min(self.max_delay, self.base_delay * 2 ** (backoff.failure_count - 1))
+            delay *= uniform(1 - self.jitter, 1)
+            backoff.next_attempt = time() + delay
+
+            self.logger.info("connecting to chromecast %s failed %d times, retrying in %.1f seconds" %
+                             (connection.get_device_name(), backoff.failure_count, delay))
+            self._schedule(connection.get_device_name(), backoff, backoff.next_attempt)
+
+    def on_connected(self, connection):
+        with self.condition:
+            backoff = self.devices.pop(connection.get_device_name(), None)
+
+        if backoff is not None:
+            RECONNECT_DURATION.observe(time() - backoff.created_at)
+
+    def cancel(self, device_name):
+        with self.condition:
+            # entries of the schedule are ignored if their backoff is not known anymore
+            self.devices.pop(device_name, None)
+
+    def _get_backoff(self, connection):
+        # called while holding the condition
+        backoff = self.devices.get(connection.get_device_name())
+        if backoff is None:
+            backoff = DeviceBackoff(connection)
+            self.devices[connection.get_device_name()] = backoff
+
+        # the device might have been re-created in the meantime
+        backoff.connection = connection
+        return backoff
+
+    def _schedule(self, device_name, backoff, attempt_time):
+        # called while holding the condition
+        backoff.scheduled = True
+        backoff.generation += 1
+
+        heapq.heappush(self.schedule, (attempt_time, self.counter, device_name, backoff, backoff.generation))
+        self.counter += 1
+        self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.schedule) == 0 or self.schedule[0][0] > time():
+                    timeout = None
+                    if len(self.schedule) > 0:
+                        timeout = self.schedule[0][0] - time()
+
+                    self.condition.wait(timeout)
+
+                attempt_time, _, device_name, backoff, generation = heapq.heappop(self.schedule)
+                if self.devices.get(device_name) is not backoff or backoff.generation != generation:
+                    continue
+
+                backoff.scheduled = False
+                connection = backoff.connection
+                self.attempt_count += 1
+                RECONNECT_ATTEMPTS.inc()
+
+            self.logger.debug("requesting connection attempt for chromecast %s" % device_name)
+            connection.request_connection()
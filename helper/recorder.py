@@ -0,0 +1,106 @@
+import gzip
+import json
+import logging
+from collections import namedtuple
+from threading import Lock
+from time import time
+
+# kinds of recorded events
+EVENT_MQTT_MESSAGE = "mqtt_message"
+EVENT_APPEARED = "appeared"
+EVENT_DISAPPEARED = "disappeared"
+EVENT_CAST_STATUS = "cast_status"
+EVENT_MEDIA_STATUS = "media_status"
+EVENT_CONNECTION_STATUS = "connection_status"
+
+# fields of the pychromecast statuses used by the connector, only these are recorded
+CAST_STATUS_FIELDS = ("display_name", "volume_level", "volume_muted", "app_id")
+MEDIA_STATUS_FIELDS = ("media_metadata", "player_state", "current_time", "duration", "playback_rate", "title",
+                       "album_name", "artist", "album_artist", "track", "content_type", "content_id")
+CONNECTION_STATUS_FIELDS = ("status",)
+
+RecordedCastStatus = namedtuple("RecordedCastStatus", CAST_STATUS_FIELDS)
+RecordedMediaStatus = namedtuple("RecordedMediaStatus", MEDIA_STATUS_FIELDS)
+RecordedConnectionStatus = namedtuple("RecordedConnectionStatus", CONNECTION_STATUS_FIELDS)
+
+# recorded event: seconds since the recording has been started, kind, device name (if any) and the event data
+RecordedEvent = namedtuple("RecordedEvent", ["time", "kind", "device_name", "data"])
+
+STATUS_FIELDS = {
+    EVENT_CAST_STATUS: CAST_STATUS_FIELDS,
+    EVENT_MEDIA_STATUS: MEDIA_STATUS_FIELDS,
+    EVENT_CONNECTION_STATUS: CONNECTION_STATUS_FIELDS,
+}
+
+STATUS_CLASSES = {
+    EVENT_CAST_STATUS: RecordedCastStatus,
+    EVENT_MEDIA_STATUS: RecordedMediaStatus,
+    EVENT_CONNECTION_STATUS: RecordedConnectionStatus,
+}
+
+
+def _open(filename, mode):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode + "t", encoding="utf-8")
+
+    return open(filename, mode, encoding="utf-8")
+
+
+class EventRecorder:
+    """
+    Records the inbound events (mqtt commands, discovery and device statuses) to a file, one json array per line.
+    Files ending with .gz are compressed.
+    """
+
+    def __init__(self, filename):
+        self.logger = logging.getLogger("recorder")
+        self.filename = filename
+        self.lock = Lock()
+        self.file = _open(filename, "w")
+        self.started_at = time()
+        self.event_count = 0
+
+        self.logger.info("recording events to %s" % filename)
+
+    def record(self, kind, device_name, data):
+        line = json.dumps([round(time() - self.started_at, 4), kind, device_name, data], separators=(",", ":"),
+                          default=str)
+
+        with self.lock:
+            if self.file is None:
+                return
+
+            self.file.write(line + "\n")
+            self.event_count += 1
+
+    def record_status(self, kind, device_name, status):
+        if status is None:
+            self.record(kind, device_name, None)
+            return
+
+        self.record(kind, device_name, {field: getattr(status, field, None) for field in STATUS_FIELDS[kind]})
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+        self.logger.info("recorded %d events to %s" % (self.event_count, self.filename))
+
+
+def read_events(filename):
+    """
+    Read a recording, returns a generator of RecordedEvent. Statuses are returned as Recorded*Status.
+    """
+    with _open(filename, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+
+            event_time, kind, device_name, data = json.loads(line)
+
+            if kind in STATUS_CLASSES and data is not None:
+                data = STATUS_CLASSES[kind](**data)
+
+            yield RecordedEvent(event_time, kind, device_name, data)
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+from collections import namedtuple
+from threading import Lock
+from uuid import UUID
+
+CachedService = namedtuple("CachedService", ["device_name", "model_name", "ip_address", "port", "uuid", "cast_type"])
+
+
+class ChromecastServiceCache:
+    """
+    Addresses of Chromecast devices as resolved by the discovery, shared with the device connections so that they
+    can connect to a known host directly instead of browsing for it again. If a file name is given, the cache is
+    persisted so that the devices can be connected right away after a restart.
+    """
+
+    def __init__(self, filename=None):
+        self.logger = logging.getLogger("services")
+        self.lock = Lock()
+        self.services = {}
+        self.filename = filename
+
+        # devices whose cached address did not work, they are kept in the file until the discovery removes them
+        self.stale_devices = set()
+
+    def load(self):
+        """
+        Load the persisted services, returns the loaded services.
+        """
+
+        if self.filename is None or not os.path.isfile(self.filename):
+            return []
+
+        # noinspection PyBroadException
+        try:
+            with open(self.filename, "r") as file:
+                entries = json.load(file)
+
+            services = []
+            for entry in entries:
+                if entry["uuid"] is not None:
+                    entry["uuid"] = UUID(entry["uuid"])
+
+                services.append(CachedService(**entry))
+        except Exception:
+            self.logger.exception("failed reading device cache %s, ignoring it" % self.filename)
+            return []
+
+        with self.lock:
+            for service in services:
+                self.services[service.device_name] = service
+
+        self.logger.info("loaded %d cached devices" % len(services))
+        return services
+
+    def update(self, device_name, model_name, ip_address, port, uuid, cast_type=None):
+        with self.lock:
+            previous = self.services.get(device_name)
+            if cast_type is None and previous is not None:
+                cast_type = previous.cast_type
+
+            service = CachedService(device_name, model_name, ip_address, port, uuid, cast_type)
+            self.stale_devices.discard(device_name)
+            if service == previous:
+                return
+
+            self.services[device_name] = service
+            self._save()
+
+    def get(self, device_name):
+        """
+        Get the cached service of a device, None if unknown or stale.
+        """
+
+        with self.lock:
+            if device_name in self.stale_devices:
+                return None
+
+            return self.services.get(device_name)
+
+    def mark_stale(self, device_name):
+        """
+        Mark the service of a device as stale, e.g. because connecting to the cached address has failed. The device is
+        looked up until its address is updated, but it is still remembered across restarts (it might just be off).
+        """
+
+        with self.lock:
+            if device_name in self.services and device_name not in self.stale_devices:
+                self.stale_devices.add(device_name)
+                self.logger.info("marked cached service of chromecast %s as stale" % device_name)
+
+    def invalidate(self, device_name):
+        """
+        Forget the service of a device, e.g. because the discovery reports it as removed.
+        """
+
+        with self.lock:
+            self.stale_devices.discard(device_name)
+            if self.services.pop(device_name, None) is not None:
+                self.logger.info("invalidated cached service of chromecast %s" % device_name)
+                self._save()
+
+    def _save(self):
+        # called while holding the lock
+        if self.filename is None:
+            return
+
+        entries = []
+        for service in self.services.values():
+            entry = service._asdict()
+            if entry["uuid"] is not None:
+                entry["uuid"] = str(entry["uuid"])
+
+            entries.append(entry)
+
+        # noinspection PyBroadException
+        try:
+            # write to a temporary file first, so that a crash does not leave a broken cache behind
+            temporary_filename = self.filename + ".tmp"
+            with open(temporary_filename, "w") as file:
+                json.dump(entries, file, indent=2, sort_keys=True)
+
+            os.replace(temporary_filename, self.filename)
+        except Exception:
+            self.logger.exception("failed writing device cache %s" % self.filename)
@@ -0,0 +1,80 @@
+import logging
+from threading import Lock
+from time import time
+
+
+class StartupTimeline:
+    """
+    Tracks how long it takes from the start of the connector until the devices found at startup are connected.
+    Every device added before all known devices have been connected is part of the startup.
+    """
+
+    def __init__(self, start_time=None):
+        self.logger = logging.getLogger("startup")
+        self.lock = Lock()
+        self.start_time = start_time if start_time is not None else time()
+
+        self.pending_devices = set()
+        self.connected_devices = set()
+        self.first_added = None
+        self.first_connected = None
+        self.all_connected = None
+
+    def is_finished(self):
+        with self.lock:
+            return self.all_connected is not None
+
+    def on_device_added(self, device_name):
+        with self.lock:
+            if self.all_connected is not None or device_name in self.connected_devices:
+                return
+
+            if self.first_added is None:
+                self.first_added = time() - self.start_time
+                self.logger.info("startup: first device added after %.3f seconds" % self.first_added)
+
+            self.pending_devices.add(device_name)
+
+    def on_device_removed(self, device_name):
+        """
+        Devices which are removed during the startup are not waited for.
+        """
+        with self.lock:
+            if self.all_connected is not None:
+                return
+
+            self.pending_devices.discard(device_name)
+            self._check_finished()
+
+    def on_device_connected(self, device_name):
+        """
+        Returns a summary of the startup if this has been the last device to connect, None otherwise.
+        """
+        with self.lock:
+            if self.all_connected is not None or device_name not in self.pending_devices:
+                return None
+
+            self.pending_devices.discard(device_name)
+            self.connected_devices.add(device_name)
+
+            if self.first_connected is None:
+                self.first_connected = time() - self.start_time
+                self.logger.info("startup: first device connected after %.3f seconds" % self.first_connected)
+
+            return self._check_finished()
+
+    def _check_finished(self):
+        # called while holding the lock
+        if len(self.pending_devices) > 0 or len(self.connected_devices) == 0:
+            return None
+
+        self.all_connected = time() - self.start_time
+        self.logger.info("startup: all %d devices connected after %.3f seconds" %
+                         (len(self.connected_devices), self.all_connected))
+
+        return {
+            "devices": len(self.connected_devices),
+            "first_added": round(self.first_added, 3),
+            "first_connected": round(self.first_connected, 3),
+            "all_connected": round(self.all_connected, 3),
+        }
@@ -0,0 +1,66 @@
+import heapq
+import logging
+from threading import Thread, Condition
+from time import time
+
+
+class TimeoutScheduler(Thread):
+    """
+    Calls functions at a given time, all from a single thread, e.g. for the timeouts of traced commands. A timeout
+    which is not needed anymore is cancelled using the handle returned by call_later(). The functions must not block,
+    as they delay all other timeouts.
+    """
+
+    def __init__(self):
+        super().__init__(name="timeout-scheduler")
+        self.daemon = True
+
+        self.logger = logging.getLogger("timeouts")
+        self.condition = Condition()
+        self.schedule = []
+        self.counter = 0
+
+    def start_scheduler(self):
+        self.logger.debug("starting timeout scheduler")
+        self.start()
+
+    def call_later(self, delay, function, *args):
+        """
+        Call function(*args) after delay seconds. Returns a handle for cancel().
+        """
+
+        with self.condition:
+            # entries are lists, so that cancel() can remove the function without searching the schedule
+            entry = [time() + delay, self.counter, function, args]
+            heapq.heappush(self.schedule, entry)
+            self.counter += 1
+            self.condition.notify()
+
+        return entry
+
+    def cancel(self, handle):
+        with self.condition:
+            # cancelled entries are skipped once they are due
+            handle[2] = None
+            handle[3] = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.schedule) == 0 or self.schedule[0][0] > time():
+                    timeout = None
+                    if len(self.schedule) > 0:
+                        timeout = self.schedule[0][0] - time()
+
+                    self.condition.wait(timeout)
+
+                _, _, function, args = heapq.heappop(self.schedule)
+
+            if function is None:
+                continue
+
+            # noinspection PyBroadException
+            try:
+                function(*args)
+            except Exception:
+                self.logger.exception("timeout %s failed" % (function,))
@@ -0,0 +1,156 @@
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+# hops of a command, in the order they are usually reached
+HOP_RECEIVED = "received"  # received from the broker
+HOP_DISPATCHED = "dispatched"  # handled by the event handler
+HOP_QUEUED = "queued"  # added to the processing queue of the device
+HOP_STARTED = "started"  # taken from the processing queue of the device
+HOP_POSTPONED = "postponed"  # buffered until the device is connected again
+HOP_SENT = "sent"  # pychromecast call returned
+HOP_STATUS = "status"  # first status received from the device afterwards
+
+RESULT_OK = "ok"
+RESULT_NO_STATUS = "no_status"  # sent, but the device did not report a status in time
+RESULT_INVALID = "invalid"  # not addressing a device or invalid payload
+RESULT_REJECTED = "rejected"  # queue full or device not connected
+RESULT_EXPIRED = "expired"  # message expiry interval passed before the command has been sent
+RESULT_PARTIAL = "partial"  # group command, the members have different results
+RESULT_PENDING = "pending"  # member of a group command, not finished when the result has been published
+RESULT_FORWARDED = "forwarded"  # member of a group command, sent to the connector instance owning the device
+RESULT_FAILED = "failed"
+
+
+class CommandTrace:
+    """
+    Timestamps of a single command on its way from the broker to the device, identified by a correlation id. The
+    trace is finished exactly once, which calls finished_callback(trace). A command is not sent to the device anymore
+    after expires_at and not before start_at (if given).
+    """
+
+    def __init__(self, topic, correlation_id=None, response_topic=None, correlation_data=None,
+                 finished_callback=None, expires_at=None, start_at=None):
+        self.topic = topic
+        self.correlation_id = correlation_id or uuid4().hex[:16]
+        self.response_topic = response_topic
+        self.correlation_data = correlation_data
+        self.finished_callback = finished_callback
+        self.expires_at = expires_at
+        self.start_at = start_at
+
+        # results of the member commands (device name -> result document) if this is a group command
+        self.members = None
+
+        self.lock = Lock()
+        self.hops = [(HOP_RECEIVED, time())]
+        self.result = None
+        self.error = None
+
+    def mark(self, hop):
+        with self.lock:
+            if self.result is None:
+                self.hops.append((hop, time()))
+
+    def has_hop(self, hop):
+        with self.lock:
+            return any(name == hop for name, _ in self.hops)
+
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at < time()
+
+    def finish(self, result, error=None):
+        with self.lock:
+            if self.result is not None:
+                return
+
+            self.result = result
+            self.error = error
+
+        if self.finished_callback is not None:
+            self.finished_callback(self)
+
+    def get_timings(self):
+        """
+        Returns the milliseconds from receiving the command until each hop has been reached.
+        """
+        with self.lock:
+            received_at = self.hops[0][1]
+            return {hop: round((reached_at - received_at) * 1000, 3) for hop, reached_at in self.hops}
+
+    def to_dict(self):
+        document = {
+            "correlation_id": self.correlation_id,
+            "topic": self.topic,
+            "received_at": self.hops[0][1],
+            "result": self.result,
+            "timings": self.get_timings(),
+        }
+
+        if self.error is not None:
+            document["error"] = self.error
+
+        if self.members is not None:
+            document["members"] = self.members
+
+        return document
+
+
+class TraceCollector:
+    """
+    Traces waiting for the first status of a device after their commands have been sent. If a timeout scheduler is
+    given, traces which have not received a status within timeout seconds are finished with RESULT_NO_STATUS.
+    """
+
+    def __init__(self, timeout_scheduler=None, timeout=5):
+        self.timeout_scheduler = timeout_scheduler
+        self.timeout = timeout
+
+        self.lock = Lock()
+        self.traces = []
+        # id of the traces of a command -> handle of its timeout
+        self.timeouts = {}
+
+    def add(self, traces):
+        traces = list(traces)
+
+        timeout = None
+        if self.timeout_scheduler is not None:
+            timeout = self.timeout_scheduler.call_later(self.timeout, self._expire, traces)
+
+        with self.lock:
+            # traces finished in the meantime (e.g. by a timeout) are not kept
+            self.traces = [trace for trace in self.traces if trace.result is None] + traces
+
+            if timeout is not None:
+                self.timeouts[id(traces)] = timeout
+
+    def has_traces(self):
+        with self.lock:
+            return len(self.traces) > 0
+
+    def finish(self, hop, result):
+        """
+        Mark all waiting traces with a hop and finish them.
+        """
+        with self.lock:
+            traces = self.traces
+            timeouts = self.timeouts
+            self.traces = []
+            self.timeouts = {}
+
+        for timeout in timeouts.values():
+            self.timeout_scheduler.cancel(timeout)
+
+        for trace in traces:
+            if hop is not None:
+                trace.mark(hop)
+
+            trace.finish(result)
+
+    def _expire(self, traces):
+        with self.lock:
+            self.timeouts.pop(id(traces), None)
+
+        for trace in traces:
+            trace.finish(RESULT_NO_STATUS)
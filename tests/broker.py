@@ -0,0 +1,255 @@
+"""
+Minimal MQTT 3.1.1 broker on a local socket, enough for the connector and a paho client publishing commands. Messages
+are delivered with qos 0, retained messages are kept.
+"""
+import logging
+import socket
+import struct
+from threading import Thread, Lock
+
+from paho.mqtt.client import topic_matches_sub
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+class SocketBroker:
+    """
+    Accepts connections on 127.0.0.1 and a free port (see port), every client is served by an own thread.
+    drop_connections() closes the sockets of all clients, like a lost network connection.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("test-broker")
+        self.lock = Lock()
+        self.sessions = []
+        self.retained = {}
+        self.connect_count = 0
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+
+        self.accept_thread = Thread(target=self._accept, name="test-broker")
+        self.accept_thread.daemon = True
+
+    def start(self):
+        self.accept_thread.start()
+
+    def stop(self):
+        self.server.close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        with self.lock:
+            sessions = list(self.sessions)
+
+        for session in sessions:
+            session.close()
+
+    def get_retained(self, topic):
+        with self.lock:
+            return self.retained.get(topic)
+
+    def is_subscribed(self, topic):
+        """
+        Returns True if a connected client has subscribed to a filter matching the topic.
+        """
+        with self.lock:
+            return any(session.get_subscription(topic) for session in self.sessions)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+
+            session = BrokerSession(self, sock)
+            with self.lock:
+                self.sessions.append(session)
+
+            session.start()
+
+    def _remove(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def _route(self, topic, payload, retain):
+        with self.lock:
+            if retain:
+                if len(payload) == 0:
+                    self.retained.pop(topic, None)
+                else:
+                    self.retained[topic] = payload
+
+            sessions = [session for session in self.sessions if session.get_subscription(topic)]
+
+        for session in sessions:
+            session.send_publish(topic, payload, False)
+
+    def _send_retained(self, session, topic_filter):
+        with self.lock:
+            messages = [(topic, payload) for topic, payload in self.retained.items()
+                        if topic_matches_sub(topic_filter, topic)]
+
+        for topic, payload in messages:
+            session.send_publish(topic, payload, True)
+
+
+class BrokerSession(Thread):
+
+    def __init__(self, broker, sock):
+        Thread.__init__(self, name="test-broker-session")
+        self.daemon = True
+
+        self.broker = broker
+        self.sock = sock
+        self.send_lock = Lock()
+        self.subscriptions = set()
+        self.will = None
+
+    def get_subscription(self, topic):
+        return any(topic_matches_sub(topic_filter, topic) for topic_filter in list(self.subscriptions))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.sock.close()
+
+    def run(self):
+        is_clean = False
+        try:
+            while True:
+                packet_type, flags, body = self._read_packet()
+                if packet_type == DISCONNECT:
+                    is_clean = True
+                    break
+
+                self._handle(packet_type, flags, body)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker._remove(self)
+            self.close()
+
+        if not is_clean and self.will is not None:
+            self.broker._route(*self.will)
+
+    def _handle(self, packet_type, flags, body):
+        if packet_type == CONNECT:
+            self._handle_connect(body)
+            with self.broker.lock:
+                self.broker.connect_count += 1
+            self._send(CONNACK << 4, b"\x00\x00")
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 3
+            topic, offset = _read_string(body, 0)
+            if qos > 0:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self._send(PUBACK << 4, packet_id)
+
+            self.broker._route(topic, body[offset:], flags & 1 == 1)
+        elif packet_type == SUBSCRIBE:
+            packet_id, offset = body[:2], 2
+            topic_filters = []
+            while offset < len(body):
+                topic_filter, offset = _read_string(body, offset)
+                topic_filters.append(topic_filter)
+                offset += 1
+
+            self.subscriptions.update(topic_filters)
+            self._send(SUBACK << 4, packet_id + b"\x00" * len(topic_filters))
+
+            for topic_filter in topic_filters:
+                self.broker._send_retained(self, topic_filter)
+        elif packet_type == UNSUBSCRIBE:
+            packet_id, offset = body[:2], 2
+            while offset < len(body):
+                topic_filter, offset = _read_string(body, offset)
+                self.subscriptions.discard(topic_filter)
+
+            self._send(UNSUBACK << 4, packet_id)
+        elif packet_type == PINGREQ:
+            self._send(PINGRESP << 4, b"")
+
+    def _handle_connect(self, body):
+        _, offset = _read_string(body, 0)
+        connect_flags = body[offset + 1]
+        # protocol level, connect flags and keep alive
+        offset += 4
+        _, offset = _read_string(body, offset)
+
+        if connect_flags & 0x04:
+            will_topic, offset = _read_string(body, offset)
+            length = struct.unpack("!H", body[offset:offset + 2])[0]
+            will_payload = body[offset + 2:offset + 2 + length]
+            self.will = (will_topic, will_payload, connect_flags & 0x20 != 0)
+
+    def send_publish(self, topic, payload, retain):
+        encoded_topic = topic.encode("utf-8")
+        self._send(PUBLISH << 4 | (1 if retain else 0),
+                   struct.pack("!H", len(encoded_topic)) + encoded_topic + payload)
+
+    def _send(self, header, body):
+        length = len(body)
+        encoded_length = bytearray()
+        while True:
+            byte = length % 128
+            length //= 128
+            encoded_length.append(byte | 0x80 if length > 0 else byte)
+            if length == 0:
+                break
+
+        try:
+            with self.send_lock:
+                self.sock.sendall(bytes([header]) + bytes(encoded_length) + body)
+        except OSError:
+            # the session ends once reading fails as well
+            pass
+
+    def _read_packet(self):
+        header = self._read_exactly(1)[0]
+
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self._read_exactly(1)[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if byte & 0x80 == 0:
+                break
+
+        return header >> 4, header & 0x0f, self._read_exactly(length)
+
+    def _read_exactly(self, count):
+        data = b""
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if len(chunk) == 0:
+                raise ConnectionError("connection closed by the client")
+
+            data += chunk
+
+        return data
+
+
+def _read_string(data, offset):
+    length = struct.unpack("!H", data[offset:offset + 2])[0]
+    return data[offset + 2:offset + 2 + length].decode("utf-8"), offset + 2 + length
@@ -0,0 +1,157 @@
+"""
+The connector wired like connector.py does, with simulated devices but a paho client talking to a broker on a local
+socket. Every test runs with the worker threads and with the asyncio runtime, where the network i/o of paho is driven
+by MqttNetworkLoop.
+"""
+import unittest
+from time import time, sleep
+
+from paho.mqtt import client
+
+from benchmark.fakes import SimulatedNetwork, FakeChromecast, SimulatedConnection
+from benchmark.harness import SimulatedEventHandler
+from handler.properties import TOPIC_COMMAND_PLAYER_STATE, TOPIC_COMMAND_VOLUME_LEVEL, TOPIC_PLAYER_STATE, \
+    TOPIC_VOLUME_LEVEL
+from helper.aio import AsyncRuntime
+from helper.mqtt import MqttConnection
+from helper.pool import WorkerPool
+from helper.reconnect import ReconnectScheduler
+from tests.broker import SocketBroker
+
+DEVICE_COUNT = 3
+
+
+def wait_until(condition, timeout=10):
+    started_at = time()
+    while time() - started_at < timeout:
+        if condition():
+            return True
+
+        sleep(0.01)
+
+    return False
+
+
+class RuntimeTestCase:
+    """
+    Tests shared by both runtimes, mixed into a TestCase setting runtime and worker_pool_size.
+    """
+
+    runtime = "threads"
+    worker_pool_size = 0
+
+    def setUp(self):
+        self.broker = SocketBroker()
+        self.broker.start()
+
+        self.network = SimulatedNetwork()
+        self.network.start()
+        SimulatedConnection.network = self.network
+
+        self.async_runtime = None
+        worker_pool = None
+        if self.runtime == "asyncio":
+            self.async_runtime = AsyncRuntime(4)
+            self.async_runtime.start()
+            worker_pool = self.async_runtime
+        elif self.worker_pool_size > 0:
+            worker_pool = WorkerPool(self.worker_pool_size)
+
+        reconnect_scheduler = ReconnectScheduler(0.1, 1, 0.5, 8)
+        reconnect_scheduler.start_scheduler()
+
+        self.event_handler = SimulatedEventHandler(worker_pool, None, None, reconnect_scheduler=reconnect_scheduler,
+                                                   runtime=self.async_runtime)
+        self.mqtt = MqttConnection("127.0.0.1", self.broker.port, None, None, self.event_handler,
+                                   runtime=self.async_runtime)
+        self.event_handler.set_mqtt_connection(self.mqtt)
+        self.assertTrue(self.mqtt.start_connection())
+
+        self.devices = [FakeChromecast("device%d" % index, self.network) for index in range(DEVICE_COUNT)]
+        for device in self.devices:
+            self.event_handler.on_chromecast_appeared(device.name, device.cast_info.model_name, device.cast_info.host,
+                                                      device.cast_info.port)
+
+        self.assertTrue(wait_until(lambda: all(self.broker.is_subscribed(TOPIC_COMMAND_PLAYER_STATE % device.name)
+                                               for device in self.devices)))
+
+        # publishes the commands, like a home automation system would
+        self.publisher = client.Client(client.CallbackAPIVersion.VERSION2)
+        self.publisher.connect("127.0.0.1", self.broker.port)
+        self.publisher.loop_start()
+
+    def tearDown(self):
+        self.publisher.disconnect()
+        self.publisher.loop_stop()
+        self.mqtt.stop_connection()
+
+        if self.async_runtime is not None:
+            self.async_runtime.stop()
+
+        self.broker.stop()
+
+    def test_network_loop(self):
+        # with the asyncio runtime, the network thread of paho must not be used
+        self.assertEqual(self.runtime == "asyncio", self.mqtt.mqtt._thread is None)
+
+    def test_command_is_executed(self):
+        device = self.devices[0]
+        self.publisher.publish(TOPIC_COMMAND_PLAYER_STATE % device.name, "PAUSE")
+
+        self.assertTrue(wait_until(lambda: [name for name, _ in device.commands] == ["pause"]))
+        self.assertTrue(wait_until(lambda: self.broker.get_retained(TOPIC_PLAYER_STATE % device.name) == b"PAUSED"))
+
+    def test_commands_of_a_device_stay_in_order(self):
+        device = self.devices[0]
+        for index in range(10):
+            self.publisher.publish(TOPIC_COMMAND_PLAYER_STATE % device.name, "PAUSE" if index % 2 == 0 else "RESUME")
+
+        expected = ["pause" if index % 2 == 0 else "play" for index in range(10)]
+        self.assertTrue(wait_until(lambda: [name for name, _ in device.commands] == expected))
+
+    def test_devices_execute_commands_in_parallel(self):
+        for device in self.devices:
+            device.response_latency = 0.5
+
+        started_at = time()
+        for device in self.devices:
+            self.publisher.publish(TOPIC_COMMAND_VOLUME_LEVEL % device.name, "20")
+
+        self.assertTrue(wait_until(lambda: all(len(device.commands) == 1 for device in self.devices)))
+        self.assertLess(time() - started_at, 0.5 * DEVICE_COUNT)
+
+        for device in self.devices:
+            self.assertTrue(wait_until(lambda: self.broker.get_retained(TOPIC_VOLUME_LEVEL % device.name) == b"20"))
+
+    def test_reconnects_after_connection_loss(self):
+        device = self.devices[0]
+        connect_count = self.broker.connect_count
+
+        self.broker.drop_connections()
+
+        # both the connector and the publisher reconnect, the connector subscribes again once it has reconnected
+        self.assertTrue(wait_until(lambda: self.broker.connect_count >= connect_count + 2
+                                   and self.broker.is_subscribed(TOPIC_COMMAND_PLAYER_STATE % device.name)))
+
+        self.publisher.publish(TOPIC_COMMAND_PLAYER_STATE % device.name, "PAUSE")
+        self.assertTrue(wait_until(lambda: [name for name, _ in device.commands] == ["pause"]))
+
+
+class ThreadsTest(RuntimeTestCase, unittest.TestCase):
+
+    runtime = "threads"
+
+
+class WorkerPoolTest(RuntimeTestCase, unittest.TestCase):
+
+    runtime = "threads"
+    worker_pool_size = 2
+
+
+class AsyncioTest(RuntimeTestCase, unittest.TestCase):
+
+    runtime = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()